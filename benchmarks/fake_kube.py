@@ -0,0 +1,372 @@
+"""
+A fake Kubernetes API server, good enough to run kubessh against.
+
+Keeps pods, PVCs & Leases in memory. Supports listing (with label & field
+selectors), watching, creating, patching, replacing and deleting them. New pods become
+Running after a configurable scheduling delay. exec runs the requested
+command on this machine, and portforward connects to the port on localhost.
+
+Counts requests by verb & resource, so benchmarks can report how many API
+calls kubessh makes.
+
+    python benchmarks/fake_kube.py --port 18080 --schedule-delay 0.5
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import itertools
+import json
+import random
+import uuid
+
+from aiohttp import web
+
+EXIT_CODE_CHANNEL = 3
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _status(code, reason, message=''):
+    return web.json_response(
+        {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure', 'code': code, 'reason': reason, 'message': message},
+        status=code
+    )
+
+
+def _matches(obj, label_selector, field_selector):
+    labels = obj['metadata'].get('labels') or {}
+    for term in filter(None, (label_selector or '').split(',')):
+        if '=' in term:
+            key, value = term.split('=', 1)
+            if labels.get(key) != value:
+                return False
+        elif term not in labels:
+            return False
+    for term in filter(None, (field_selector or '').split(',')):
+        key, value = term.split('=', 1)
+        current = obj
+        for part in key.split('.'):
+            current = (current or {}).get(part)
+        if current != value:
+            return False
+    return True
+
+
+def _merge_patch(target, patch):
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge_patch(target[key], value)
+        else:
+            target[key] = value
+
+
+def _json_patch(target, operations):
+    """
+    Apply JSON patch operations to target, returning False if a test fails
+    """
+    for operation in operations:
+        parts = [p.replace('~1', '/').replace('~0', '~') for p in operation['path'].split('/')[1:]]
+        parent = target
+        for part in parts[:-1]:
+            parent = parent[int(part)] if isinstance(parent, list) else parent.setdefault(part, {})
+        key = parts[-1]
+        if operation['op'] == 'test':
+            if parent.get(key) != operation['value']:
+                return False
+        elif operation['op'] in ('add', 'replace'):
+            parent[key] = operation['value']
+        elif operation['op'] == 'remove':
+            parent.pop(key, None)
+    return True
+
+
+class FakeKube:
+    """
+    In memory Kubernetes API server, for pods, PVCs & Leases.
+    """
+    def __init__(self, schedule_delay=0.5, schedule_jitter=0.0):
+        self.schedule_delay = schedule_delay
+        self.schedule_jitter = schedule_jitter
+        self.resource_version = itertools.count(1)
+        # kind -> name -> object
+        self.objects = {'pods': {}, 'persistentvolumeclaims': {}, 'leases': {}}
+        # kind -> list of queues of watch events
+        self.watchers = {kind: [] for kind in self.objects}
+        # (verb, resource) -> number of requests
+        self.requests = collections.Counter()
+        self._tasks = set()
+
+        self.app = web.Application()
+        for kind in self.objects:
+            group = '/apis/coordination.k8s.io/v1' if kind == 'leases' else '/api/v1'
+            collection = f'{group}/namespaces/{{namespace}}/{kind}'
+            self.app.router.add_get(collection, self.list_or_watch)
+            self.app.router.add_post(collection, self.create)
+            self.app.router.add_get(collection + '/{name}', self.get)
+            self.app.router.add_patch(collection + '/{name}', self.patch)
+            self.app.router.add_put(collection + '/{name}', self.replace)
+            self.app.router.add_delete(collection + '/{name}', self.delete)
+        self.app.router.add_get('/api/v1/namespaces/{namespace}/pods/{name}/exec', self.exec)
+        self.app.router.add_get('/api/v1/namespaces/{namespace}/pods/{name}/portforward', self.portforward)
+        self.app.router.add_get('/stats', self.stats)
+        self.runner = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        """
+        Start serving, returning the URL the API server is at
+        """
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        host, port = self.runner.addresses[0][:2]
+        return f'http://{host}:{port}'
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await self.runner.cleanup()
+
+    def _kind(self, request):
+        parts = request.path.split('/')
+        return parts[parts.index('namespaces') + 2]
+
+    def _count(self, request, verb):
+        self.requests[verb, self._kind(request)] += 1
+
+    def _emit(self, kind, event_type, obj):
+        obj['metadata']['resourceVersion'] = str(next(self.resource_version))
+        for queue in self.watchers[kind]:
+            queue.put_nowait({'type': event_type, 'object': obj})
+
+    def _background(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def list_or_watch(self, request):
+        kind = self._kind(request)
+        query = request.query
+        if query.get('watch') == 'true':
+            self._count(request, 'watch')
+            return await self._watch(request, kind)
+        self._count(request, 'list')
+        items = [
+            obj for obj in self.objects[kind].values()
+            if _matches(obj, query.get('labelSelector'), query.get('fieldSelector'))
+        ]
+        return web.json_response({
+            'kind': 'List', 'apiVersion': 'v1',
+            'metadata': {'resourceVersion': str(next(self.resource_version))},
+            'items': items,
+        })
+
+    async def _watch(self, request, kind):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        queue = asyncio.Queue()
+        self.watchers[kind].append(queue)
+        timeout = float(request.query.get('timeoutSeconds', 300))
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if _matches(event['object'], request.query.get('labelSelector'), request.query.get('fieldSelector')):
+                    await response.write(json.dumps(event).encode() + b'\n')
+        finally:
+            self.watchers[kind].remove(queue)
+        return response
+
+    async def create(self, request):
+        self._count(request, 'create')
+        kind = self._kind(request)
+        obj = await request.json()
+        metadata = obj.setdefault('metadata', {})
+        if 'generateName' in metadata and 'name' not in metadata:
+            metadata['name'] = metadata['generateName'] + uuid.uuid4().hex[:5]
+        if metadata['name'] in self.objects[kind]:
+            return _status(409, 'AlreadyExists', f'{kind} "{metadata["name"]}" already exists')
+        metadata.update(
+            uid=str(uuid.uuid4()),
+            namespace=request.match_info['namespace'],
+            creationTimestamp=_now(),
+        )
+        if kind == 'pods':
+            obj['status'] = {'phase': 'Pending'}
+            self._background(self._schedule(metadata['name'], metadata['uid']))
+        elif kind == 'persistentvolumeclaims':
+            obj['status'] = {'phase': 'Bound'}
+        self.objects[kind][metadata['name']] = obj
+        self._emit(kind, 'ADDED', obj)
+        return web.json_response(obj, status=201)
+
+    async def _schedule(self, name, uid):
+        await asyncio.sleep(self.schedule_delay + random.uniform(0, self.schedule_jitter))
+        pod = self.objects['pods'].get(name)
+        if pod is None or pod['metadata']['uid'] != uid:
+            return
+        pod['status'] = {
+            'phase': 'Running',
+            'startTime': _now(),
+            'conditions': [{'type': 'Ready', 'status': 'True', 'lastTransitionTime': _now()}],
+        }
+        self._emit('pods', 'MODIFIED', pod)
+
+    async def get(self, request):
+        self._count(request, 'get')
+        obj = self.objects[self._kind(request)].get(request.match_info['name'])
+        if obj is None:
+            return _status(404, 'NotFound')
+        return web.json_response(obj)
+
+    async def patch(self, request):
+        self._count(request, 'patch')
+        kind = self._kind(request)
+        obj = self.objects[kind].get(request.match_info['name'])
+        if obj is None:
+            return _status(404, 'NotFound')
+        body = await request.json()
+        if request.content_type == 'application/json-patch+json':
+            patched = json.loads(json.dumps(obj))
+            if not _json_patch(patched, body):
+                return _status(422, 'Invalid', 'test operation failed')
+            obj.clear()
+            obj.update(patched)
+        else:
+            _merge_patch(obj, body)
+        self._emit(kind, 'MODIFIED', obj)
+        return web.json_response(obj)
+
+    async def replace(self, request):
+        self._count(request, 'replace')
+        kind = self._kind(request)
+        obj = self.objects[kind].get(request.match_info['name'])
+        if obj is None:
+            return _status(404, 'NotFound')
+        body = await request.json()
+        if body['metadata'].get('resourceVersion') not in (None, obj['metadata']['resourceVersion']):
+            return _status(409, 'Conflict', 'the object has been modified')
+        body['metadata'] = dict(obj['metadata'], **body['metadata'])
+        obj.clear()
+        obj.update(body)
+        self._emit(kind, 'MODIFIED', obj)
+        return web.json_response(obj)
+
+    async def delete(self, request):
+        self._count(request, 'delete')
+        kind = self._kind(request)
+        name = request.match_info['name']
+        obj = self.objects[kind].get(name)
+        if obj is None:
+            return _status(404, 'NotFound')
+        if request.can_read_body:
+            preconditions = (await request.json() or {}).get('preconditions') or {}
+            if preconditions.get('uid') not in (None, obj['metadata']['uid']):
+                return _status(409, 'Conflict', 'uid precondition failed')
+            if preconditions.get('resourceVersion') not in (None, obj['metadata']['resourceVersion']):
+                return _status(409, 'Conflict', 'resourceVersion precondition failed')
+        del self.objects[kind][name]
+        self._emit(kind, 'DELETED', obj)
+        return web.json_response(obj)
+
+    async def exec(self, request):
+        self.requests['exec', 'pods'] += 1
+        if request.match_info['name'] not in self.objects['pods']:
+            return _status(404, 'NotFound')
+        ws = web.WebSocketResponse(protocols=['v5.channel.k8s.io', 'v4.channel.k8s.io'])
+        await ws.prepare(request)
+        process = await asyncio.create_subprocess_exec(
+            *request.query.getall('command'),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+
+        async def send_output(stream, channel):
+            while True:
+                data = await stream.read(64 * 1024)
+                if not data:
+                    return
+                await ws.send_bytes(bytes([channel]) + data)
+
+        async def receive_input():
+            async for message in ws:
+                channel, data = message.data[0], message.data[1:]
+                if channel == 0:
+                    process.stdin.write(data)
+                    await process.stdin.drain()
+                elif channel == 255:
+                    process.stdin.close()
+            # Client went away
+            if process.returncode is None:
+                process.kill()
+
+        receiving = asyncio.ensure_future(receive_input())
+        await asyncio.gather(send_output(process.stdout, 1), send_output(process.stderr, 2))
+        code = await process.wait()
+        if code == 0:
+            status = {'status': 'Success'}
+        else:
+            status = {
+                'status': 'Failure', 'reason': 'NonZeroExitCode',
+                'details': {'causes': [{'reason': 'ExitCode', 'message': str(code)}]},
+            }
+        if not ws.closed:
+            await ws.send_bytes(bytes([EXIT_CODE_CHANNEL]) + json.dumps(status).encode())
+            await ws.close()
+        receiving.cancel()
+        return ws
+
+    async def portforward(self, request):
+        self.requests['portforward', 'pods'] += 1
+        ws = web.WebSocketResponse(protocols=['v4.channel.k8s.io'])
+        await ws.prepare(request)
+        port = int(request.query['ports'])
+        prefix = port.to_bytes(2, 'little')
+        await ws.send_bytes(b'\x00' + prefix)
+        await ws.send_bytes(b'\x01' + prefix)
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError as e:
+            await ws.send_bytes(b'\x01' + str(e).encode())
+            await ws.close()
+            return ws
+
+        async def send_upstream_data():
+            while True:
+                data = await reader.read(64 * 1024)
+                if not data:
+                    break
+                await ws.send_bytes(b'\x00' + data)
+            await ws.close()
+
+        sending = asyncio.ensure_future(send_upstream_data())
+        async for message in ws:
+            writer.write(message.data[1:])
+            await writer.drain()
+        writer.close()
+        sending.cancel()
+        return ws
+
+    async def stats(self, request):
+        return web.json_response({f'{verb} {kind}': count for (verb, kind), count in self.requests.items()})
+
+
+async def main(args):
+    fake = FakeKube(args.schedule_delay, args.schedule_jitter)
+    url = await fake.start(args.host, args.port)
+    print(f'Fake Kubernetes API at {url}', flush=True)
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    argparser.add_argument('--port', type=int, default=18080, help='Port to listen on')
+    argparser.add_argument('--schedule-delay', type=float, default=0.5, help='Seconds before new pods are Running')
+    argparser.add_argument('--schedule-jitter', type=float, default=0.0, help='Extra random seconds, up to this, before pods are Running')
+    asyncio.run(main(argparser.parse_args()))
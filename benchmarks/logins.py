@@ -0,0 +1,230 @@
+"""
+Benchmark concurrent ssh logins into kubessh, against a fake Kubernetes API.
+
+Starts the fake API server from fake_kube.py in this process, and kubessh
+(with the DummyAuthenticator) in a subprocess pointed at it. Then opens
+--logins concurrent ssh connections, each running a command in its user's
+pod, for --rounds rounds. The first round has to start pods, later rounds
+find them running.
+
+Reports, per round, login to first output latency (p50 / p99), failed
+logins, Kubernetes API calls made, and kubessh's CPU time & RSS growth per
+session. Runs entirely offline. Exits with a non-zero status if any login
+fails, or p99 latency is over --max-p99, so it can gate releases.
+
+    python benchmarks/logins.py --logins 100 --users 50
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import asyncssh
+
+from fake_kube import FakeKube
+
+# Printed by the command we run in user pods, so we know the shell is up
+READY_MARKER = b'kubessh-benchmark-ready'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def process_usage(pid):
+    """
+    Return (CPU seconds, RSS bytes) used by process pid so far.
+
+    Returns (None, None) where /proc isn't available.
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # Skip past the command name, which might have spaces in it
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/status') as f:
+            rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+    except OSError:
+        return None, None
+    # utime & stime are fields 14 & 15 of stat, 12 & 13 after the command name
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    return cpu, rss
+
+
+def write_config(directory, api_url, ssh_port, args):
+    kubeconfig = os.path.join(directory, 'kubeconfig')
+    with open(kubeconfig, 'w') as f:
+        # JSON is valid YAML
+        json.dump({
+            'apiVersion': 'v1',
+            'kind': 'Config',
+            'clusters': [{'name': 'fake', 'cluster': {'server': api_url}}],
+            'users': [{'name': 'fake', 'user': {'token': 'fake'}}],
+            'contexts': [{'name': 'fake', 'context': {'cluster': 'fake', 'user': 'fake'}}],
+            'current-context': 'fake',
+        }, f)
+
+    config = os.path.join(directory, 'kubessh_config.py')
+    with open(config, 'w') as f:
+        f.write('from kubessh.authentication.dummy import DummyAuthenticator\n')
+        f.write('c.KubeSSH.authenticator_class = DummyAuthenticator\n')
+        f.write(f'c.KubeSSH.port = {ssh_port}\n')
+        f.write('c.KubeSSH.default_namespace = "default"\n')
+        if args.pvcs:
+            pvc_template = {'metadata': {'name': 'home-{username}'}, 'spec': {'accessModes': ['ReadWriteOnce']}}
+            f.write(f'c.UserPod.pvc_templates = {[pvc_template] * args.pvcs!r}\n')
+        if args.warm_pool:
+            f.write(f'c.WarmPool.size = {args.warm_pool}\n')
+        if args.extra_config:
+            f.write(args.extra_config + '\n')
+    return kubeconfig, config
+
+
+async def wait_for_port(port, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'kubessh exited with status {process.returncode}')
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise TimeoutError(f'kubessh did not start listening on port {port}')
+
+
+async def login(port, username):
+    """
+    Log in as username, returning seconds until the command's output arrives
+    """
+    start_time = time.perf_counter()
+    async with asyncssh.connect(
+        '127.0.0.1', port, username=username, password=username, known_hosts=None
+    ) as conn:
+        process = await conn.create_process(f'echo {READY_MARKER.decode()}', encoding=None)
+        output = b''
+        while READY_MARKER not in output:
+            data = await process.stdout.read(1024)
+            if not data:
+                raise RuntimeError(f'Session ended before the shell was ready: {output!r}')
+            output += data
+        latency = time.perf_counter() - start_time
+        await process.wait()
+    return latency
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def run_round(args, ssh_port, kubessh_pid, fake):
+    requests_before = fake.requests.copy()
+    cpu_before, rss_before = process_usage(kubessh_pid)
+    start_time = time.perf_counter()
+    results = await asyncio.gather(
+        *[login(ssh_port, f'user{i % args.users}') for i in range(args.logins)],
+        return_exceptions=True
+    )
+    elapsed = time.perf_counter() - start_time
+    cpu_after, rss_after = process_usage(kubessh_pid)
+
+    latencies = [r for r in results if not isinstance(r, BaseException)]
+    errors = [r for r in results if isinstance(r, BaseException)]
+    report = {
+        'logins': args.logins,
+        'failed': len(errors),
+        'elapsed': elapsed,
+        'api_calls': {
+            f'{verb} {kind}': count - requests_before[verb, kind]
+            for (verb, kind), count in fake.requests.items()
+            if count > requests_before[verb, kind]
+        },
+    }
+    if latencies:
+        report['p50'] = percentile(latencies, 0.5)
+        report['p99'] = percentile(latencies, 0.99)
+    if cpu_before is not None:
+        report['cpu_per_session'] = (cpu_after - cpu_before) / args.logins
+        report['rss'] = rss_after
+        report['rss_per_session'] = (rss_after - rss_before) / args.logins
+    if errors:
+        report['errors'] = sorted({repr(e) for e in errors})[:5]
+    return report
+
+
+def print_report(number, report):
+    line = f'round {number}: {report["logins"]} logins in {report["elapsed"]:.2f}s, {report["failed"]} failed'
+    if 'p50' in report:
+        line += f', p50 {report["p50"] * 1000:.0f}ms, p99 {report["p99"] * 1000:.0f}ms'
+    print(line)
+    if 'cpu_per_session' in report:
+        print(
+            f'  kubessh CPU {report["cpu_per_session"] * 1000:.1f}ms / session, '
+            f'RSS {report["rss"] / 2**20:.1f}MiB ({report["rss_per_session"] / 1024:+.1f}KiB / session)'
+        )
+    print(f'  API calls: {", ".join(f"{k}: {v}" for k, v in sorted(report["api_calls"].items())) or "none"}')
+    for error in report.get('errors', []):
+        print(f'  error: {error}')
+
+
+async def main(args):
+    fake = FakeKube(args.schedule_delay, args.schedule_jitter)
+    api_url = await fake.start()
+    ssh_port = free_port()
+
+    with tempfile.TemporaryDirectory() as directory:
+        kubeconfig, config = write_config(directory, api_url, ssh_port, args)
+        kubessh = subprocess.Popen(
+            [sys.executable, '-m', 'kubessh', f'--KubeSSH.config_file={config}'],
+            env=dict(os.environ, KUBECONFIG=kubeconfig),
+            stdout=None if args.verbose else subprocess.DEVNULL,
+            stderr=None if args.verbose else subprocess.DEVNULL,
+        )
+        try:
+            await wait_for_port(ssh_port, kubessh)
+            if args.warm_pool:
+                # Give the pool time to fill
+                await asyncio.sleep(args.schedule_delay + args.schedule_jitter + 2)
+            reports = []
+            for number in range(1, args.rounds + 1):
+                report = await run_round(args, ssh_port, kubessh.pid, fake)
+                print_report(number, report)
+                reports.append(report)
+        finally:
+            kubessh.terminate()
+            kubessh.wait()
+            await fake.stop()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+    failed = any(report['failed'] for report in reports)
+    too_slow = args.max_p99 is not None and any(report.get('p99', 0) > args.max_p99 for report in reports)
+    if too_slow:
+        print(f'p99 latency over {args.max_p99}s')
+    return 1 if failed or too_slow else 0
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument('--logins', type=int, default=50, help='Concurrent logins per round')
+    argparser.add_argument('--users', type=int, default=50, help='Number of distinct users the logins are spread across')
+    argparser.add_argument('--rounds', type=int, default=2, help='Number of rounds of logins')
+    argparser.add_argument('--schedule-delay', type=float, default=0.5, help='Seconds before new pods are Running')
+    argparser.add_argument('--schedule-jitter', type=float, default=0.0, help='Extra random seconds before pods are Running')
+    argparser.add_argument('--pvcs', type=int, default=0, help='Number of PVCs per user pod')
+    argparser.add_argument('--warm-pool', type=int, default=0, help='Size of the warm pod pool')
+    argparser.add_argument('--extra-config', help='Extra lines of kubessh config')
+    argparser.add_argument('--max-p99', type=float, help='Fail if p99 latency of any round is over this many seconds')
+    argparser.add_argument('--json', help='Write the reports to this file as JSON')
+    argparser.add_argument('--verbose', action='store_true', help="Show kubessh's output")
+    sys.exit(asyncio.run(main(argparser.parse_args())))
@@ -0,0 +1,163 @@
+"""
+Benchmark the port-forward relay against a local echo server.
+
+Measures round trip latency of small request / responses, latency of data
+the server pushes on its own (like output streamed from a Jupyter kernel),
+and bulk throughput. Runs for kubessh.relay.relay and for the polling loop
+it replaced.
+
+    python benchmarks/relay.py
+"""
+import argparse
+import asyncio
+import struct
+import time
+
+from kubessh.relay import relay
+
+
+async def echo(reader, writer):
+    while True:
+        data = await reader.read(64 * 1024)
+        if not data:
+            break
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+async def ticker(reader, writer, interval=0.002):
+    """
+    Push the current time to the client every interval, until it goes away
+    """
+    while not reader.at_eof():
+        writer.write(struct.pack('!d', time.perf_counter()))
+        await writer.drain()
+        await asyncio.sleep(interval)
+    writer.close()
+
+
+async def polling_relay(reader, writer, upstream_reader, upstream_writer):
+    """
+    The relay loop kubessh used before, kept here for comparison
+    """
+    while not reader.at_eof():
+        try:
+            data = await asyncio.wait_for(reader.read(8092), timeout=0.1)
+        except asyncio.TimeoutError:
+            data = None
+        if data:
+            upstream_writer.write(data)
+            await upstream_writer.drain()
+
+        try:
+            in_data = await asyncio.wait_for(upstream_reader.read(8092), timeout=0.1)
+        except asyncio.TimeoutError:
+            in_data = None
+        if in_data:
+            writer.write(in_data)
+            await writer.drain()
+        if upstream_reader.at_eof():
+            break
+    writer.close()
+
+
+async def start_relay(relay_func, upstream_port):
+    async def handle(reader, writer):
+        upstream_reader, upstream_writer = await asyncio.open_connection('127.0.0.1', upstream_port)
+        await relay_func(reader, writer, upstream_reader, upstream_writer)
+    return await asyncio.start_server(handle, '127.0.0.1', 0)
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+    return timings[len(timings) // 2], timings[int(len(timings) * 0.99)]
+
+
+async def measure_round_trip(port, count, size=64):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    message = b'x' * size
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        writer.write(message)
+        await reader.readexactly(size)
+        timings.append(time.perf_counter() - start)
+    writer.close()
+    return percentiles(timings)
+
+
+async def measure_push(port, count):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    timings = []
+    for _ in range(count):
+        sent_at, = struct.unpack('!d', await reader.readexactly(8))
+        timings.append(time.perf_counter() - sent_at)
+    writer.close()
+    return percentiles(timings)
+
+
+async def measure_throughput(port, total_bytes, chunk_size=64 * 1024):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    chunk = b'x' * chunk_size
+
+    async def send():
+        sent = 0
+        while sent < total_bytes:
+            writer.write(chunk)
+            await writer.drain()
+            sent += chunk_size
+
+    async def receive():
+        received = 0
+        while received < total_bytes:
+            data = await reader.read(256 * 1024)
+            if not data:
+                break
+            received += len(data)
+
+    start = time.perf_counter()
+    await asyncio.gather(send(), receive())
+    elapsed = time.perf_counter() - start
+    writer.close()
+    return total_bytes / elapsed / (1024 * 1024)
+
+
+async def main(args):
+    echo_server = await asyncio.start_server(echo, '127.0.0.1', 0)
+    echo_port = echo_server.sockets[0].getsockname()[1]
+    ticker_server = await asyncio.start_server(ticker, '127.0.0.1', 0)
+    ticker_port = ticker_server.sockets[0].getsockname()[1]
+
+    candidates = [('relay', relay, args.round_trips, args.megabytes)]
+    if not args.skip_polling:
+        # The polling loop is slow enough that we give it less work to do
+        candidates.append(('polling', polling_relay, min(args.round_trips, 50), min(args.megabytes, 8)))
+
+    print(f'{"relay":<8} {"rtt p50":>10} {"rtt p99":>10} {"push p50":>10} {"push p99":>10} {"MB/s":>8}')
+    for name, relay_func, round_trips, megabytes in candidates:
+        echo_relay = await start_relay(relay_func, echo_port)
+        ticker_relay = await start_relay(relay_func, ticker_port)
+        port = echo_relay.sockets[0].getsockname()[1]
+
+        rtt = await measure_round_trip(port, round_trips)
+        push = await measure_push(ticker_relay.sockets[0].getsockname()[1], round_trips)
+        throughput = await measure_throughput(port, megabytes * 1024 * 1024)
+        ms = [f'{t * 1000:>8.3f}ms' for t in rtt + push]
+        print(f'{name:<8} {" ".join(ms)} {throughput:>8.1f}')
+
+        # Give the relays time to notice our connections are gone
+        await asyncio.sleep(0.5)
+        echo_relay.close()
+        ticker_relay.close()
+
+    echo_server.close()
+    ticker_server.close()
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument('--round-trips', type=int, default=500, help='Number of small request / responses')
+    argparser.add_argument('--megabytes', type=int, default=512, help='Megabytes to push through for throughput')
+    argparser.add_argument('--skip-polling', action='store_true', help="Don't benchmark the old polling relay")
+    asyncio.run(main(argparser.parse_args()))
@@ -0,0 +1,105 @@
+"""
+Benchmark kubessh.serialization against the functions it replaced.
+
+Compares turning a pod template into a request body via model objects (JSON
+round trip + ApiClient.deserialize, then sanitize_for_serialization) with
+sending the dict as is, and setting attributes on model objects with and
+without the cached attribute index & in place merges.
+
+    python benchmarks/serialization.py
+"""
+import argparse
+import copy
+import json
+import timeit
+
+from kubernetes import client
+
+from kubessh.pod import UserPod
+from kubessh.serialization import (
+    _serialization_api_client, make_api_object_from_dict, api_body, _set_k8s_attribute, merge_dictionaries
+)
+
+def old_make_api_object_from_dict(dict_, kind=client.V1Pod):
+    """
+    The JSON round trip kubessh used before, kept here for comparison
+    """
+    return _serialization_api_client().deserialize(json.dumps(dict_), kind, 'application/json')
+
+
+def old_set_k8s_attribute(obj, attribute, value):
+    """
+    The linear scan & sanitize kubessh used before, kept here for comparison
+    """
+    current_value = None
+    attribute_name = None
+    for python_attribute, json_attribute in obj.attribute_map.items():
+        if json_attribute == attribute:
+            attribute_name = python_attribute
+            break
+    else:
+        raise ValueError('Attribute must be one of {}'.format(obj.attribute_map.values()))
+
+    if hasattr(obj, attribute_name):
+        current_value = getattr(obj, attribute_name)
+
+    if current_value is not None:
+        current_value = _serialization_api_client().sanitize_for_serialization(current_value)
+
+    if isinstance(current_value, dict):
+        setattr(obj, attribute_name, merge_dictionaries(current_value, value))
+    elif isinstance(current_value, list):
+        setattr(obj, attribute_name, current_value + value)
+    else:
+        setattr(obj, attribute_name, value)
+
+
+def make_template(containers):
+    """
+    Return the default pod template, with containers copies of its container
+    """
+    template = copy.deepcopy(UserPod('', 'default').pod_template)
+    container = template['spec']['containers'][0]
+    template['metadata'] = {'labels': {'app': 'kubessh'}, 'annotations': {'team': 'data'}}
+    template['spec']['containers'] = [
+        dict(container, name=f'container-{i}', env=[{'name': f'VAR_{j}', 'value': 'x'} for j in range(20)])
+        for i in range(containers)
+    ]
+    return template
+
+
+def report(name, func, number):
+    per_call = timeit.timeit(func, number=number) / number
+    print(f'{name:<40} {per_call * 1e6:>10.1f}us')
+
+
+def main(args):
+    template = make_template(args.containers)
+    number = args.number
+
+    print(f'pod template with {args.containers} containers, {len(json.dumps(template))} bytes of JSON')
+    report('body via model (old)', lambda: _serialization_api_client().sanitize_for_serialization(
+        old_make_api_object_from_dict(template)), number)
+    report('body via model', lambda: api_body(make_api_object_from_dict(template)), number)
+    report('body from dict', lambda: json.dumps(api_body(template)), number)
+    report('make_api_object_from_dict (old)', lambda: old_make_api_object_from_dict(template), number)
+    report('make_api_object_from_dict', lambda: make_api_object_from_dict(template), number)
+
+    for name, set_attribute in [
+        ('_set_k8s_attribute x3 (old)', old_set_k8s_attribute),
+        ('_set_k8s_attribute x3', _set_k8s_attribute),
+    ]:
+        pod = make_api_object_from_dict(template)
+
+        def set_attributes():
+            set_attribute(pod, 'metadata', {'labels': {'kubessh.yuvi.in/username': 'yuvi'}})
+            set_attribute(pod.spec, 'nodeSelector', {'pool': 'users'})
+            set_attribute(pod.spec, 'restartPolicy', 'Never')
+        report(name, set_attributes, number)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument('--containers', type=int, default=10, help='Number of containers in the pod template')
+    argparser.add_argument('--number', type=int, default=200, help='Number of times to run each function')
+    main(argparser.parse_args())
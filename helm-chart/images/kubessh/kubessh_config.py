@@ -30,3 +30,21 @@ if 'podTemplate' in config:
 
 if 'pvcTemplates' in config:
     c.UserPod.pvc_templates = config['pvcTemplates']
+
+if 'warmPool' in config:
+    c.WarmPool.size = config['warmPool'].get('size', 0)
+    c.WarmPool.size_schedule = config['warmPool'].get('sizeSchedule', [])
+
+if config.get('imagePuller', {}).get('enabled'):
+    c.ImagePuller.enabled = True
+
+if 'workers' in config:
+    c.KubeSSH.workers = config['workers']
+
+if config.get('replicaCount', 1) > 1:
+    # Replicas take turns starting users' pods & filling the warm pool
+    c.UserPod.spawn_lease = True
+    c.WarmPool.leader_election = True
+
+if config.get('metrics', {}).get('enabled'):
+    c.KubeSSH.metrics_port = 9090
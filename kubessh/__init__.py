@@ -0,0 +1,4 @@
+import time
+
+# When kubessh started being imported, so startup timings can include imports
+IMPORT_STARTED = time.perf_counter()
@@ -3,18 +3,37 @@ import shlex
 import logging
 import asyncio
 import argparse
+import contextlib
 import os
-from concurrent.futures import ThreadPoolExecutor
+import shutil
+import signal
+import tempfile
+import time
 from functools import partial
 import itertools
 from traitlets.config import Application
-from traitlets import Unicode, Bool, Integer, Type, default
+from traitlets import Unicode, Bool, Integer, Type, CaselessStrEnum, default
 
 import asyncssh
 
+from kubessh import IMPORT_STARTED
 from kubessh.pod import UserPod, PodState
+from kubessh.informer import PodInformer, PVCInformer
+from kubessh.kube import KubeClient, load_config
+from kubessh.forwarding import PortForwarder
+from kubessh.warmpool import WarmPool
+from kubessh.prepuller import ImagePuller
+from kubessh.sessions import SessionRegistry
+from kubessh.metrics import start_metrics_server
+from kubessh.loopmonitor import LoopMonitor
 from kubessh.authentication import Authenticator
 from kubessh.authentication.github import GitHubAuthenticator
+from kubessh.authentication.keycache import AuthorizedKeysCache
+
+IMPORTS_DONE = time.perf_counter()
+
+# Seconds between checks for exited workers
+WORKER_POLL_INTERVAL = 0.5
 
 
 class KubeSSH(Application):
@@ -34,6 +53,55 @@ class KubeSSH(Application):
         config=True
     )
 
+    workers = Integer(
+        1,
+        help="""
+        Number of worker processes to accept ssh connections with.
+
+        SSH encryption is CPU heavy, and one process can only use one core.
+        With more than one worker, each is a separate process listening on
+        the same port (with SO_REUSEPORT), and the kernel spreads incoming
+        connections between them. Workers are restarted if they die.
+
+        Workers coordinate with each other the same way kubessh replicas do,
+        so UserPod.spawn_lease and WarmPool.leader_election are turned on
+        unless configured otherwise. Fetched keys are shared through
+        AuthorizedKeysCache.cache_dir.
+        """,
+        config=True
+    )
+
+    channel_window = Integer(
+        8 * 1024 * 1024,
+        help="""
+        Bytes a client can send on an ssh channel before waiting for us.
+
+        Larger windows keep more data in flight on high latency links,
+        which bulk transfers like sftp need to run at full speed.
+        """,
+        config=True
+    )
+
+    metrics_port = Integer(
+        0,
+        help="""
+        Port to serve Prometheus metrics on, at /metrics.
+
+        Set to 0 (the default) to not serve metrics. Requires the
+        prometheus_client package. With more than one worker, each worker
+        serves its own metrics, on metrics_port plus its index.
+        """,
+        config=True
+    )
+
+    metrics_host = Unicode(
+        '',
+        help="""
+        Address to serve Prometheus metrics on. Defaults to all interfaces.
+        """,
+        config=True
+    )
+
     host_key_path = Unicode(
         None,
         allow_none=True,
@@ -45,6 +113,19 @@ class KubeSSH(Application):
         config=True
     )
 
+    host_key_type = CaselessStrEnum(
+        ['ssh-ed25519', 'ecdsa-sha2-nistp256', 'ssh-rsa'],
+        default_value='ssh-ed25519',
+        help="""
+        Type of the ephemeral host key generated when host_key_path is None.
+
+        ed25519 keys are generated almost instantly, while RSA keys take a
+        noticeable part of startup time. Only very old clients (OpenSSH
+        before 6.5) can't use ed25519.
+        """,
+        config=True
+    )
+
     debug = Bool(
         False,
         help="""
@@ -53,6 +134,17 @@ class KubeSSH(Application):
         config=True
     )
 
+    use_uvloop = Bool(
+        False,
+        help="""
+        Run on uvloop instead of the default asyncio event loop.
+
+        uvloop is faster, particularly at handling many connections. Requires
+        the uvloop package.
+        """,
+        config=True
+    )
+
     authenticator_class = Type(
         GitHubAuthenticator,
         klass=Authenticator,
@@ -71,6 +163,11 @@ class KubeSSH(Application):
         config=True
     )
 
+    aliases = {
+        **Application.aliases,
+        'workers': 'KubeSSH.workers',
+    }
+
     @default('default_namespace')
     def _populate_default_namespace(self):
         # If no namespace to spawn into is specified, use current pod's namespace by default
@@ -84,14 +181,27 @@ class KubeSSH(Application):
     async def handle_client(self, process):
         username = process.channel.get_extra_info('username')
 
+        if process.subsystem not in (None, 'sftp'):
+            process.stderr.write(f'Subsystem {process.subsystem} is not supported\r\n'.encode())
+            process.exit(1)
+            return
+
         pod = UserPod(parent=self, username=username, namespace=self.default_namespace)
 
 
         spinner = itertools.cycle(['-', '/', '|', '\\'])
 
         async for status in pod.ensure_running():
+            if process.subsystem:
+                # Anything we write would be mistaken for the subsystem's output
+                continue
             if status == PodState.RUNNING:
                 process.stdout.write('\r\033[K'.encode('ascii'))
+            elif status == PodState.STARTING and pod.timeline is not None and process.get_terminal_type():
+                # Say what we are waiting for, on one line that is redrawn
+                line = f'{next(spinner)} {pod.timeline.describe()}'
+                width = process.get_terminal_size()[0] or 80
+                process.stdout.write(f'\r\033[K{line[:width - 1]}'.encode('utf-8', 'replace'))
             elif status == PodState.STARTING:
                 process.stdout.write('\b'.encode('ascii'))
                 process.stdout.write(next(spinner).encode('ascii'))
@@ -102,7 +212,8 @@ class KubeSSH(Application):
         """
         Fix logging so both asyncssh & traitlet logging works
         """
-        self.log.setLevel(logging.DEBUG if self.debug else logging.INFO)
+        # Sets the level of the log handler too, not just the logger
+        self.log_level = logging.DEBUG if self.debug else logging.INFO
         self.log.propagate = True
         UserPod.log = self.log
 
@@ -112,40 +223,221 @@ class KubeSSH(Application):
         asyncssh_logger.setLevel(self.log.level)
 
 
+    @contextlib.contextmanager
+    def timed(self, phase):
+        """
+        Record how long the block takes as phase, for the startup report
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.startup_timings[phase] = time.perf_counter() - start
+
+    def report_startup(self):
+        """
+        Log how long starting up took, and where the time went
+        """
+        total = time.perf_counter() - self.startup_began
+        phases = ', '.join(f'{phase} {seconds:.3f}s' for phase, seconds in self.startup_timings.items())
+        who = f'Worker {self.worker_index}' if self.workers > 1 else 'kubessh'
+        self.log.info(f'{who} ready on port {self.port} in {total:.3f}s ({phases})')
+
     def initialize(self, *args, **kwargs):
-        super().initialize(*args, **kwargs)
-        self.load_config_file(self.config_file)
-        self.init_logging()
+        # Seconds taken by each phase of startup, in order
+        self.startup_began = IMPORT_STARTED
+        self.startup_timings = {'imports': IMPORTS_DONE - IMPORT_STARTED}
+        with self.timed('config'):
+            super().initialize(*args, **kwargs)
+            self.load_config_file(self.config_file)
+            self.init_logging()
+        if self.use_uvloop:
+            self.init_uvloop()
+        # Index of the worker process we are, set in each worker
+        self.worker_index = 0
+        # Key cache directory made for workers, if we made one
+        self.workers_cache_dir = None
+        if self.workers > 1:
+            self.init_workers()
+        with self.timed('kube config'):
+            load_config()
+        # Shared by everything that talks to the Kubernetes API
+        self.kube = KubeClient.instance(parent=self)
+        # Make sure the shared port forwarder, warm pod pool, image puller and key cache pick up our config
+        PortForwarder.instance(parent=self)
+        WarmPool.instance(parent=self, namespace=self.default_namespace)
+        ImagePuller.instance(parent=self, namespace=self.default_namespace)
+        AuthorizedKeysCache.instance(parent=self)
+        SessionRegistry.instance(parent=self, namespace=self.default_namespace)
+
+        with self.timed('host key'):
+            self.init_host_key()
 
+    def init_host_key(self):
         if self.host_key_path is None:
             # We'll generate a temporary key in-memory key for this run only
-            self.ssh_host_key = asyncssh.generate_private_key('ssh-rsa')
-            self.log.warn('No --host-key-path provided, generating an ephemeral host key')
+            self.ssh_host_key = asyncssh.generate_private_key(self.host_key_type)
+            self.log.warning(f'No --host-key-path provided, generating an ephemeral {self.host_key_type} host key')
         else:
             with open(self.host_key_path) as f:
                 self.ssh_host_key = asyncssh.import_private_key(f.read())
             self.log.info(f'Loaded host key from {self.host_key_path}')
 
+    def init_uvloop(self):
+        try:
+            import uvloop
+        except ImportError:
+            self.log.warning('uvloop is not installed, using the default event loop')
+            return
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    def init_workers(self):
+        """
+        Set up config for workers to share state & coordinate with each other
+        """
+        self.config.UserPod.setdefault('spawn_lease', True)
+        self.config.WarmPool.setdefault('leader_election', True)
+        if not self.config.AuthorizedKeysCache.get('cache_dir'):
+            # Removed by supervise once workers are done with it
+            self.workers_cache_dir = tempfile.mkdtemp(prefix='kubessh-keys-')
+            self.config.AuthorizedKeysCache.cache_dir = self.workers_cache_dir
+
+    def start_worker(self, index):
+        """
+        Fork a worker process, returning its pid
+        """
+        pid = os.fork()
+        if pid:
+            return pid
+        # In the worker. Never return from here.
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        # Until LoopMonitor handles them, so they don't kill us
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+        self.worker_index = index
+        # Workers only report their own startup
+        self.startup_began = time.perf_counter()
+        self.startup_timings = {}
+        try:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start())
+            loop.run_forever()
+        except Exception:
+            self.log.exception(f'Worker {index} failed')
+        os._exit(1)
+
+    def supervise(self):
+        """
+        Run workers worker processes, restarting any that die.
+
+        Returns once all workers have been stopped with SIGTERM or SIGINT.
+        """
+        # pid -> (worker index, time.monotonic() when started)
+        workers = {}
+        stopping = False
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+            for pid in workers:
+                os.kill(pid, signal.SIGTERM)
+
+        def forward(signum, frame):
+            for pid in workers:
+                os.kill(pid, signum)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        # Task dumps & profiles, see LoopMonitor
+        signal.signal(signal.SIGUSR1, forward)
+        signal.signal(signal.SIGUSR2, forward)
+
+        try:
+            for index in range(self.workers):
+                workers[self.start_worker(index)] = (index, time.monotonic())
+            self.log.info(f'Started {self.workers} workers')
+
+            while workers:
+                # Only reap our own workers - other children belong to whoever
+                # started them, and os.wait() would take their exit status
+                exited = [
+                    (pid, status) for pid, status in
+                    (os.waitpid(pid, os.WNOHANG) for pid in list(workers))
+                    if pid
+                ]
+                if not exited:
+                    time.sleep(WORKER_POLL_INTERVAL)
+                    continue
+                for pid, status in exited:
+                    index, started = workers.pop(pid)
+                    if stopping:
+                        continue
+                    self.log.warning(
+                        f'Worker {index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}, restarting'
+                    )
+                    if time.monotonic() - started < 1:
+                        # Don't spin if workers die right away
+                        time.sleep(1)
+                    workers[self.start_worker(index)] = (index, time.monotonic())
+        finally:
+            if self.workers_cache_dir is not None:
+                shutil.rmtree(self.workers_cache_dir, ignore_errors=True)
+
     async def start(self):
+        with self.timed('background tasks'):
+            LoopMonitor.instance(parent=self).start()
+            # Start listing & watching user pods before the first login comes in
+            PodInformer.for_namespace(self.default_namespace, parent=self)
+            if UserPod.configured(self.config, 'pvc_templates'):
+                PVCInformer.for_namespace(self.default_namespace, parent=self)
+            WarmPool.instance().start()
+            ImagePuller.instance().start()
+            SessionRegistry.instance().start()
+
+        if self.metrics_port:
+            metrics_port = self.metrics_port + self.worker_index
+            try:
+                with self.timed('metrics'):
+                    await start_metrics_server(self.metrics_host, metrics_port)
+                self.log.info(f'Serving metrics on port {metrics_port}')
+            except ImportError as e:
+                self.log.warning(f'Not serving metrics: {e}')
+
+        with self.timed('listen'):
+            await self.listen()
+        self.report_startup()
+
+    async def listen(self):
         await asyncssh.listen(
             host='',
             port=self.port,
+            # Lets workers all listen on the same port
+            reuse_port=self.workers > 1,
             # Pass log through so we keep same logging infrastructure everywhere
-            server_factory=partial(self.authenticator_class, parent=self, namespace=self.default_namespace, log=self.log),
-            process_factory=self.handle_client,
+            server_factory=partial(
+                self.authenticator_class,
+                parent=self, namespace=self.default_namespace, log=self.log,
+                process_factory=self.handle_client,
+            ),
             kex_algs=[alg.decode('ascii') for alg in asyncssh.kex.get_kex_algs()],
             server_host_keys=[self.ssh_host_key],
             encoding=None,
             agent_forwarding=False, # The cause of so much pain! Let's not allow this by default
+            window=self.channel_window,
             keepalive_interval=30 # FIXME: Make this configurable
         )
 
 app = KubeSSH()
 
 def main():
-    loop = asyncio.get_event_loop()
-
     app.initialize()
+    if app.workers > 1:
+        app.supervise()
+        return
+
+    loop = asyncio.get_event_loop()
     loop.run_until_complete(app.start())
     loop.run_forever()
 
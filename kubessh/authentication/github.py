@@ -1,7 +1,7 @@
 from kubessh.authentication import Authenticator
-import async_timeout
-import aiohttp
-import asyncssh
+from kubessh.authentication.keycache import AuthorizedKeysCache
+from kubessh.metrics import AUTH_DURATION
+import time
 from traitlets import List
 
 class GitHubAuthenticator(Authenticator):
@@ -32,11 +32,10 @@ class GitHubAuthenticator(Authenticator):
             # Deny all users not explicitly allowed
             self.log.info(f"User {username} not in allowed_users, authentication denied")
             return True
-        url = f'https://github.com/{username}.keys'
-        async with aiohttp.ClientSession() as session, async_timeout.timeout(5):
-            async with session.get(url) as response:
-                keys = await response.text()
+        start_time = time.perf_counter()
+        keys = await AuthorizedKeysCache.instance().get(f'https://github.com/{username}.keys')
+        AUTH_DURATION.labels(authenticator='github').observe(time.perf_counter() - start_time)
         if keys:
-            self.conn.set_authorized_keys(asyncssh.import_authorized_keys(keys))
+            self.conn.set_authorized_keys(keys)
         # Return true to indicate we always *must* authenticate
         return True
@@ -1,10 +1,18 @@
 from kubessh.authentication import Authenticator
-import async_timeout
-import aiohttp
+from kubessh.authentication.keycache import AuthorizedKeysCache
+from kubessh.metrics import AUTH_DURATION
+import time
 import asyncssh
 import re
 from traitlets import Unicode, List
 
+
+def parse_keys(keys):
+    # Remove comment fields from SSH keys, as asyncssh seems to choke on those
+    keys = "\n".join(re.findall("^[^ ]+ [^ ]+", keys, flags=re.M))
+    return asyncssh.import_authorized_keys(keys)
+
+
 class GitLabAuthenticator(Authenticator):
     """
     Authenticate with GitLab SSH keys
@@ -44,12 +52,10 @@ class GitLabAuthenticator(Authenticator):
             self.log.info(f"User {username} not in allowed_users, authentication denied")
             return True
         url = f'{self.instance_url}/{username}.keys'
-        async with aiohttp.ClientSession() as session, async_timeout.timeout(5):
-            async with session.get(url) as response:
-                keys = await response.text()
+        start_time = time.perf_counter()
+        keys = await AuthorizedKeysCache.instance().get(url, parse=parse_keys)
+        AUTH_DURATION.labels(authenticator='gitlab').observe(time.perf_counter() - start_time)
         if keys:
-            # Remove comment fields from SSH keys, as asyncssh seems to choke on those
-            keys = "\n".join(re.findall("^[^ ]+ [^ ]+", keys, flags=re.M))
-            self.conn.set_authorized_keys(asyncssh.import_authorized_keys(keys))
+            self.conn.set_authorized_keys(keys)
         # Return true to indicate we always *must* authenticate
         return True
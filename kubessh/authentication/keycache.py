@@ -0,0 +1,201 @@
+"""
+Cache of users' public keys fetched over HTTP.
+
+GitHub, GitLab & friends publish every user's public keys at a URL like
+https://github.com/<username>.keys. Fetching these on every login adds an
+external round trip to each one, and makes logins fail whenever the key
+server is slow, down or rate limiting us. AuthorizedKeysCache shares one HTTP
+session across all lookups and keeps the parsed keys around:
+
+- Keys younger than `ttl` are used as is.
+- Older keys are still used, but refreshed in the background.
+- Users with no keys (or that don't exist) are remembered for `negative_ttl`.
+- Concurrent lookups of the same URL share a single fetch.
+- If a fetch fails or times out, the last keys we saw are used instead.
+
+With cache_dir set, fetched keys are also written to files there, so
+worker processes sharing the directory share their fetches too.
+"""
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+
+import aiohttp
+import asyncssh
+from traitlets.config import SingletonConfigurable
+from traitlets import Float, Unicode
+
+
+class AuthorizedKeysCache(SingletonConfigurable):
+    """
+    Shared cache of parsed authorized keys, keyed by URL.
+
+    Get it with `AuthorizedKeysCache.instance()`.
+    """
+    ttl = Float(
+        300,
+        help="""
+        Seconds fetched keys are used before they are refreshed.
+
+        Keys older than this are still used while the refresh happens in the
+        background, so users removing a key might be able to log in with it
+        once more after ttl expires.
+        """,
+        config=True
+    )
+
+    max_stale = Float(
+        24 * 60 * 60,
+        help="""
+        Seconds after which keys are too old to be used while refreshing.
+
+        Logins then wait for fresh keys. If fetching fresh keys fails, the
+        old keys are still used no matter how old they are.
+        """,
+        config=True
+    )
+
+    negative_ttl = Float(
+        60,
+        help="""
+        Seconds to remember that a user has no keys.
+        """,
+        config=True
+    )
+
+    fetch_timeout = Float(
+        5,
+        help="""
+        Seconds to wait for keys to be fetched.
+        """,
+        config=True
+    )
+
+    cache_dir = Unicode(
+        '',
+        help="""
+        Directory to share fetched keys with other kubessh processes in.
+
+        Empty (the default) keeps keys in memory only. Set automatically
+        when running with more than one worker.
+        """,
+        config=True
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # url -> (parsed keys or None, time.monotonic() when fetched)
+        self.entries = {}
+        # url -> future of the fetch in progress
+        self._fetches = {}
+        self._session = None
+
+    def _ensure_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.fetch_timeout)
+            )
+        return self._session
+
+    def _path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode()).hexdigest())
+
+    def _load(self, url, parse):
+        """
+        Return entry for url saved in cache_dir by any process, or None
+        """
+        try:
+            path = self._path(url)
+            age = time.time() - os.stat(path).st_mtime
+            with open(path) as f:
+                keys = f.read()
+            return (parse(keys) if keys.strip() else None, time.monotonic() - age)
+        except (OSError, ValueError, asyncssh.KeyImportError):
+            return None
+
+    def _save(self, url, keys):
+        # Written to a temporary file first, so readers never see half of it
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, 'w') as f:
+                f.write(keys)
+            os.replace(tmp_path, self._path(url))
+        except OSError as e:
+            self.log.warning(f'Saving keys from {url} to {self.cache_dir} failed: {e!r}')
+
+    async def _fetch(self, url, parse):
+        """
+        Fetch & parse keys from url, returning None if there aren't any
+        """
+        async with self._ensure_session().get(url) as response:
+            if response.status == 404:
+                keys = ''
+            else:
+                response.raise_for_status()
+                keys = await response.text()
+        if self.cache_dir:
+            self._save(url, keys)
+        if not keys.strip():
+            return None
+        return parse(keys)
+
+    def _refresh(self, url, parse):
+        """
+        Return future for fetching url, starting a fetch if none is running
+        """
+        fetch = self._fetches.get(url)
+        if fetch is None:
+            fetch = self._fetches[url] = asyncio.ensure_future(self._fetch(url, parse))
+
+            def done(fetch):
+                del self._fetches[url]
+                if fetch.cancelled():
+                    return
+                if fetch.exception() is None:
+                    self.entries[url] = (fetch.result(), time.monotonic())
+                else:
+                    self.log.warning(f'Fetching keys from {url} failed: {fetch.exception()!r}')
+            fetch.add_done_callback(done)
+        return fetch
+
+    def _fresh(self, entry):
+        keys, fetched_at = entry
+        return time.monotonic() - fetched_at < (self.ttl if keys is not None else self.negative_ttl)
+
+    async def get(self, url, parse=asyncssh.import_authorized_keys):
+        """
+        Return authorized keys published at url, or None if there are none.
+
+        parse is called with the text of the response to turn it into keys
+        asyncssh understands.
+        """
+        entry = self.entries.get(url)
+        if self.cache_dir and (entry is None or not self._fresh(entry)):
+            # Another process might have fetched more recently than us
+            saved = self._load(url, parse)
+            if saved is not None and (entry is None or saved[1] > entry[1]):
+                entry = self.entries[url] = saved
+        if entry is not None:
+            keys, fetched_at = entry
+            age = time.monotonic() - fetched_at
+            if self._fresh(entry):
+                return keys
+            if keys is not None and age < self.max_stale:
+                # Stale while revalidate
+                self._refresh(url, parse)
+                return keys
+
+        try:
+            # shield, so one login giving up doesn't cancel the fetch for others
+            return await asyncio.shield(self._refresh(url, parse))
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, asyncssh.KeyImportError):
+            if entry is not None:
+                self.log.info(f'Using keys from {url} fetched {age:.0f}s ago')
+                return entry[0]
+            return None
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
@@ -4,13 +4,37 @@ Standalone daemon to clean up finished shell pods.
 User pods can mark themselves as 'completed' by killing their
 pid 1 (kill 1)d
 
+Finished user pods are found by watching for pods with kubessh's username
+label entering the Succeeded phase, so they are deleted as soon as they
+finish rather than on the next poll. Pods that finished while we weren't
+watching are found by listing, a page at a time.
 """
+import asyncio
+import datetime
 import kubernetes
-import time
 import logging
 import os
 from traitlets.config import Application
-from traitlets import Unicode, default, Bool
+from traitlets import Unicode, Integer, Float, default, Bool
+
+from kubessh.kube import KubeClient, load_config
+from kubessh.informer import USERNAME_LABEL
+
+
+def _finished_at(pod):
+    """
+    Return when the last container in pod terminated, or None if unknown
+    """
+    finished = [
+        status['state']['terminated']['finishedAt']
+        for status in pod.get('status', {}).get('containerStatuses') or []
+        if (status.get('state') or {}).get('terminated', {}).get('finishedAt')
+    ]
+    if not finished:
+        return None
+    # Python < 3.11 can't parse the 'Z' suffix
+    return datetime.datetime.fromisoformat(max(finished).replace('Z', '+00:00'))
+
 
 class KubeSanitation(Application):
     config_file = Unicode(
@@ -35,6 +59,46 @@ class KubeSanitation(Application):
         config=True
     )
 
+    page_size = Integer(
+        500,
+        help="""
+        Number of pods to ask for at a time when listing finished pods
+        """,
+        config=True
+    )
+
+    delete_concurrency = Integer(
+        10,
+        help="""
+        Maximum number of pod deletions in flight at any time
+        """,
+        config=True
+    )
+
+    watch_timeout = Integer(
+        300,
+        help="""
+        Seconds after which pod watches are restarted
+        """,
+        config=True
+    )
+
+    poll_interval = Float(
+        30,
+        help="""
+        Seconds between looking for finished pods, when not allowed to watch pods
+        """,
+        config=True
+    )
+
+    report_interval = Float(
+        300,
+        help="""
+        Seconds between logging how quickly finished pods are being deleted
+        """,
+        config=True
+    )
+
     @default('namespace')
     def _populate_default_namespace(self):
         # If no namespace to spawn into is specified, use current pod's namespace by default
@@ -45,31 +109,141 @@ class KubeSanitation(Application):
         else:
             return 'default'
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # uid -> task deleting the pod
+        self.deleting = {}
+        # Seconds between pods finishing & being deleted, since the last report
+        self.deletion_lags = []
+        self.deleted = 0
+
     def initialize(self, *args, **kwargs):
+        super().initialize(*args, **kwargs)
         self.load_config_file(self.config_file)
-        self.log.setLevel(logging.DEBUG if self.debug else logging.INFO)
-        try:
-            kubernetes.config.load_incluster_config()
-        except kubernetes.config.ConfigException:
-            kubernetes.config.load_kube_config()
+        # Sets the level of the log handler too, not just the logger
+        self.log_level = logging.DEBUG if self.debug else logging.INFO
+        load_config()
+        self.kube = KubeClient.instance(parent=self)
+
+    @property
+    def path(self):
+        return f'/api/v1/namespaces/{self.namespace}/pods'
 
-    def start(self):
-        v1 = kubernetes.client.CoreV1Api()
+    @property
+    def selectors(self):
+        return {'labelSelector': USERNAME_LABEL, 'fieldSelector': 'status.phase=Succeeded'}
+
+    def schedule_delete(self, pod):
+        """
+        Start deleting pod, unless it is already being deleted
+        """
+        uid = pod['metadata']['uid']
+        if uid in self.deleting or pod['metadata'].get('deletionTimestamp'):
+            return
+        self.deleting[uid] = asyncio.ensure_future(self.delete(pod))
+        self.deleting[uid].add_done_callback(lambda task: self.deleting.pop(uid, None))
+
+    async def delete(self, pod):
+        name = pod['metadata']['name']
+        async with self._delete_semaphore:
+            self.log.info(f"Deleting pod {name}...")
+            try:
+                # Make sure we don't delete a new pod that got the same name
+                await self.kube.delete(f'{self.path}/{name}', body={
+                    'preconditions': {'uid': pod['metadata']['uid']}
+                })
+            except kubernetes.client.rest.ApiException as e:
+                if e.status in (404, 409):
+                    # Already gone
+                    return
+                self.log.warning(f'Deleting pod {name} failed: {e.status} {e.reason}')
+                return
+
+        self.deleted += 1
+        finished_at = _finished_at(pod)
+        if finished_at is not None:
+            lag = (datetime.datetime.now(datetime.timezone.utc) - finished_at).total_seconds()
+            self.deletion_lags.append(lag)
+            self.log.debug(f'Deleted pod {name}, {lag:.1f}s after it finished')
+
+    async def sweep(self):
+        """
+        Delete all finished pods, returning the resourceVersion they were listed at
+        """
+        params = dict(self.selectors, limit=str(self.page_size))
+        resource_version = None
+        while True:
+            page = await self.kube.get(self.path, params)
+            # All pages come from the same snapshot as the first one
+            resource_version = resource_version or page['metadata']['resourceVersion']
+            for pod in page['items']:
+                self.schedule_delete(pod)
+            if not page['metadata'].get('continue'):
+                return resource_version
+            params = dict(params, **{'continue': page['metadata']['continue']})
+
+    async def watch(self, resource_version):
+        """
+        Delete pods as they finish, until the watch times out
+        """
+        async for event in self.kube.watch(
+            self.path,
+            dict(self.selectors, resourceVersion=resource_version, allowWatchBookmarks='true'),
+            timeout_seconds=self.watch_timeout
+        ):
+            if event['type'] in ('ADDED', 'MODIFIED'):
+                self.schedule_delete(event['object'])
+            resource_version = event['object']['metadata']['resourceVersion']
+        return resource_version
+
+    def report(self):
+        if self.deletion_lags:
+            lags = sorted(self.deletion_lags)
+            self.log.info(
+                f'Deleted {self.deleted} finished pods in the last {self.report_interval:.0f}s. '
+                f'Deletion lag p50 {lags[len(lags) // 2]:.1f}s, max {lags[-1]:.1f}s'
+            )
+        self.deletion_lags = []
+        self.deleted = 0
+
+    async def _report_forever(self):
         while True:
-            pods = v1.list_namespaced_pod(self.namespace, field_selector="status.phase=Succeeded")
-            if len(pods.items):
-                for pod in pods.items:
-                    self.log.info(f"Deleting pod {pod.metadata.name}...")
-                    v1.delete_namespaced_pod(pod.metadata.name, self.namespace)
-            else:
-                self.log.info("No completed pods found")
-            time.sleep(30)
+            await asyncio.sleep(self.report_interval)
+            self.report()
+
+    async def start(self):
+        self._delete_semaphore = asyncio.Semaphore(self.delete_concurrency)
+        reporter = asyncio.ensure_future(self._report_forever())
+        backoff = 1
+        try:
+            while True:
+                try:
+                    resource_version = await self.sweep()
+                    while True:
+                        resource_version = await self.watch(resource_version)
+                        backoff = 1
+                except kubernetes.client.rest.ApiException as e:
+                    if e.status == 410:
+                        # Our resourceVersion or continue token is too old, so list again
+                        self.log.debug('Watch expired, listing finished pods again')
+                        continue
+                    if e.status == 403:
+                        self.log.warning('Not allowed to watch pods, falling back to polling')
+                        await asyncio.sleep(self.poll_interval)
+                        continue
+                    self.log.warning(f'Watching for finished pods failed: {e.status} {e.reason}')
+                except Exception:
+                    self.log.exception('Watching for finished pods failed')
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+        finally:
+            reporter.cancel()
 
 
 def main():
     app = KubeSanitation()
     app.initialize()
-    app.start()
+    asyncio.get_event_loop().run_until_complete(app.start())
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,60 @@
+"""
+Port forwards into user pods.
+
+Every forwarded ssh channel opens its own stream to the pod, so there is
+nothing to pool. What is worth sharing is knowing where to connect to:
+PortForwarder remembers the pod each user's forwards last went to, and
+while the pod informer still shows that same pod running, new forwards
+skip straight to opening a stream - no matter which ssh connection they
+came in on.
+"""
+from traitlets.config import SingletonConfigurable
+
+from kubessh.informer import PodInformer
+from kubessh.pod import PodState, pod_is_running
+from kubessh.stream import PortForwardStream
+
+
+class PortForwarder(SingletonConfigurable):
+    """
+    Opens port forwards into user pods, starting them if needed.
+
+    Get it with `PortForwarder.instance()`.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (namespace, pod name of the user) -> (name, uid) of the pod last connected to
+        self.pods = {}
+
+    def running_pod(self, namespace, pod_name):
+        """
+        Return the pod forwards for pod_name last went to, if it is still running
+        """
+        known = self.pods.get((namespace, pod_name))
+        if known is None:
+            return None
+        name, uid = known
+        pod = PodInformer.for_namespace(namespace).get(name)
+        if pod is not None and pod['metadata']['uid'] == uid and pod_is_running(pod):
+            return pod
+        # Gone or replaced, so the next forward looks it up again
+        del self.pods[(namespace, pod_name)]
+        return None
+
+    async def connect(self, user_pod, port):
+        """
+        Open a new stream to port in user_pod's pod, starting the pod if needed.
+
+        user_pod's pod & pod_name are set to the pod connected to.
+        """
+        key = (user_pod.namespace, user_pod.pod_name)
+        pod = self.running_pod(*key)
+        if pod is None:
+            async for status in user_pod.ensure_running():
+                if status == PodState.RUNNING:
+                    break
+            self.pods[key] = (user_pod.pod_name, user_pod.pod['metadata']['uid'])
+        else:
+            user_pod.pod = pod
+            user_pod.pod_name = pod['metadata']['name']
+        return await PortForwardStream.connect(user_pod.namespace, user_pod.pod_name, port)
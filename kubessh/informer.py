@@ -0,0 +1,263 @@
+"""
+Process-wide cache of user pods, kept up to date with a single watch.
+
+Every ssh channel and every forwarded connection needs to know the state
+of its user's pod. Instead of asking the API server each time, we list
+all pods carrying the kubessh username label once per namespace, then
+keep that list current with a watch. Lookups are answered from memory.
+
+User PVCs are kept track of the same way, by PVCInformer, so PVCs that
+already exist don't have to be created again at every spawn.
+"""
+import asyncio
+
+import kubernetes
+from traitlets.config import LoggingConfigurable
+from traitlets import Integer, Unicode
+
+from kubessh.kube import KubeClient
+
+USERNAME_LABEL = 'kubessh.yuvi.in/username'
+
+
+def _resource_version(pod):
+    try:
+        return int(pod['metadata']['resourceVersion'])
+    except (KeyError, TypeError, ValueError):
+        # resourceVersion is opaque as per the API conventions. If it
+        # isn't an integer, we can't order events, so assume it is newer.
+        return None
+
+
+class PodInformer(LoggingConfigurable):
+    """
+    In-memory index of kubessh user pods in a namespace.
+
+    There is exactly one of these per namespace per process, obtained with
+    `PodInformer.for_namespace`. Pods are indexed both by name and by the
+    value of their kubessh username label.
+    """
+    namespace = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Kubernetes Namespace whose user pods are being watched.
+        """,
+    )
+
+    watch_timeout = Integer(
+        300,
+        help="""
+        Seconds after which a watch is closed by the API server & resumed
+        from the last seen resourceVersion.
+        """,
+        config=True
+    )
+
+    # Resource under /api/v1/namespaces/<namespace> that is listed & watched
+    resource = 'pods'
+
+    _instances = {}
+
+    @classmethod
+    def for_namespace(cls, namespace, **kwargs):
+        """
+        Return the informer for namespace, creating & starting it if needed
+        """
+        if namespace not in cls._instances:
+            informer = cls(namespace=namespace, **kwargs)
+            informer.start()
+            cls._instances[namespace] = informer
+        return cls._instances[namespace]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # pod name -> pod object
+        self.pods = {}
+        # username label -> pod name
+        self.pods_by_user = {}
+        self.synced = False
+        # Set when we aren't allowed to list / watch pods at all
+        self.forbidden = False
+        # pod name -> list of futures waiting for the next change to that pod
+        self._waiters = {}
+        self._task = None
+
+    def start(self):
+        """
+        Start listing & watching pods in the background.
+        """
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def get(self, name):
+        """
+        Return cached pod with given name, or None if we don't know about it.
+
+        A None return does not mean the pod does not exist - the cache might not
+        be synced yet, or the watch might be lagging. Callers should treat it
+        as a cache miss and ask the API server.
+        """
+        if not self.synced:
+            return None
+        return self.pods.get(name)
+
+    def get_by_user(self, username_label):
+        """
+        Return cached pod belonging to given (escaped) username, if any
+        """
+        if not self.synced:
+            return None
+        name = self.pods_by_user.get(username_label)
+        if name is None:
+            return None
+        return self.pods.get(name)
+
+    def record(self, pod):
+        """
+        Record pod object we got directly from the API server.
+
+        Used to seed the cache from create / read responses, so we don't have
+        to wait for the watch to catch up. Never replaces a newer object.
+        """
+        self._apply('MODIFIED', pod)
+
+    async def wait_for_change(self, name, timeout):
+        """
+        Wait up to timeout seconds for the next change to pod with given name.
+
+        Returns the cached pod after the change (None if it was deleted), or the
+        current cached pod if nothing changed before the timeout.
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.setdefault(name, []).append(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return self.pods.get(name)
+        finally:
+            waiters = self._waiters.get(name, [])
+            if future in waiters:
+                waiters.remove(future)
+            if not waiters:
+                self._waiters.pop(name, None)
+
+    def _notify(self, name):
+        for future in self._waiters.pop(name, []):
+            if not future.done():
+                future.set_result(self.pods.get(name))
+
+    def forget(self, name):
+        """
+        Drop pod with given name from the cache.
+        """
+        pod = self.pods.pop(name, None)
+        if pod is not None:
+            self._unindex(pod)
+            self._notify(name)
+
+    def _index(self, pod):
+        username = pod['metadata'].get('labels', {}).get(USERNAME_LABEL)
+        # Unclaimed warm pool pods have an empty username
+        if username:
+            self.pods_by_user[username] = pod['metadata']['name']
+
+    def _unindex(self, pod):
+        username = pod['metadata'].get('labels', {}).get(USERNAME_LABEL)
+        if self.pods_by_user.get(username) == pod['metadata']['name']:
+            del self.pods_by_user[username]
+
+    def _apply(self, event_type, pod):
+        if event_type not in ('ADDED', 'MODIFIED', 'DELETED'):
+            # BOOKMARK events only move our resourceVersion forward
+            return
+        name = pod['metadata']['name']
+        current = self.pods.get(name)
+        if event_type == 'DELETED':
+            if current is not None and current['metadata']['uid'] == pod['metadata']['uid']:
+                self.forget(name)
+            return
+
+        if current is not None:
+            current_version = _resource_version(current)
+            new_version = _resource_version(pod)
+            if current['metadata']['uid'] == pod['metadata']['uid'] and \
+                    None not in (current_version, new_version) and \
+                    new_version < current_version:
+                # Stale object, possibly from a read that raced the watch
+                return
+            self._unindex(current)
+        self.pods[name] = pod
+        self._index(pod)
+        self._notify(name)
+
+    def _replace(self, pods):
+        self.pods = {}
+        self.pods_by_user = {}
+        for pod in pods:
+            self._apply('ADDED', pod)
+        self.synced = True
+        self.forbidden = False
+        # Anything waiting might have missed events while we were relisting
+        for name in list(self._waiters):
+            self._notify(name)
+
+    def _set_unsynced(self, forbidden=False):
+        self.synced = False
+        self.forbidden = forbidden
+
+    async def _run(self):
+        kube = KubeClient.instance()
+        path = f'/api/v1/namespaces/{self.namespace}/{self.resource}'
+        params = {'labelSelector': USERNAME_LABEL}
+
+        backoff = 1
+        while True:
+            try:
+                pod_list = await kube.get(path, params)
+                resource_version = pod_list['metadata']['resourceVersion']
+                self._replace(pod_list['items'])
+                self.log.debug(f'Listed {len(pod_list["items"])} user {self.resource} in {self.namespace}')
+
+                while True:
+                    # Resume from the last resourceVersion we saw, so no events
+                    # are lost between watches. Bookmarks keep it fresh even
+                    # when none of our pods change for a while.
+                    async for event in kube.watch(
+                        path,
+                        dict(params, resourceVersion=resource_version, allowWatchBookmarks='true'),
+                        timeout_seconds=self.watch_timeout
+                    ):
+                        self._apply(event['type'], event['object'])
+                        resource_version = event['object']['metadata']['resourceVersion']
+                    backoff = 1
+            except kubernetes.client.rest.ApiException as e:
+                if e.status == 410:
+                    # Our resourceVersion is too old, so we must list again
+                    self.log.debug(f'Watch for {self.resource} in {self.namespace} expired, relisting')
+                    continue
+                if e.status == 403:
+                    # Not allowed to watch. Callers fall back to polling, and
+                    # we check back much less often in case RBAC changes.
+                    self.log.warning(f'Not allowed to watch {self.resource} in {self.namespace}, falling back to the API')
+                    self._set_unsynced(forbidden=True)
+                    await asyncio.sleep(300)
+                    continue
+                self.log.warning(f'Watching {self.resource} in {self.namespace} failed: {e.status} {e.reason}')
+            except Exception:
+                self.log.exception(f'Watching {self.resource} in {self.namespace} failed')
+            self._set_unsynced()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+
+class PVCInformer(PodInformer):
+    """
+    In-memory index of kubessh user PersistentVolumeClaims in a namespace.
+
+    Works like PodInformer, with PVCs in place of pods. Obtain it with
+    `PVCInformer.for_namespace`.
+    """
+    resource = 'persistentvolumeclaims'
+
+    _instances = {}
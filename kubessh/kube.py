@@ -0,0 +1,219 @@
+"""
+Shared asyncio client for the Kubernetes API.
+
+All talk with the API server from kubessh goes through the one KubeClient
+instance in the process. It keeps a pool of keep-alive HTTP connections,
+bounds how many requests are in flight at once, and never needs a thread.
+
+Requests and responses are plain JSON-style dicts. Configuration (API server
+address, credentials, certificates) is whatever the kubernetes python client
+has been loaded with - call load_config() once at startup, before the first
+request. Nothing is loaded or connected on import.
+"""
+import asyncio
+import json
+import ssl
+import time
+
+import aiohttp
+import kubernetes
+from kubernetes import client as k
+from traitlets.config import SingletonConfigurable
+from traitlets import Integer, Float
+
+from kubessh.metrics import KUBE_REQUEST_DURATION
+from kubessh.serialization import api_body
+
+
+def _make_ssl_context(configuration):
+    if not configuration.verify_ssl:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    else:
+        context = ssl.create_default_context(cafile=configuration.ssl_ca_cert)
+    if configuration.cert_file:
+        context.load_cert_chain(configuration.cert_file, configuration.key_file)
+    return context
+
+
+def load_config():
+    """
+    Load API server address & credentials into the kubernetes python client.
+
+    Uses the pod's service account when running inside Kubernetes, and
+    ~/.kube/config (or $KUBECONFIG) otherwise.
+    """
+    try:
+        kubernetes.config.load_incluster_config()
+    except kubernetes.config.ConfigException:
+        kubernetes.config.load_kube_config()
+
+
+def _api_exception(status, reason, body=None):
+    e = kubernetes.client.rest.ApiException(status=status, reason=reason)
+    e.body = body
+    return e
+
+
+class KubeClient(SingletonConfigurable):
+    """
+    Process-wide async client for the Kubernetes API.
+
+    Get it with `KubeClient.instance()`.
+    """
+    max_connections = Integer(
+        100,
+        help="""
+        Maximum number of HTTP connections to keep open to the API server.
+
+        Idle connections are kept alive and reused for later requests.
+        """,
+        config=True
+    )
+
+    max_concurrent_requests = Integer(
+        50,
+        help="""
+        Maximum number of API requests in flight at the same time.
+
+        Further requests wait their turn. Watches and streaming connections
+        (exec, port-forward) are long lived, and don't count towards this.
+        """,
+        config=True
+    )
+
+    request_timeout = Float(
+        30,
+        help="""
+        Seconds after which a single API request is considered failed.
+        """,
+        config=True
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._session = None
+        self._loop = None
+
+    def _ensure_session(self):
+        loop = asyncio.get_event_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            self.configuration = k.Configuration.get_default_copy()
+            self.host = self.configuration.host.rstrip('/')
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                ssl=_make_ssl_context(self.configuration) if self.host.startswith('https') else False,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+            self._loop = loop
+        return self._session
+
+    def _headers(self):
+        # Evaluated per request, so refreshed tokens (like projected service
+        # account tokens) are picked up
+        return {
+            setting['key']: setting['value']
+            for setting in self.configuration.auth_settings().values()
+            if setting['in'] == 'header' and setting['value']
+        }
+
+    async def request(self, method, path, params=None, body=None, content_type='application/json'):
+        """
+        Make a request to the API server & return the decoded JSON response.
+
+        body can be a dict or a kubernetes client model object. Raises
+        kubernetes.client.rest.ApiException on non-2xx responses.
+        """
+        session = self._ensure_session()
+        headers = self._headers()
+        data = None
+        if body is not None:
+            data = json.dumps(api_body(body))
+            headers['Content-Type'] = content_type
+
+        async with self._semaphore:
+            start_time = time.perf_counter()
+            try:
+                async with session.request(
+                    method, self.host + path,
+                    params=params, data=data, headers=headers,
+                    timeout=aiohttp.ClientTimeout(total=self.request_timeout)
+                ) as response:
+                    text = await response.text()
+            finally:
+                KUBE_REQUEST_DURATION.labels(verb=method).observe(time.perf_counter() - start_time)
+            if response.status >= 400:
+                raise _api_exception(response.status, response.reason, text)
+            return json.loads(text) if text else None
+
+    async def get(self, path, params=None):
+        return await self.request('GET', path, params=params)
+
+    async def create(self, path, body):
+        return await self.request('POST', path, body=body)
+
+    async def replace(self, path, body):
+        return await self.request('PUT', path, body=body)
+
+    async def patch(self, path, body, content_type='application/merge-patch+json'):
+        return await self.request('PATCH', path, body=body, content_type=content_type)
+
+    async def delete(self, path, body=None, params=None):
+        return await self.request('DELETE', path, params=params, body=body)
+
+    async def watch(self, path, params=None, timeout_seconds=300):
+        """
+        Watch the collection at path, yielding watch event dicts.
+
+        Returns when the API server ends the watch after timeout_seconds.
+        ERROR events are raised as ApiException, so a 410 Gone can be handled
+        by relisting.
+        """
+        session = self._ensure_session()
+        params = dict(params or {}, watch='true', timeoutSeconds=str(timeout_seconds))
+        async with session.get(
+            self.host + path, params=params, headers=self._headers(),
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=timeout_seconds + 30)
+        ) as response:
+            if response.status >= 400:
+                raise _api_exception(response.status, response.reason, await response.text())
+            buffer = b''
+            async for chunk in response.content.iter_any():
+                buffer += chunk
+                *lines, buffer = buffer.split(b'\n')
+                for line in lines:
+                    if not line.strip():
+                        continue
+                    event = json.loads(line)
+                    if event['type'] == 'ERROR':
+                        status = event['object']
+                        raise _api_exception(status.get('code'), status.get('reason'), status.get('message'))
+                    yield event
+
+    async def ws_connect(self, path, params, protocols):
+        """
+        Open a websocket to path on the API server, for streaming subresources.
+
+        Raises ApiException if the API server refuses.
+        """
+        session = self._ensure_session()
+        start_time = time.perf_counter()
+        try:
+            return await session.ws_connect(
+                self.host + path,
+                params=params,
+                protocols=protocols,
+                headers=self._headers(),
+                max_msg_size=0,
+            )
+        except aiohttp.WSServerHandshakeError as e:
+            raise _api_exception(e.status, e.message)
+        finally:
+            KUBE_REQUEST_DURATION.labels(verb='CONNECT').observe(time.perf_counter() - start_time)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
@@ -0,0 +1,152 @@
+"""
+Kubernetes Leases, so kubessh replicas can agree on who does what.
+
+Many kubessh replicas can run behind the same Service. Most of what they do
+is safe to do at the same time: creating a pod that already exists fails
+with a 409, and claiming warm pool pods is guarded by a JSON patch test.
+Leases are for work that is wasteful to do twice, like starting a user's
+pod or topping up the warm pool.
+
+A Lease is held by one process at a time, named by replica_identity().
+Holders must renew it before leaseDurationSeconds are up, or someone else
+may take it over.
+"""
+import datetime
+import os
+import socket
+import time
+
+import kubernetes
+
+from kubessh.kube import KubeClient
+
+
+def replica_identity():
+    """
+    Return the name this process holds leases under.
+
+    The hostname is the pod name when running in Kubernetes, and the pid
+    tells apart processes in the same pod.
+    """
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _format_time(value):
+    # Leases use MicroTime, which always has microseconds
+    return value.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def _parse_time(value):
+    # Python < 3.11 can't parse the 'Z' suffix
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+class Lease:
+    """
+    A coordination.k8s.io Lease this process can try to hold.
+    """
+    def __init__(self, namespace, name, duration, identity=None):
+        self.namespace = namespace
+        self.name = name
+        # Seconds the lease is valid for after each renewal
+        self.duration = duration
+        self.identity = identity or replica_identity()
+        # Lease object as of our last write, if we hold it
+        self.lease = None
+        self._renewed = None
+
+    @property
+    def path(self):
+        return f'/apis/coordination.k8s.io/v1/namespaces/{self.namespace}/leases'
+
+    def _expired(self, spec):
+        renewed = spec.get('renewTime') or spec.get('acquireTime')
+        if not spec.get('holderIdentity') or not renewed:
+            return True
+        duration = spec.get('leaseDurationSeconds') or self.duration
+        return _now() > _parse_time(renewed) + datetime.timedelta(seconds=duration)
+
+    async def acquire(self):
+        """
+        Try to take or renew the lease. Returns True if we hold it now.
+
+        Returns False if someone else holds the lease and it hasn't expired,
+        or if someone else changed it while we were trying. Leases renewed
+        recently are assumed to still be ours, without asking the API server.
+        """
+        if self.lease is not None and time.monotonic() - self._renewed < self.duration / 3:
+            return True
+
+        kube = KubeClient.instance()
+        now = _format_time(_now())
+        try:
+            lease = await kube.get(f'{self.path}/{self.name}')
+        except kubernetes.client.rest.ApiException as e:
+            if e.status != 404:
+                raise
+            lease = None
+
+        try:
+            if lease is None:
+                self.lease = await kube.create(self.path, {
+                    'apiVersion': 'coordination.k8s.io/v1',
+                    'kind': 'Lease',
+                    'metadata': {'name': self.name},
+                    'spec': {
+                        'holderIdentity': self.identity,
+                        'leaseDurationSeconds': int(self.duration),
+                        'acquireTime': now,
+                        'renewTime': now,
+                        'leaseTransitions': 0,
+                    },
+                })
+            else:
+                spec = lease.get('spec') or {}
+                if spec.get('holderIdentity') == self.identity:
+                    spec = dict(spec, renewTime=now)
+                elif self._expired(spec):
+                    spec = dict(
+                        spec,
+                        holderIdentity=self.identity,
+                        leaseDurationSeconds=int(self.duration),
+                        acquireTime=now,
+                        renewTime=now,
+                        leaseTransitions=spec.get('leaseTransitions', 0) + 1,
+                    )
+                else:
+                    self.lease = None
+                    return False
+                # The resourceVersion we read makes this fail if anyone else wrote since
+                self.lease = await kube.replace(f'{self.path}/{self.name}', {**lease, 'spec': spec})
+        except kubernetes.client.rest.ApiException as e:
+            if e.status != 409:
+                raise
+            # Someone else got there first
+            self.lease = None
+            return False
+        self._renewed = time.monotonic()
+        return True
+
+    async def release(self):
+        """
+        Give up the lease, if we hold it.
+
+        The lease is deleted rather than emptied, so leases for every user
+        that ever logged in don't pile up.
+        """
+        if self.lease is None:
+            return
+        lease, self.lease = self.lease, None
+        try:
+            await KubeClient.instance().delete(
+                f'{self.path}/{self.name}',
+                body={'preconditions': {'resourceVersion': lease['metadata']['resourceVersion']}}
+            )
+        except kubernetes.client.rest.ApiException as e:
+            # Already gone, or taken over by someone else
+            if e.status not in (404, 409):
+                raise
@@ -0,0 +1,216 @@
+"""
+Find out what is stalling the event loop.
+
+Every ssh session in a kubessh process shares one event loop, so anything
+blocking it - a synchronous call, a huge template expansion - freezes all
+of them. LoopMonitor helps find such things in production:
+
+- Loop lag (how late a sleep wakes up) is sampled all the time, and
+  recorded in the kubessh_event_loop_lag_seconds histogram.
+- With stall_threshold set, a watchdog thread logs the stack of whatever
+  the loop is running when it has been blocked for longer than that.
+- SIGUSR1 logs the stacks of all asyncio tasks & threads.
+- SIGUSR2 samples the loop thread's stack for profile_duration seconds, and
+  writes the counts in collapsed stack format (as used by flamegraph.pl
+  and speedscope) to profile_dir.
+"""
+import asyncio
+import collections
+import io
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from traitlets.config import SingletonConfigurable
+from traitlets import Float, Unicode
+
+from kubessh.metrics import LOOP_LAG
+
+
+def collapse_stack(frame):
+    """
+    Return frame's stack as a single line, outermost frame first
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class LoopMonitor(SingletonConfigurable):
+    """
+    Watches the event loop of this process for stalls.
+
+    Get it with `LoopMonitor.instance()`.
+    """
+    lag_interval = Float(
+        0.25,
+        help="""
+        Seconds between measurements of event loop lag.
+        """,
+        config=True
+    )
+
+    stall_threshold = Float(
+        0,
+        help="""
+        Seconds the event loop can be blocked before the stack of what is
+        blocking it is logged.
+
+        Set to 0 (the default) to not watch for stalls. Uses one thread.
+        """,
+        config=True
+    )
+
+    profile_duration = Float(
+        30,
+        help="""
+        Seconds to sample the event loop's stack for after SIGUSR2.
+        """,
+        config=True
+    )
+
+    profile_interval = Float(
+        0.005,
+        help="""
+        Seconds between stack samples while profiling.
+        """,
+        config=True
+    )
+
+    profile_dir = Unicode(
+        tempfile.gettempdir(),
+        help="""
+        Directory profiles are written to.
+        """,
+        config=True
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_lag = 0
+        self._last_tick = time.monotonic()
+        self._loop_thread_id = None
+        self._profiling = False
+        self._stopped = threading.Event()
+        self._task = None
+
+    def start(self):
+        """
+        Start watching the running event loop
+        """
+        if self._task is not None:
+            return
+        loop = asyncio.get_event_loop()
+        self._stopped.clear()
+        self._loop_thread_id = threading.get_ident()
+        self._task = asyncio.ensure_future(self._sample_lag())
+        loop.add_signal_handler(signal.SIGUSR1, self.dump_tasks)
+        loop.add_signal_handler(signal.SIGUSR2, self.start_profile)
+        if self.stall_threshold > 0:
+            threading.Thread(target=self._watch, name='kubessh-loop-watchdog', daemon=True).start()
+
+    def stop(self):
+        """
+        Stop watching the event loop
+        """
+        if self._task is None:
+            return
+        self._task.cancel()
+        self._task = None
+        self._stopped.set()
+        loop = asyncio.get_event_loop()
+        loop.remove_signal_handler(signal.SIGUSR1)
+        loop.remove_signal_handler(signal.SIGUSR2)
+
+    async def _sample_lag(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            lag = max(loop.time() - start - self.lag_interval, 0)
+            self._last_tick = time.monotonic()
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG.observe(lag)
+
+    def _watch(self):
+        """
+        Log what the loop is running whenever it stalls. Runs in its own thread.
+        """
+        stalled = False
+        while not self._stopped.wait(self.stall_threshold / 4):
+            blocked = time.monotonic() - self._last_tick - self.lag_interval
+            if blocked <= self.stall_threshold:
+                stalled = False
+                continue
+            if stalled:
+                # Only log each stall once
+                continue
+            stalled = True
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+            self.log.warning(f'Event loop blocked for {blocked:.2f}s so far, in:\n{stack}')
+
+    def dump_tasks(self):
+        """
+        Log the stacks of all asyncio tasks and threads
+        """
+        out = io.StringIO()
+        tasks = asyncio.all_tasks()
+        out.write(f'{len(tasks)} tasks, max loop lag {self.max_lag:.3f}s\n')
+        for task in tasks:
+            out.write(f'\n{task!r}\n')
+            task.print_stack(file=out)
+        for thread in threading.enumerate():
+            frame = sys._current_frames().get(thread.ident)
+            if frame is not None and thread.ident != self._loop_thread_id:
+                out.write(f'\nThread {thread.name}:\n')
+                traceback.print_stack(frame, file=out)
+        self.log.warning(out.getvalue())
+
+    def start_profile(self):
+        """
+        Start sampling the event loop's stack in a background thread
+        """
+        if self._profiling:
+            self.log.info('Already profiling')
+            return
+        self._profiling = True
+        path = os.path.join(self.profile_dir, f'kubessh-profile-{os.getpid()}-{int(time.time())}.txt')
+        self.log.info(f'Profiling event loop for {self.profile_duration:.0f}s, into {path}')
+        threading.Thread(target=self._profile, args=(path,), name='kubessh-profiler', daemon=True).start()
+
+    def profile(self, duration):
+        """
+        Sample the event loop's stack for duration seconds.
+
+        Returns a Counter of collapsed stacks. Must not be called from the
+        event loop's thread.
+        """
+        samples = collections.Counter()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+                samples[collapse_stack(frame)] += 1
+            del frame
+            time.sleep(self.profile_interval)
+        return samples
+
+    def _profile(self, path):
+        try:
+            samples = self.profile(self.profile_duration)
+            with open(path, 'w') as f:
+                for stack, count in samples.most_common():
+                    f.write(f'{stack} {count}\n')
+            self.log.info(f'Wrote {sum(samples.values())} samples to {path}')
+        except Exception:
+            self.log.exception('Profiling event loop failed')
+        finally:
+            self._profiling = False
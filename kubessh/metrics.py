@@ -0,0 +1,159 @@
+"""
+Prometheus metrics for kubessh.
+
+Timings are recorded as they happen, with histograms. Everything else
+(sessions, warm pool, bytes relayed) is kept track of anyway by
+the objects responsible for it, and is only read when metrics are scraped -
+so nothing is added to the path every relayed byte takes.
+
+prometheus_client is optional. Without it, metrics are not recorded and the
+metrics server can't be started.
+"""
+import threading
+
+try:
+    import prometheus_client
+    from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+except ImportError:
+    prometheus_client = False
+
+
+class _NoMetric:
+    """
+    Stands in for metrics when prometheus_client isn't installed
+    """
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+
+def _histogram(*args, **kwargs):
+    if prometheus_client:
+        return prometheus_client.Histogram(*args, **kwargs)
+    return _NoMetric()
+
+
+AUTH_DURATION = _histogram(
+    'kubessh_auth_duration_seconds',
+    'Time taken to get the keys a user can authenticate with',
+    ['authenticator'],
+)
+
+SPAWN_DURATION = _histogram(
+    'kubessh_spawn_duration_seconds',
+    'Time taken to get a running pod for a user',
+    # cold: a pod had to be started, warm: user's pod was already running,
+    # pool: a pod was claimed from the warm pool
+    ['start'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300),
+)
+
+SPAWN_PHASE_DURATION = _histogram(
+    'kubessh_spawn_phase_duration_seconds',
+    'Time spent in each phase of starting a user pod from scratch',
+    # create, scheduling, volumes, image_pull, container_start - see kubessh.timeline
+    ['phase'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300),
+)
+
+FIRST_BYTE_DURATION = _histogram(
+    'kubessh_session_first_byte_seconds',
+    'Time from a shell session starting in a running pod to its first output',
+)
+
+KUBE_REQUEST_DURATION = _histogram(
+    'kubessh_kube_request_duration_seconds',
+    'Time taken by requests to the Kubernetes API',
+    ['verb'],
+)
+
+LOOP_LAG = _histogram(
+    'kubessh_event_loop_lag_seconds',
+    'How late the event loop runs callbacks that are due',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+
+
+class KubeSSHCollector:
+    """
+    Collects metrics from kubessh's shared objects when scraped
+    """
+    def collect(self):
+        # Imported here to avoid import cycles, since everything imports this module
+        from kubessh.sessions import SessionRegistry
+        from kubessh.warmpool import WarmPool
+        from kubessh.prepuller import ImagePuller
+
+        threads = GaugeMetricFamily('kubessh_threads', 'Number of threads in the kubessh process')
+        threads.add_metric([], threading.active_count())
+        yield threads
+
+        if SessionRegistry.initialized():
+            registry = SessionRegistry.instance()
+            sessions = GaugeMetricFamily('kubessh_sessions', 'Open sessions into user pods', labels=['kind'])
+            counts = {'shell': 0, 'sftp': 0, 'forward': 0}
+            for activity in registry.pods.values():
+                for kind, count in activity.sessions_by_kind.items():
+                    counts[kind] = counts.get(kind, 0) + count
+            for kind, count in counts.items():
+                sessions.add_metric([kind], count)
+            yield sessions
+
+            pods = GaugeMetricFamily('kubessh_active_pods', 'User pods with open sessions')
+            pods.add_metric([], sum(1 for activity in registry.pods.values() if activity.sessions))
+            yield pods
+
+            relayed = CounterMetricFamily(
+                'kubessh_relayed_bytes', 'Bytes relayed between ssh clients and user pods', labels=['kind']
+            )
+            for kind, nbytes in registry.bytes_relayed.items():
+                relayed.add_metric([kind], nbytes)
+            yield relayed
+
+        if WarmPool.initialized():
+            stats = WarmPool.instance().stats()
+            pool = GaugeMetricFamily('kubessh_warm_pool_pods', 'Unclaimed warm pool pods', labels=['state'])
+            pool.add_metric(['ready'], stats['ready'])
+            pool.add_metric(['starting'], stats['starting'])
+            yield pool
+            claims = CounterMetricFamily(
+                'kubessh_warm_pool_claims', 'Logins that tried to claim a warm pool pod', labels=['result']
+            )
+            claims.add_metric(['claimed'], stats['claims'])
+            claims.add_metric(['missed'], stats['misses'])
+            yield claims
+
+        if ImagePuller.initialized() and ImagePuller.instance().enabled:
+            nodes = GaugeMetricFamily(
+                'kubessh_image_puller_nodes', 'Nodes by state of pulling user pod images', labels=['state']
+            )
+            for state, count in ImagePuller.instance().stats().items():
+                nodes.add_metric([state], count)
+            yield nodes
+
+
+async def _metrics(request):
+    from aiohttp import web
+    return web.Response(
+        body=prometheus_client.generate_latest(prometheus_client.REGISTRY),
+        headers={'Content-Type': prometheus_client.CONTENT_TYPE_LATEST},
+    )
+
+
+async def start_metrics_server(host, port):
+    """
+    Serve metrics at /metrics on host & port
+    """
+    if not prometheus_client:
+        raise ImportError('prometheus_client must be installed to serve metrics')
+    # Only imported when serving metrics, it isn't needed otherwise
+    from aiohttp import web
+    prometheus_client.REGISTRY.register(KubeSSHCollector())
+    app = web.Application()
+    app.router.add_get('/metrics', _metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -1,37 +1,116 @@
 import asyncio
 import asyncssh
 import subprocess
-from ptyprocess import PtyProcess
 import time
 import argparse
 import os
 import sys
-from kubernetes import client as k
-import kubernetes.config
+import kubernetes
 import escapism
-import functools
+import json
 from enum import Enum
 import shlex
 import string
-from concurrent.futures import ThreadPoolExecutor
 from traitlets.config import LoggingConfigurable
-from traitlets import Dict, Unicode, List, default
+from traitlets.config.loader import LazyConfigValue
+from traitlets import Dict, Unicode, List, Float, Bool, CaselessStrEnum, default, observe
 
-from .serialization import make_api_object_from_dict
+from .template import CompiledTemplate, LRUCache
+from .kube import KubeClient
+from .lease import Lease
+from .informer import PodInformer, PVCInformer, USERNAME_LABEL
+from .terminal import Terminal
+from .timeline import SpawnTimeline
+from .stream import ExecStream, STDOUT_CHANNEL, STDERR_CHANNEL
+from .metrics import SPAWN_DURATION, SPAWN_PHASE_DURATION, FIRST_BYTE_DURATION
 
-try:
-    kubernetes.config.load_incluster_config()
-except kubernetes.config.ConfigException:
-    kubernetes.config.load_kube_config()
+# Largest chunk of data read from an ssh channel at a time
+STREAM_READ_SIZE = 64 * 1024
 
-# FIXME: Figure out if making this global is a problem
-v1 = k.CoreV1Api()
+# Seconds without output after stdin EOF before an exec stream that can't
+# pass on EOF (v4.channel.k8s.io) is closed
+STDIN_EOF_IDLE_TIMEOUT = 2
+
+# Number of expanded pod & PVC specs to keep around
+SPEC_CACHE_SIZE = 1024
 
 class PodState(Enum):
     UNKNOWN = 0
     STARTING = 1
     RUNNING = 2
 
+def pod_is_running(pod):
+    """
+    Return True if pod is ready to have shells exec'd into it.
+
+    This is as soon as the kubelet reports the pod as Running, or marks
+    it as Ready - whichever we hear about first.
+    """
+    status = pod.get('status', {})
+    if status.get('phase') == 'Running':
+        return True
+    for condition in status.get('conditions', []):
+        if condition['type'] == 'Ready' and condition['status'] == 'True':
+            return True
+    return False
+
+class Spawn:
+    """
+    One run of UserPod._spawn, shared by everyone waiting on the same pod.
+
+    The spawn runs in its own task, so it carries on even if the ssh
+    connection that started it goes away while others are still waiting.
+    """
+    def __init__(self, user_pod):
+        # The UserPod doing the spawning, which ends up with the pod
+        self.user_pod = user_pod
+        self.state = PodState.UNKNOWN
+        # One queue of states per follower. None marks the end.
+        self._followers = set()
+        self.task = asyncio.ensure_future(self._run())
+        self.task.add_done_callback(self._done)
+
+    async def _run(self):
+        try:
+            async for state in self.user_pod._spawn():
+                self.state = state
+                for queue in self._followers:
+                    queue.put_nowait(state)
+        finally:
+            for queue in self._followers:
+                queue.put_nowait(None)
+
+    def _done(self, task):
+        # Errors are raised to followers, but someone should hear about them if there are none
+        if not task.cancelled() and task.exception() is not None and not self._followers:
+            self.user_pod.log.error(
+                f'Starting pod for {self.user_pod.username} failed', exc_info=task.exception()
+            )
+
+    async def follow(self):
+        """
+        Yield the states the spawn goes through, starting with the current one.
+
+        Raises whatever the spawn raised, if it failed.
+        """
+        queue = asyncio.Queue()
+        if self.state != PodState.UNKNOWN:
+            queue.put_nowait(self.state)
+        if self.task.done():
+            queue.put_nowait(None)
+        self._followers.add(queue)
+        try:
+            while True:
+                state = await queue.get()
+                if state is None:
+                    break
+                yield state
+        finally:
+            self._followers.discard(queue)
+        # Raise any errors. Shielded, since the spawn might have other followers.
+        await asyncio.shield(self.task)
+
+
 class UserPod(LoggingConfigurable):
     """
     A kubernetes pod of specific configuration for one user.
@@ -123,148 +202,633 @@ class UserPod(LoggingConfigurable):
         """,
     )
 
+    exec_backend = CaselessStrEnum(
+        ['websocket', 'kubectl'],
+        'websocket',
+        help="""
+        How to run commands inside user pods.
 
-    def _expand_user_properties(self, template):
+        'websocket' (the default) talks to the Kubernetes exec API directly
+        from kubessh. 'kubectl' spawns a `kubectl exec` process per session,
+        and requires kubectl to be installed.
+        """,
+        config=True
+    )
+
+    sftp_server_command = List(
+        [
+            'sh', '-c',
+            'for p in /usr/lib/openssh/sftp-server /usr/libexec/openssh/sftp-server '
+            '/usr/lib/ssh/sftp-server /usr/libexec/sftp-server /usr/lib/sftp-server; do '
+            '[ -x "$p" ] && exec "$p"; done; '
+            'echo "No sftp-server found in this pod" >&2; exit 127'
+        ],
+        help="""
+        Command run in the shell container to serve sftp sessions.
+
+        The sftp session's data is relayed to and from this command
+        unchanged, so it must speak the SFTP protocol on stdin & stdout -
+        like OpenSSH's sftp-server. The default looks for sftp-server where
+        common distributions put it.
+        """,
+        config=True
+    )
+
+    poll_max_interval = Float(
+        5,
+        help="""
+        Maximum seconds between checks of a starting pod's status, when
+        watching pods is not possible.
+
+        Polling starts at a fraction of a second and backs off up to this.
+        """,
+        config=True
+    )
+
+    spawn_lease = Bool(
+        False,
+        help="""
+        Use a Kubernetes Lease per user to pick which replica starts their pod.
+
+        When several kubessh replicas get logins for the same user at once,
+        only the one holding the lease creates the pod, and the others wait
+        for it to show up. Without it, every replica tries to create the
+        pod, and all but one get a conflict and use the winner's pod
+        instead. Requires permission to manage leases in the namespace.
+        """,
+        config=True
+    )
+
+    spawn_lease_duration = Float(
+        30,
+        help="""
+        Seconds other replicas wait for a replica holding a spawn lease to
+        create the pod, before taking the lease over.
+
+        The lease is given up as soon as the pod is created, so this only
+        matters when a replica goes away while starting a pod.
+        """,
+        config=True
+    )
+
+    # Spawns in progress in this process, keyed by (namespace, username label)
+    _spawns = {}
+
+    # Finished pod & PVC request bodies, keyed by template & user
+    _specs = LRUCache(SPEC_CACHE_SIZE)
+
+    # (trait name, id of config or default value) -> (that value, compiled).
+    # Config is deep copied into every UserPod, so templates are compiled
+    # here once per config rather than once per UserPod.
+    _compiled_config = {}
+
+    # Namespaces we've warned about not being able to use leases in
+    _lease_unavailable = set()
+
+    def _user_properties(self):
         # Make sure username and servername match the restrictions for DNS labels
         # Note: '-' is not in safe_chars, as it is being used as escape character
         safe_chars = set(string.ascii_lowercase + string.digits)
 
         safe_username = escapism.escape(self.username, safe=safe_chars, escape_char='-').lower()
 
-        return template.format(
-            username=safe_username,
-        )
+        return {
+            'username': safe_username,
+        }
+
+    def _expand_user_properties(self, template):
+        return template.format(**self._user_properties())
 
     def _expand_all(self, src):
-        if isinstance(src, list):
-            return [self._expand_all(i) for i in src]
-        elif isinstance(src, dict):
-            return {k: self._expand_all(v) for k, v in src.items()}
-        elif isinstance(src, str):
+        """
+        Return src with user properties expanded in all strings in it.
+
+        The result shares unexpanded parts with src, so must not be modified.
+        """
+        if isinstance(src, str):
             return self._expand_user_properties(src)
+        return src.expand(**self._user_properties())
+
+    @classmethod
+    def configured(cls, config, name):
+        """
+        Return the value trait name would have in a UserPod made with config.
+
+        For things that only need the templates, without making a UserPod.
+        """
+        value = config.UserPod.get(name)
+        default = cls.class_traits()[name].default()
+        if value is None:
+            return default
+        if isinstance(value, LazyConfigValue):
+            return value.get_value(default)
+        return value
+
+    def _compile(self, name, value):
+        if name == 'pvc_templates':
+            return [CompiledTemplate(template) for template in value]
+        return CompiledTemplate(value)
+
+    def compiled_templates(self, name):
+        """
+        Return compiled pod_template, or list of compiled pvc_templates.
+
+        Values from config or trait defaults are compiled once per process.
+        Anything else is compiled once per UserPod.
+        """
+        compiled = self._compiled.get(name)
+        if compiled is not None:
+            return compiled
+        value = getattr(self, name)
+        for source in (self.config.UserPod.get(name), self.traits()[name].default_value):
+            # Equal unless the value was changed after config was loaded
+            if source is not None and source == value:
+                key = (name, id(source))
+                if key not in self._compiled_config:
+                    self._compiled_config[key] = (source, self._compile(name, source))
+                compiled = self._compiled_config[key][1]
+                break
         else:
-            return src
+            compiled = self._compile(name, value)
+        self._compiled[name] = compiled
+        return compiled
+
+    @observe('pod_template', 'pvc_templates')
+    def _templates_changed(self, change):
+        # Compiled again when next needed
+        self._compiled.pop(change.name, None)
 
     def __init__(self, username, namespace, *args, **kwargs):
         self.username = username
         self.namespace = namespace
+        # Trait name -> compiled templates, see compiled_templates
+        self._compiled = {}
         super().__init__(*args, **kwargs)
 
         self.required_labels = {
-            'kubessh.yuvi.in/username': escapism.escape(self.username, escape_char='-'),
+            USERNAME_LABEL: escapism.escape(self.username, escape_char='-'),
         }
 
-        # Threads required to perform all activities in this shell
-        # These should probably be a well sized global threadpool, since this is being
-        # used as a sort of queue. We will currently use a threadpool of 1 thread per shell
-        # for simplicity. The number of threads here needs to be the maximum number of threads
-        # this object could possibly use at the same time. Eventually, this needs to be a
-        # global threadpool with well enforced limits #FIXME
-        self.kube_api_threadpool = ThreadPoolExecutor(1)
-
-    def _run_in_executor(self, func, *args, **kwargs):
-        return asyncio.get_event_loop().run_in_executor(self.kube_api_threadpool, functools.partial(func, *args, **kwargs))
+        self.kube = KubeClient.instance()
+        # SpawnTimeline of the pod being started from scratch, if it is
+        self.timeline = None
 
     def _make_labelselector(self, labels):
         return ','.join([f'{k}={v}' for k, v in labels.items()])
 
+    def _with_labels(self, obj, name=None):
+        metadata = dict(obj.get('metadata') or {})
+        metadata['labels'] = {**(metadata.get('labels') or {}), **self.required_labels}
+        if name is not None:
+            metadata['name'] = name
+        return {**obj, 'metadata': metadata}
+
     def make_pod_spec(self):
-        pod = make_api_object_from_dict(self._expand_all(self.pod_template), k.V1Pod)
-        pod.metadata.name = self.pod_name
+        """
+        Return request body for creating this user's pod.
 
-        if pod.metadata.labels is None:
-            pod.metadata.labels = {}
-        pod.metadata.labels.update(self.required_labels)
+        Cached per user & template. Shared with other callers, so must not
+        be modified.
+        """
+        compiled = self.compiled_templates('pod_template')
+        return self._specs.get(
+            (compiled, self.username, self.pod_name),
+            lambda: self._with_labels(self._expand_all(compiled), self.pod_name)
+        )
 
-        return pod
+    def make_pvc_spec(self, compiled):
+        """
+        Return request body for creating a PVC for this user, from one of
+        compiled_templates('pvc_templates').
+
+        Cached per user & template. Shared with other callers, so must not
+        be modified.
+        """
+        return self._specs.get(
+            (compiled, self.username),
+            lambda: self._with_labels(self._expand_all(compiled))
+        )
+
+    async def _read_pod(self, name, use_cache=True):
+        """
+        Return pod with given name, from the informer cache if possible.
 
-    def make_pvc_spec(self, template):
-        pvc = make_api_object_from_dict(self._expand_all(template), k.V1PersistentVolumeClaim)
+        Only contacts the API server on a cache miss. Returns None if the pod
+        doesn't exist.
+        """
+        if use_cache:
+            pod = self.informer.get(name)
+            if pod is not None:
+                return pod
+        try:
+            pod = await self.kube.get(f'/api/v1/namespaces/{self.namespace}/pods/{name}')
+        except kubernetes.client.rest.ApiException as e:
+            if e.status == 404:
+                return None
+            raise
+        self.informer.record(pod)
+        return pod
 
-        if pvc.metadata.labels is None:
-            pvc.metadata.labels = {}
-        pvc.metadata.labels.update(self.required_labels)
+    async def _find_pod(self):
+        """
+        Return this user's pod, if there is one.
 
-        return pvc
+        The pod is found by its username label rather than by name, since it
+        may have been claimed from the warm pool. Only contacts the API server
+        on a cache miss.
+        """
+        username_label = self.required_labels[USERNAME_LABEL]
+        pod = self.informer.get_by_user(username_label) or self.informer.get(self.pod_name)
+        if pod is None:
+            pods = await self.kube.get(
+                f'/api/v1/namespaces/{self.namespace}/pods',
+                {'labelSelector': f'{USERNAME_LABEL}={username_label}'}
+            )
+            for candidate in pods['items']:
+                self.informer.record(candidate)
+                # Prefer pods we can use right away
+                if pod is None or pod_is_running(candidate):
+                    pod = candidate
+        if pod is not None:
+            self.pod_name = pod['metadata']['name']
+        return pod
 
     async def ensure_running(self):
         """
-        Ensure this user pod is running.
+        Ensure this user pod is running, yielding PodState as it starts.
+
+        Concurrent calls for the same user (several terminals and port
+        forwards opened at once) all follow the same spawn, so the pod is
+        only looked up & created once. Once PodState.RUNNING has been
+        yielded, self.pod and self.pod_name describe the running pod.
+        While a pod is started from scratch, self.timeline says how far
+        along it is.
+        """
+        key = (self.namespace, self.required_labels[USERNAME_LABEL])
+        spawn = self._spawns.get(key)
+        if spawn is None:
+            spawn = self._spawns[key] = Spawn(self)
+
+            def forget(task):
+                if self._spawns.get(key) is spawn:
+                    del self._spawns[key]
+            spawn.task.add_done_callback(forget)
+
+        async for status in spawn.follow():
+            self.timeline = spawn.user_pod.timeline
+            if status == PodState.RUNNING:
+                self.pod = spawn.user_pod.pod
+                self.pod_name = spawn.user_pod.pod_name
+            yield status
+
+    async def _spawn(self):
+        """
+        Make sure this user has a running pod.
 
         1. If pod already exists, and is in running state, just return
         2. If pod already exists, and has completed, delete it.
-        3. If pod doesn't exist, create new pod & wait for it to be running
+        3. If there is a running pod in the warm pool, claim it
+        4. If pod doesn't exist, create new pod & wait for it to be running.
+           With spawn_lease, only the replica holding the user's lease
+           creates it, and others wait for it to show up.
         """
-        try:
-            pod = await self._run_in_executor(
-                v1.read_namespaced_pod,
-                self.pod_name, self.namespace
-            )
-        except kubernetes.client.rest.ApiException as e:
-            if e.status == 404:
-                pod = None
-            else:
-                raise
+        # Imported here, since the warm pool uses UserPod to make its pods
+        from kubessh.warmpool import WarmPool
+
+        start_time = time.perf_counter()
+        self.informer = PodInformer.for_namespace(self.namespace, parent=self)
+        pod = await self._find_pod()
 
-        if pod and pod.status.phase == 'Running':
+        if pod and pod_is_running(pod):
             # Pod exists, and is running. Nothing to do
             self.pod = pod
+            SPAWN_DURATION.labels(start='warm').observe(time.perf_counter() - start_time)
             yield PodState.RUNNING
             return
 
         # FIXME: Deal with pods in Terminating state
-        if pod and pod.status.phase in ['Failed', 'Succeeded']:
+        if pod and pod['status'].get('phase') in ['Failed', 'Succeeded']:
             # Pod exists, but is in an unusable state.
             # Delete it, and say there is no pod
-            await self._run_in_executor(
-                v1.delete_namespaced_pod,
-                pod.metadata.name,
-                pod.metadata.namespace, body=k.V1DeleteOptions(grace_period_seconds=0)
+            await self.kube.delete(
+                f'/api/v1/namespaces/{self.namespace}/pods/{self.pod_name}',
+                body={'gracePeriodSeconds': 0}
             )
+            self.informer.forget(self.pod_name)
+            # Go back to our own name for the pod we are about to create
+            self.pod_name = self._pod_name_default()
             pod = None
 
         if not pod:
+            pod = await WarmPool.instance().claim(self)
+            if pod:
+                self.pod_name = pod['metadata']['name']
+                self.pod = pod
+                SPAWN_DURATION.labels(start='pool').observe(time.perf_counter() - start_time)
+                yield PodState.RUNNING
+                return
+
             # There is no pod, so start one!
+            self.timeline = SpawnTimeline()
             yield PodState.STARTING
 
-            # create persistent volumes, if any
-            for template in self.pvc_templates:
-                pvc_spec = self.make_pvc_spec(template)
+            lease = None
+            if self.spawn_lease:
+                lease = Lease(self.namespace, self.pod_name, self.spawn_lease_duration)
+                while not await self._acquire(lease):
+                    # Another replica is starting this user's pod
+                    yield PodState.STARTING
+                    pod = await self._wait_for_other_spawn()
+                    if pod is not None:
+                        break
+
+            if not pod:
                 try:
-                    pvc = await self._run_in_executor(v1.create_namespaced_persistent_volume_claim, self.namespace, pvc_spec)
-                    self.log.info(f"Successfully created PVC {pvc.metadata.name}")
-                    self.log.debug(pvc)
-                except kubernetes.client.rest.ApiException as e:
-                    if e.status == 409:
-                        self.log.info(f"PVC {pvc_spec.metadata.name} already exists, did not create a new PVC.")
-                    elif e.status == 403:
-                        t, v, tb = sys.exc_info()
-                        try:
-                            pvc = await self._run_in_executor(v1.read_namespaced_persistent_volume_claim, pvc_spec.metadata.name, self.namespace, pvc_spec)
-                        except:
-                            raise v.with_traceback(tb)
-                        self.log.info(f"PVC {pvc_spec.metadata.name} already exists, possibly have reached quota.")
-                    else:
-                        raise
-
-            pod = await self._run_in_executor(
-                v1.create_namespaced_pod,
-                self.namespace, self.make_pod_spec()
-            )
+                    pod = await self._create()
+                finally:
+                    if lease is not None:
+                        await lease.release()
+            self.timeline.mark('created')
+
+        async for status in self._wait_for_running(pod):
+            if status == PodState.RUNNING:
+                SPAWN_DURATION.labels(start='cold').observe(time.perf_counter() - start_time)
+                if self.timeline is not None:
+                    self._report_timeline()
+            yield status
+
+    def _report_timeline(self):
+        """
+        Record how long each phase of starting the pod took
+        """
+        phases = self.timeline.phases()
+        for phase, seconds in phases.items():
+            SPAWN_PHASE_DURATION.labels(phase=phase).observe(seconds)
+        self.log.info('Pod started: ' + json.dumps({
+            'namespace': self.namespace,
+            'pod': self.pod_name,
+            'username': self.username,
+            'node': self.pod.get('spec', {}).get('nodeName'),
+            'seconds': round(self.timeline.elapsed(), 3),
+            'phases': {phase: round(seconds, 3) for phase, seconds in phases.items()},
+        }))
+
+    async def _acquire(self, lease):
+        """
+        Try to get the spawn lease, returning True if we may create the pod.
 
-        while pod.status.phase != 'Running':
-            # By now, a pod exists but is not necessarily in 'Running' state
-            # So we just wait for that to be the case, and return
-            yield PodState.STARTING
+        If we can't use leases - we aren't allowed to (403), or the API server
+        doesn't serve them (404) - everyone may. Replicas starting the same
+        pod then find out from the conflict when creating it.
+        """
+        try:
+            return await lease.acquire()
+        except kubernetes.client.rest.ApiException as e:
+            if e.status not in (403, 404):
+                raise
+            if self.namespace in self._lease_unavailable:
+                log = self.log.debug
+            else:
+                # Warn once, rather than on every spawn
+                self._lease_unavailable.add(self.namespace)
+                log = self.log.warning
+            reason = 'Not allowed to use' if e.status == 403 else 'API server does not serve'
+            log(f'{reason} leases in {self.namespace}, starting pod without one')
+            return True
+
+    async def _wait_for_other_spawn(self):
+        """
+        Wait a little for another replica to create this user's pod.
+
+        Returns the pod if it showed up, None otherwise.
+        """
+        if self.informer.synced:
+            await self.informer.wait_for_change(self.pod_name, timeout=1)
+        else:
             await asyncio.sleep(1)
-            pod = await self._run_in_executor(
-                v1.read_namespaced_pod,
-                pod.metadata.name, pod.metadata.namespace
+        return await self._find_pod()
+
+    async def _create(self):
+        """
+        Create this user's PVCs & pod, returning the pod.
+
+        If another replica created the pod first, their pod is returned.
+        """
+        # Create persistent volumes, if any. All at once, and only the ones we don't know exist.
+        if self.pvc_templates:
+            await asyncio.gather(*[
+                self._ensure_pvc(compiled) for compiled in self.compiled_templates('pvc_templates')
+            ])
+
+        # Imported here, since the image puller uses UserPod to read the pod template
+        from kubessh.prepuller import ImagePuller
+        try:
+            pod = await self.kube.create(
+                f'/api/v1/namespaces/{self.namespace}/pods',
+                ImagePuller.instance().place(self.make_pod_spec())
             )
+        except kubernetes.client.rest.ApiException as e:
+            if e.status != 409:
+                raise
+            # Another replica beat us to it. Use their pod.
+            pod = await self._read_pod(self.pod_name, use_cache=False)
+            if pod is None:
+                raise
+            self.log.info(f'Pod {self.pod_name} was created by another replica, using it')
+            return pod
+        self.informer.record(pod)
+        return pod
+
+    async def _ensure_pvc(self, compiled):
+        """
+        Make sure the PVC from compiled template exists for this user.
+
+        PVCs the PVC informer knows about are left alone without asking the
+        API server. Binding isn't waited for - the pod can be created and
+        scheduled meanwhile, and the scheduler waits for the claim if it must.
+        """
+        pvcs = PVCInformer.for_namespace(self.namespace, parent=self)
+        pvc_spec = self.make_pvc_spec(compiled)
+        pvc_name = pvc_spec['metadata']['name']
+        known = pvcs.get(pvc_name)
+        if known is not None and not known['metadata'].get('deletionTimestamp'):
+            return
+
+        pvc_path = f'/api/v1/namespaces/{self.namespace}/persistentvolumeclaims'
+        try:
+            pvc = await self.kube.create(pvc_path, pvc_spec)
+            self.log.info(f"Successfully created PVC {pvc['metadata']['name']}")
+            self.log.debug(pvc)
+        except kubernetes.client.rest.ApiException as e:
+            if e.status == 409:
+                self.log.info(f"PVC {pvc_name} already exists, did not create a new PVC.")
+                return
+            elif e.status == 403:
+                t, v, tb = sys.exc_info()
+                try:
+                    pvc = await self.kube.get(f'{pvc_path}/{pvc_name}')
+                except:
+                    raise v.with_traceback(tb)
+                self.log.info(f"PVC {pvc_name} already exists, possibly have reached quota.")
+            else:
+                raise
+        pvcs.record(pvc)
+
+    async def _wait_for_running(self, pod):
+        """
+        Wait for pod to be running, yielding PodState.STARTING while we wait.
+
+        State changes are pushed to us by the informer's watch, so we find out
+        the moment the pod is running. If we can't watch pods, poll with a
+        bounded exponential backoff instead. Progress is recorded in
+        self.timeline, if there is one.
+        """
+        name = pod['metadata']['name']
+        poll_interval = 0.1
+        events = None
+        if self.timeline is not None and not pod_is_running(pod):
+            events = asyncio.ensure_future(self._follow_events(pod))
+        try:
+            while not pod_is_running(pod):
+                if self.timeline is not None:
+                    self.timeline.update_from_pod(pod)
+                yield PodState.STARTING
+                if self.informer.synced:
+                    # Wake up at least every second, so the spinner keeps moving
+                    pod = await self.informer.wait_for_change(name, timeout=1)
+                else:
+                    await asyncio.sleep(poll_interval)
+                    poll_interval = min(poll_interval * 2, self.poll_max_interval)
+                    pod = None
+                if pod is None:
+                    # Cache miss - possibly a relist raced our create. Ask the API server.
+                    pod = await self._read_pod(name, use_cache=False)
+                if pod is None:
+                    raise RuntimeError(f'Pod {name} was deleted while starting')
+                if pod.get('status', {}).get('phase') in ['Failed', 'Succeeded']:
+                    raise RuntimeError(f'Pod {name} exited while starting')
+        finally:
+            if events is not None:
+                events.cancel()
+        if self.timeline is not None:
+            self.timeline.update_from_pod(pod)
+            self.timeline.mark('running')
+        self.pod = pod
         yield PodState.RUNNING
 
+    async def _follow_events(self, pod):
+        """
+        Feed events Kubernetes posts about pod into self.timeline, until cancelled
+        """
+        path = f'/api/v1/namespaces/{self.namespace}/events'
+        selector = f'involvedObject.kind=Pod,involvedObject.name={pod["metadata"]["name"]}'
+        if pod['metadata'].get('uid'):
+            # Not events about an earlier pod with the same name
+            selector += f',involvedObject.uid={pod["metadata"]["uid"]}'
+        params = {'fieldSelector': selector}
+        try:
+            events = await self.kube.get(path, params)
+            for event in events['items']:
+                self.timeline.update_from_event(event)
+            async for event in self.kube.watch(
+                path, dict(params, resourceVersion=events['metadata']['resourceVersion'])
+            ):
+                if event['type'] in ('ADDED', 'MODIFIED'):
+                    self.timeline.update_from_event(event['object'])
+        except kubernetes.client.rest.ApiException as e:
+            # Only the details of the timeline are lost
+            self.log.debug(f'Could not watch events for pod {pod["metadata"]["name"]}: {e.status} {e.reason}')
+        except Exception:
+            self.log.exception(f'Watching events for pod {pod["metadata"]["name"]} failed')
+
     async def execute(self, ssh_process):
-        command = shlex.split(ssh_process.command) if ssh_process.command else ["/bin/bash", "-l"]
+        """
+        Run the command requested over ssh in this pod's shell container.
+
+        Data flows directly between the ssh channel and the API server's exec
+        websocket, unless exec_backend is set to 'kubectl'. sftp sessions
+        run sftp_server_command.
+        """
+        if ssh_process.subsystem == 'sftp':
+            # File transfers stream straight into the pod, with no copy kept here
+            command, kind = self.sftp_server_command, 'sftp'
+        else:
+            command = shlex.split(ssh_process.command) if ssh_process.command else ["/bin/bash", "-l"]
+            kind = 'shell'
+        # Imported here, since the registry needs pod_is_running from this module
+        from kubessh.sessions import SessionRegistry
+        with SessionRegistry.instance().session(self, kind) as session:
+            if self.exec_backend == 'kubectl':
+                return await self._execute_kubectl(ssh_process, command)
+            return await self._execute_websocket(ssh_process, command, session)
+
+    async def _execute_websocket(self, ssh_process, command, session):
+
+        start_time = time.perf_counter()
+        tty = bool(ssh_process.get_terminal_type())
+        exec_stream = await ExecStream.connect(self.namespace, self.pod_name, 'shell', command, tty)
+        if tty:
+            width, height = ssh_process.get_terminal_size()[:2]
+            await exec_stream.resize(width, height)
+
+        # time.monotonic() when the process last wrote something
+        last_output = time.monotonic()
+
+        async def relay_stdin():
+            while True:
+                try:
+                    data = await ssh_process.stdin.read(STREAM_READ_SIZE)
+                except asyncssh.misc.TerminalSizeChanged as exc:
+                    await exec_stream.resize(exc.width, exc.height)
+                    continue
+                if not data:
+                    break
+                session.record(len(data))
+                await exec_stream.write_stdin(data)
+
+            if tty:
+                # SSH client is gone, but the shell is still alive. Closing the
+                # stream hangs up the terminal, which kills it.
+                await exec_stream.close()
+                self.log.info('Terminated process')
+                return
+            if not exec_stream.can_close_stdin:
+                # EOF can only be passed on by closing the stream, which loses
+                # any output after it. Give the process a chance to finish by
+                # itself first - this task is cancelled if it does.
+                while time.monotonic() - last_output < STDIN_EOF_IDLE_TIMEOUT:
+                    await asyncio.sleep(STDIN_EOF_IDLE_TIMEOUT - (time.monotonic() - last_output))
+                ssh_process.stderr.write(
+                    b'kubessh: closing the session at end of input, since the API server '
+                    b'does not support v5.channel.k8s.io\r\n'
+                )
+            await exec_stream.close_stdin()
+
+        stdin_relay = asyncio.ensure_future(relay_stdin())
+        try:
+            async for channel, data in exec_stream:
+                last_output = time.monotonic()
+                if start_time is not None:
+                    FIRST_BYTE_DURATION.observe(time.perf_counter() - start_time)
+                    start_time = None
+                session.record(len(data))
+                if channel == STDOUT_CHANNEL:
+                    ssh_process.stdout.write(data)
+                    await ssh_process.stdout.drain()
+                elif channel == STDERR_CHANNEL:
+                    ssh_process.stderr.write(data)
+                    await ssh_process.stderr.drain()
+        except BrokenPipeError:
+            # ssh channel closed under us
+            pass
+        finally:
+            stdin_relay.cancel()
+            await exec_stream.close()
+
+        # exit_code is only unknown if the ssh channel closed first
+        ssh_process.exit(exec_stream.exit_code if exec_stream.exit_code is not None else 1)
+
+    async def _execute_kubectl(self, ssh_process, command):
         tty_args = ['--tty'] if ssh_process.get_terminal_type() else []
         kubectl_command = [
             'kubectl',
@@ -277,45 +841,48 @@ class UserPod(LoggingConfigurable):
             '--'
         ] + command
 
-        # FIXME: Is this async friendly?
         if ssh_process.get_terminal_type():
-            # PtyProcess and asyncssh disagree on ordering of terminal size
-            ts = ssh_process.get_terminal_size()
-            process = PtyProcess.spawn(argv=kubectl_command, dimensions=(ts[1], ts[0]))
-            await ssh_process.redirect(process, process, process)
-
-            loop = asyncio.get_event_loop()
-
-            # Future for spawned process dying
-            # We explicitly create a threadpool of 1 threads for every run_in_executor call
-            # to help reason about interaction between asyncio and threads. A global threadpool
-            # is fine when using it as a queue (when doing HTTP requests, for example), but not
-            # here since we could end up deadlocking easily.
-            shell_completed = loop.run_in_executor(ThreadPoolExecutor(1), process.wait)
-            # Future for ssh connection closing
-            read_stdin = asyncio.ensure_future(ssh_process.stdin.read())
-
-            # This loops is here to pass TerminalSizeChanged events through to ptyprocess
-            # It needs to break when the ssh connection is gone or when the spawned process is gone.
-            # See https://github.com/ronf/asyncssh/issues/134 for info on how this works
-            while not ssh_process.stdin.at_eof() and not shell_completed.done():
-                try:
-                    if read_stdin.done():
-                        read_stdin = asyncio.ensure_future(ssh_process.stdin.read())
-                    done, _ = await asyncio.wait([read_stdin, shell_completed], return_when=asyncio.FIRST_COMPLETED)
-                    # asyncio.wait doesn't await the futures - it only waits for them to complete.
-                    # We need to explicitly await them to retreive any exceptions from them
-                    for future in done:
-                        await future
-                except asyncssh.misc.TerminalSizeChanged as exc:
-                    process.setwinsize(exc.height, exc.width)
-
-            # SSH Client is gone, but process is still alive. Let's kill it!
-            if ssh_process.stdin.at_eof() and not shell_completed.done():
-                await loop.run_in_executor(ThreadPoolExecutor(1), lambda: process.terminate(force=True))
+            width, height = ssh_process.get_terminal_size()[:2]
+            terminal = Terminal.spawn(kubectl_command, width, height)
+
+            async def relay_stdin():
+                while True:
+                    try:
+                        data = await ssh_process.stdin.read(STREAM_READ_SIZE)
+                    except asyncssh.misc.TerminalSizeChanged as exc:
+                        terminal.resize(exc.width, exc.height)
+                        continue
+                    if not data:
+                        break
+                    await terminal.write(data)
+
+            async def relay_output():
+                while True:
+                    data = await terminal.read()
+                    if not data:
+                        break
+                    ssh_process.stdout.write(data)
+                    await ssh_process.stdout.drain()
+
+            relays = [asyncio.ensure_future(relay_stdin()), asyncio.ensure_future(relay_output())]
+            try:
+                done, _ = await asyncio.wait(relays, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for relay in relays:
+                    relay.cancel()
+                # Make sure nothing is waiting on the terminal before it is closed
+                await asyncio.gather(*relays, return_exceptions=True)
+
+            if relays[1] in done and relays[1].exception() is None:
+                # Everything on the terminal has exited
+                exit_code = await terminal.wait()
+                terminal.close()
+            else:
+                # SSH Client is gone, but process is still alive. Let's kill it!
+                exit_code = await terminal.terminate()
                 self.log.info('Terminated process')
 
-            ssh_process.exit(shell_completed.result())
+            ssh_process.exit(exit_code)
         else:
             process = await asyncio.create_subprocess_exec(
                 *kubectl_command,
@@ -0,0 +1,365 @@
+"""
+Pull the images user pods need onto nodes before anyone logs in.
+
+Pulling the shell container's image is most of the time a cold start takes
+on a node that hasn't run it before. ImagePuller keeps a DaemonSet with an
+init container per image in UserPod.pod_template. Each exits right away -
+but the kubelet has to pull the image to run it. A pause container then
+keeps the pod around, so the images stay in use and aren't garbage
+collected.
+
+Init containers run one at a time, and one that fails is retried forever
+without the ones after it ever starting. So the pull containers can't rely
+on anything in the images being pulled - not even /bin/sh. A first init
+container copies busybox, which is statically linked, into a volume shared
+with the pull containers, and each of them runs it as `true`.
+
+The DaemonSet is made from the pod template every sync_interval, and
+replaced when it differs from what is running, so it follows the template
+(and puts itself back if deleted). Per node pull state is read from the
+puller pods, and new user pods prefer nodes that have every image.
+
+Pullers use the template's nodeSelector, tolerations & affinity, so they
+run on the nodes user pods can be scheduled on.
+"""
+import asyncio
+import hashlib
+import json
+import os
+
+import kubernetes
+from traitlets.config import SingletonConfigurable
+from traitlets import Bool, Float, Unicode
+
+from kubessh.kube import KubeClient
+from kubessh.pod import UserPod
+
+PULLER_LABEL = 'kubessh.yuvi.in/image-puller'
+SPEC_HASH_ANNOTATION = 'kubessh.yuvi.in/spec-hash'
+
+# Waiting reasons of puller init containers whose image can't be pulled
+PULL_FAILED_REASONS = {'ErrImagePull', 'ImagePullBackOff', 'InvalidImageName', 'ErrImageNeverPull'}
+
+# Where the helper binary is mounted in pull containers. Named after the
+# busybox applet it runs as.
+PULL_COMMAND = '/kubessh-image-puller/true'
+
+# Pod spec fields copied from UserPod.pod_template, deciding where pods can run
+PLACEMENT_FIELDS = ('nodeSelector', 'tolerations', 'affinity', 'imagePullSecrets')
+
+
+def image_state(status):
+    """
+    Return 'pulled', 'pulling' or 'failed' for a puller init container status
+    """
+    state = status.get('state') or {}
+    terminated = state.get('terminated') or (status.get('lastState') or {}).get('terminated')
+    if terminated and terminated.get('exitCode') != 0:
+        # The image is there, but the pull containers after this one never start
+        return 'failed'
+    if 'running' in state or terminated:
+        return 'pulled'
+    if (state.get('waiting') or {}).get('reason') in PULL_FAILED_REASONS:
+        return 'failed'
+    return 'pulling'
+
+
+def failure_message(status):
+    """
+    Return why image_state says a puller init container has 'failed'
+    """
+    state = status.get('state') or {}
+    terminated = state.get('terminated') or (status.get('lastState') or {}).get('terminated')
+    if terminated:
+        return f'pull container exited with {terminated.get("exitCode")}'
+    waiting = state['waiting']
+    return waiting.get('message', waiting['reason'])
+
+
+class ImagePuller(SingletonConfigurable):
+    """
+    Keeps the images of user pods pulled on every node.
+
+    Get it with `ImagePuller.instance()`.
+    """
+    namespace = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Kubernetes Namespace the puller DaemonSet runs in.
+        """,
+    )
+
+    enabled = Bool(
+        False,
+        help="""
+        Run a DaemonSet pulling the images in UserPod.pod_template on every node.
+
+        Requires permission to manage daemonsets in the namespace.
+        """,
+        config=True
+    )
+
+    name = Unicode(
+        'kubessh-image-puller',
+        help="""
+        Name of the puller DaemonSet.
+        """,
+        config=True
+    )
+
+    pause_image = Unicode(
+        'registry.k8s.io/pause:3.9',
+        help="""
+        Image of the container that keeps puller pods running once images are pulled.
+        """,
+        config=True
+    )
+
+    helper_image = Unicode(
+        'busybox:1.36',
+        help="""
+        Image with a statically linked busybox at /bin/busybox.
+
+        It is copied into every pulled image and run there as `true`, so
+        pulling works no matter what the pulled images have in them.
+        """,
+        config=True
+    )
+
+    sync_interval = Float(
+        30,
+        help="""
+        Seconds between checks of the DaemonSet & the pull state of nodes.
+        """,
+        config=True
+    )
+
+    prefer_cached_nodes = Bool(
+        True,
+        help="""
+        Ask the scheduler to put new user pods on nodes that have pulled every image.
+
+        Only a preference - pods still go to other nodes if those are full.
+        """,
+        config=True
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # node name -> {image: 'pulled' / 'pulling' / 'failed'}
+        self.nodes = {}
+        self._task = None
+
+    def _pod_template(self):
+        return UserPod.configured(self.config, 'pod_template')
+
+    def images(self):
+        """
+        Return the images in the pod template, in order.
+
+        Images that depend on the username can't be pulled ahead of time,
+        and are left out.
+        """
+        spec = self._pod_template().get('spec', {})
+        images = []
+        for container in (spec.get('initContainers') or []) + (spec.get('containers') or []):
+            image = container.get('image')
+            if image and '{' not in image and image not in images:
+                images.append(image)
+        return images
+
+    def make_daemonset(self):
+        """
+        Return the puller DaemonSet for the current pod template
+        """
+        template_spec = self._pod_template().get('spec', {})
+        pull_policies = {
+            container.get('image'): container['imagePullPolicy']
+            for container in (template_spec.get('initContainers') or []) + (template_spec.get('containers') or [])
+            if container.get('imagePullPolicy')
+        }
+        helper_mount = {'name': 'helper', 'mountPath': os.path.dirname(PULL_COMMAND)}
+        init_containers = [{
+            'name': 'helper',
+            'image': self.helper_image,
+            'command': ['cp', '/bin/busybox', PULL_COMMAND],
+            'volumeMounts': [helper_mount],
+        }]
+        for i, image in enumerate(self.images()):
+            container = {
+                'name': f'pull-{i}',
+                'image': image,
+                'command': [PULL_COMMAND],
+                'volumeMounts': [helper_mount],
+            }
+            if image in pull_policies:
+                container['imagePullPolicy'] = pull_policies[image]
+            init_containers.append(container)
+
+        labels = {PULLER_LABEL: self.name}
+        pod_spec = {
+            'automountServiceAccountToken': False,
+            'terminationGracePeriodSeconds': 0,
+            'initContainers': init_containers,
+            'containers': [{'name': 'pause', 'image': self.pause_image}],
+            'volumes': [{'name': 'helper', 'emptyDir': {}}],
+        }
+        for field in PLACEMENT_FIELDS:
+            if template_spec.get(field):
+                pod_spec[field] = template_spec[field]
+        spec = {
+            'selector': {'matchLabels': labels},
+            # Pullers are never in anyone's way, so update them all at once
+            'updateStrategy': {'type': 'RollingUpdate', 'rollingUpdate': {'maxUnavailable': '100%'}},
+            'template': {'metadata': {'labels': labels}, 'spec': pod_spec},
+        }
+        spec_hash = hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+        return {
+            'apiVersion': 'apps/v1',
+            'kind': 'DaemonSet',
+            'metadata': {
+                'name': self.name,
+                'labels': labels,
+                'annotations': {SPEC_HASH_ANNOTATION: spec_hash},
+            },
+            'spec': spec,
+        }
+
+    def stats(self):
+        """
+        Return the number of nodes in each pull state.
+
+        A node is 'pulled' once it has every image, and 'failed' if any image
+        can't be pulled.
+        """
+        stats = {'pulled': 0, 'pulling': 0, 'failed': 0}
+        for images in self.nodes.values():
+            states = set(images.values())
+            if 'failed' in states:
+                stats['failed'] += 1
+            elif states <= {'pulled'}:
+                stats['pulled'] += 1
+            else:
+                stats['pulling'] += 1
+        return stats
+
+    def cached_nodes(self):
+        """
+        Return names of nodes that have pulled every image
+        """
+        return sorted(
+            node for node, images in self.nodes.items()
+            if all(state == 'pulled' for state in images.values())
+        )
+
+    def place(self, pod):
+        """
+        Return pod with a preference for nodes that have pulled its images.
+
+        pod is not modified. Nothing is added when there is no choice to
+        make - no node has the images yet, or every node does.
+        """
+        if not self.enabled or not self.prefer_cached_nodes:
+            return pod
+        nodes = self.cached_nodes()
+        if not nodes or len(nodes) == len(self.nodes):
+            return pod
+        spec = pod['spec']
+        affinity = dict(spec.get('affinity') or {})
+        node_affinity = dict(affinity.get('nodeAffinity') or {})
+        node_affinity['preferredDuringSchedulingIgnoredDuringExecution'] = [
+            *(node_affinity.get('preferredDuringSchedulingIgnoredDuringExecution') or []),
+            {
+                'weight': 100,
+                'preference': {
+                    'matchFields': [{'key': 'metadata.name', 'operator': 'In', 'values': nodes}]
+                },
+            },
+        ]
+        affinity['nodeAffinity'] = node_affinity
+        return {**pod, 'spec': {**spec, 'affinity': affinity}}
+
+    def _update_nodes(self, pods):
+        """
+        Update per node pull state from the puller pods
+        """
+        images = {f'pull-{i}': image for i, image in enumerate(self.images())}
+        nodes = {}
+        for pod in pods:
+            node = pod.get('spec', {}).get('nodeName')
+            if not node:
+                continue
+            statuses = {
+                status['name']: status
+                for status in pod.get('status', {}).get('initContainerStatuses') or []
+            }
+            nodes[node] = {
+                image: image_state(statuses[name]) if name in statuses else 'pulling'
+                for name, image in images.items()
+            }
+            for name, image in images.items():
+                state = nodes[node][image]
+                if state == self.nodes.get(node, {}).get(image):
+                    continue
+                if state == 'pulled':
+                    self.log.debug(f'Node {node} has pulled {image}')
+                elif state == 'failed':
+                    self.log.warning(f'Node {node} failed to pull {image}: {failure_message(statuses[name])}')
+        self.nodes = nodes
+
+    async def sync(self):
+        """
+        Make the DaemonSet match the pod template, and read the pull state of nodes
+        """
+        kube = KubeClient.instance()
+        path = f'/apis/apps/v1/namespaces/{self.namespace}/daemonsets'
+        daemonset = self.make_daemonset()
+        try:
+            current = await kube.get(f'{path}/{self.name}')
+        except kubernetes.client.rest.ApiException as e:
+            if e.status != 404:
+                raise
+            current = None
+
+        try:
+            if not self.images():
+                if current is not None:
+                    await kube.delete(f'{path}/{self.name}')
+                    self.log.info(f'Deleted image puller {self.name}, since there are no images to pull')
+            elif current is None:
+                await kube.create(path, daemonset)
+                self.log.info(f'Created image puller {self.name} for {", ".join(self.images())}')
+            elif current['metadata'].get('annotations', {}).get(SPEC_HASH_ANNOTATION) != \
+                    daemonset['metadata']['annotations'][SPEC_HASH_ANNOTATION]:
+                # The resourceVersion makes this fail if anyone else wrote since we read
+                daemonset['metadata']['resourceVersion'] = current['metadata']['resourceVersion']
+                await kube.replace(f'{path}/{self.name}', daemonset)
+                self.log.info(f'Updated image puller {self.name} for {", ".join(self.images())}')
+        except kubernetes.client.rest.ApiException as e:
+            if e.status not in (404, 409):
+                raise
+            # Another replica got there first. We'll look again next time.
+
+        pods = await kube.get(
+            f'/api/v1/namespaces/{self.namespace}/pods',
+            {'labelSelector': f'{PULLER_LABEL}={self.name}'}
+        )
+        self._update_nodes(pods['items'])
+
+    def start(self):
+        """
+        Start keeping the DaemonSet in sync, if enabled
+        """
+        if not self.enabled or self._task is not None:
+            return
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sync()
+                self.log.debug(f'Image puller: {self.stats()}')
+            except Exception:
+                self.log.exception('Syncing image puller failed')
+            await asyncio.sleep(self.sync_interval)
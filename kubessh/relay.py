@@ -0,0 +1,65 @@
+"""
+Bidirectional byte relay between two streams.
+
+Used to connect forwarded ssh channels to their destination in the user pod.
+Each direction gets its own pump, so neither ever waits on the other.
+"""
+import asyncio
+
+# Read up to this many bytes at a time. Large enough to fill a default ssh
+# channel packet many times over, small enough to keep per-connection memory
+# bounded.
+RELAY_READ_SIZE = 64 * 1024
+
+
+async def pump(reader, writer, read_size=RELAY_READ_SIZE, on_data=None):
+    """
+    Copy everything from reader to writer until reader hits EOF.
+
+    Awaits writer.drain() after every write, so a slow receiver slows down
+    the reads rather than piling up data in memory. EOF is passed on to writer
+    if it supports half-close. on_data, if given, is called with the number
+    of bytes in each chunk copied.
+    """
+    while True:
+        data = await reader.read(read_size)
+        if not data:
+            break
+        if on_data is not None:
+            on_data(len(data))
+        writer.write(data)
+        await writer.drain()
+    if writer.can_write_eof():
+        writer.write_eof()
+
+
+async def relay(reader, writer, upstream_reader, upstream_writer, read_size=RELAY_READ_SIZE, on_data=None):
+    """
+    Relay data in both directions until both sides are done.
+
+    When one side closes its half of the connection, EOF is propagated to the
+    other side while data keeps flowing the other way. Writers that can't
+    half-close can't be told about EOF, so the relay ends as soon as their
+    side is done - otherwise it waits for the other side to close, which
+    may never happen. If either direction fails, the other one is stopped
+    too. Both writers are closed when done. on_data is passed on to both
+    pumps.
+    """
+    pumps = {
+        asyncio.ensure_future(pump(reader, upstream_writer, read_size, on_data)): upstream_writer,
+        asyncio.ensure_future(pump(upstream_reader, writer, read_size, on_data)): writer,
+    }
+    try:
+        pending = set(pumps)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                # Raise any exception from the pumps
+                task.result()
+            if any(not pumps[task].can_write_eof() for task in done):
+                break
+    finally:
+        for task in pumps:
+            task.cancel()
+        writer.close()
+        upstream_writer.close()
@@ -1,20 +1,35 @@
 """
 Convenience functions for creating pod templates.
 """
-from collections import namedtuple
 import copy
+from functools import lru_cache
 from kubernetes import client
-import json
 
-try:
-    import yaml
-except ImportError:
-    yaml = False
 
-# FIXME: ApiClient provides us serialize / deserialize methods,
-# but unfortunately also starts a threadpool for no reason! This
-# takes up resources, so we try to not make too many.
-SERIALIZATION_API_CLIENT = client.ApiClient()
+@lru_cache(maxsize=None)
+def _serialization_api_client():
+    """
+    Return the ApiClient used for its sanitize_for_serialization method.
+
+    ApiClient also sets up a thread pool we never use, so only one is made,
+    and only once something needs it - most pod specs are plain dicts.
+    """
+    return client.ApiClient()
+
+
+@lru_cache(maxsize=None)
+def _python_attributes(klass):
+    """
+    Return dict mapping JSON API style attribute names of klass to python ones
+    """
+    # All k8s python client objects have an 'attribute_map' property
+    # which has as keys python style attribute names (api_client)
+    # and as values the kubernetes JSON API style attribute names
+    # (apiClient).
+    return {
+        json_attribute: python_attribute
+        for python_attribute, json_attribute in klass.attribute_map.items()
+    }
 
 
 def _set_k8s_attribute(obj, attribute, value):
@@ -28,37 +43,27 @@ def _set_k8s_attribute(obj, attribute, value):
     value
         Can be anything (string, list, dict, k8s objects) that can be
         accepted by the k8s python client
+
+    Dicts are deep merged into the current value & lists are appended to it,
+    in place.
     """
-    current_value = None
-    attribute_name = None
-    # All k8s python client objects have an 'attribute_map' property
-    # which has as keys python style attribute names (api_client)
-    # and as values the kubernetes JSON API style attribute names
-    # (apiClient). We want to allow users to use the JSON API style attribute
-    # names only.
-    for python_attribute, json_attribute in obj.attribute_map.items():
-        if json_attribute == attribute:
-            attribute_name = python_attribute
-            break
-    else:
+    # We want to allow users to use the JSON API style attribute names only.
+    attribute_name = _python_attributes(type(obj)).get(attribute)
+    if attribute_name is None:
         raise ValueError('Attribute must be one of {}'.format(obj.attribute_map.values()))
 
-    if hasattr(obj, attribute_name):
-        current_value = getattr(obj, attribute_name)
-
-    if current_value is not None:
-        # This will ensure that current_value is something JSONable,
-        # so a dict, list, or scalar
-        current_value = SERIALIZATION_API_CLIENT.sanitize_for_serialization(
-            current_value
-        )
+    current_value = getattr(obj, attribute_name, None)
 
-    if isinstance(current_value, dict):
+    if isinstance(value, dict) and hasattr(current_value, 'attribute_map'):
+        # Deep merge into the k8s object
+        for key, item in value.items():
+            _set_k8s_attribute(current_value, key, item)
+    elif isinstance(current_value, dict) and isinstance(value, dict):
         # Deep merge our dictionaries!
-        setattr(obj, attribute_name, merge_dictionaries(current_value, value))
-    elif isinstance(current_value, list):
+        merge_dictionaries(current_value, value)
+    elif isinstance(current_value, list) and isinstance(value, list):
         # Just append lists
-        setattr(obj, attribute_name, current_value + value)
+        current_value.extend(value)
     else:
         # Replace everything else
         setattr(obj, attribute_name, value)
@@ -92,15 +97,28 @@ def merge_dictionaries(a, b, path=None, update=True):
             a[key] = b[key]
     return a
 
-_FakeResponse = namedtuple('_FakeResponse', ['data'])
-
 def make_api_object_from_dict(dict_, kind=client.V1Pod):
-    # FIXME: We can't use the 'deserialize' function since
-    # that expects a response object!
-    return SERIALIZATION_API_CLIENT.deserialize(
-        _FakeResponse(data=json.dumps(dict_)),
-        kind
-    )
+    """
+    Return a kubernetes client object of type kind, made from dict_
+
+    Only needed where something wants model objects - the API can be sent
+    plain dicts directly, see api_body.
+    """
+    # Models take the JSON API style attribute names, and make k8s objects
+    # of nested dicts too
+    return kind.from_dict(dict_)
+
+
+def api_body(obj):
+    """
+    Return obj in a form that can be JSON encoded & sent to the API server
+
+    Plain dicts and lists, like the pod & PVC specs kubessh makes, are
+    returned as is. Kubernetes client objects are converted to dicts.
+    """
+    if isinstance(obj, (dict, list)):
+        return obj
+    return _serialization_api_client().sanitize_for_serialization(obj)
 
 
 def clean_pod_template(pod_template):
@@ -1,18 +1,36 @@
-import asyncssh
 import asyncio
-import subprocess
+import asyncssh
 from traitlets.config import LoggingConfigurable
-from traitlets import Unicode
-from simpervisor import SupervisedProcess
-import socket
-from kubessh.pod import UserPod, PodState
-
-def random_port():
-    sock = socket.socket()
-    sock.bind(('', 0))
-    port = sock.getsockname()[1]
-    sock.close()
-    return port
+from traitlets import Unicode, Callable
+from kubessh.pod import UserPod
+from kubessh.relay import relay
+from kubessh.forwarding import PortForwarder
+from kubessh.sessions import SessionRegistry
+
+class KubeSSHProcess(asyncssh.SSHServerProcess):
+    """
+    Server process that gets sftp subsystem requests like any other session.
+
+    asyncssh only lets sftp subsystem requests through to an SFTP server it
+    runs itself. We relay them to an sftp-server in the user's pod instead,
+    so they are passed on to the process factory with process.subsystem set.
+
+    Relies on asyncssh internals, so the asyncssh version is pinned in setup.py.
+    """
+    def subsystem_requested(self, subsystem):
+        return True
+
+    def session_started(self):
+        if self.subsystem != 'sftp':
+            return super().session_started()
+        # The non-sftp branch of SSHServerProcess.session_started in
+        # asyncssh/process.py, which starts the process factory
+        stdin = asyncssh.SSHReader(self, self.channel)
+        stdout = asyncssh.SSHWriter(self, self.channel)
+        stderr = asyncssh.SSHWriter(self, self.channel, asyncssh.EXTENDED_DATA_STDERR)
+        handler = self._start_process(stdin, stdout, stderr)
+        self.channel.get_connection().create_task(handler, stdin.logger)
+
 
 class BaseServer(asyncssh.SSHServer, LoggingConfigurable):
     """
@@ -36,21 +54,33 @@ class BaseServer(asyncssh.SSHServer, LoggingConfigurable):
         """,
     )
 
+    process_factory = Callable(
+        None,
+        allow_none=True,
+        help="""
+        Coroutine called with an asyncssh.SSHServerProcess for every session
+        opened over this connection.
+        """,
+    )
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.forwarding_processes = {}
+        # Relays for port forwards opened over this ssh connection
+        self.forwarding_tasks = set()
 
     def connection_made(self, conn):
         self.conn = conn
 
+    def session_requested(self):
+        # As asyncssh makes them for connections without an sftp_factory
+        return KubeSSHProcess(self.process_factory, sftp_factory=None, sftp_version=0, allow_scp=False)
+
     def connection_lost(self, exception):
         """
-        Terminate any running port-forward process when done
+        Stop relaying any port forwards from this connection when done
         """
-        for proc in self.forwarding_processes.values():
-            # FIXME: This isn't great, since it doesn't retrieve exceptions
-            # Maybe needs to be a thread?
-            asyncio.create_task(proc.terminate())
+        for task in self.forwarding_tasks:
+            task.cancel()
 
     def connection_requested(self, dest_host, dest_port, orig_host, orig_port):
         # Only allow localhost connections
@@ -61,72 +91,22 @@ class BaseServer(asyncssh.SSHServer, LoggingConfigurable):
             )
 
         username = self.conn.get_extra_info('username')
-        user_pod = UserPod(username, self.namespace)
-
-        cache_key = f'{user_pod.pod_name}:{dest_port}'
-
+        user_pod = UserPod(username, self.namespace, parent=self)
 
-        if cache_key in self.forwarding_processes:
-            proc = self.forwarding_processes[cache_key]
-
-            port = proc.port
-        else:
-            port = random_port()
-            command = [
-                'kubectl',
-                'port-forward',
-                user_pod.pod_name,
-                f'{port}:{dest_port}'
-            ]
-            async def _socket_ready(proc):
-                try:
-                    sock = socket.create_connection(('127.0.0.1', port))
-                    sock.close()
-                    return True
-                except:
-                    # FIXME: Be more specific in errors we are catching?
-                    return False
-
-
-            proc = SupervisedProcess(
-                'kubectl', *command,
-                always_restart=True,
-                ready_func=_socket_ready
-            )
-            self.forwarding_processes[cache_key] = proc
-            proc.port = port
+        self.log.debug(f'Forwarding to {user_pod.pod_name}:{dest_port}')
 
         async def transfer_data(reader, writer):
-            # Make sure our pod is running
-            async for status in user_pod.ensure_running():
-                if status == PodState.RUNNING:
-                    break
-            # Make sure our kubectl port-forward is running
-            await proc.start()
-            await proc.ready()
-
-            # Connect to the local end of the kubectl port-forward
-            (upstream_reader, upstream_writer) = await asyncio.open_connection('127.0.0.1', port)
-
-            # FIXME: This should be as fully bidirectional as possible, with minimal buffering / timeouts
-            while not reader.at_eof():
-                try:
-                    data = await asyncio.wait_for(reader.read(8092), timeout=0.1)
-                except asyncio.TimeoutError:
-                    data = None
-                if data:
-                    upstream_writer.write(data)
-                    await upstream_writer.drain()
-
+            task = asyncio.current_task()
+            self.forwarding_tasks.add(task)
+            try:
+                upstream = await PortForwarder.instance().connect(user_pod, dest_port)
                 try:
-                    in_data = await asyncio.wait_for(upstream_reader.read(8092), timeout=0.1)
-                except asyncio.TimeoutError:
-                    in_data = None
-                if in_data:
-                    writer.write(in_data)
-                    await writer.drain()
-                if upstream_reader.at_eof():
-                    break
-            writer.close()
-
-        return transfer_data
\ No newline at end of file
+                    with SessionRegistry.instance().session(user_pod, 'forward') as session:
+                        await relay(reader, writer, upstream, upstream, on_data=session.record)
+                finally:
+                    upstream.close()
+                    await upstream.wait_closed()
+            finally:
+                self.forwarding_tasks.discard(task)
+
+        return transfer_data
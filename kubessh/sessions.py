@@ -0,0 +1,235 @@
+"""
+Track which user pods are in use, and delete ones that aren't.
+
+Every shell and port forward into a user pod is registered as a session
+while it is open, and counts the bytes flowing through it. A pod is idle
+when it has had no open sessions (or, with cull_connected, no traffic) for
+a while. The culler deletes pods that have been idle longer than
+cull_idle_timeout, freeing up their share of the cluster.
+
+Each kubessh replica only knows about its own sessions, so the last time a
+pod was active is also published as an annotation on it. Pods are only
+culled once every replica agrees they are idle.
+"""
+import asyncio
+import datetime
+import time
+
+import kubernetes
+from traitlets.config import SingletonConfigurable
+from traitlets import Bool, Float, Unicode
+
+from kubessh.informer import PodInformer, USERNAME_LABEL
+from kubessh.kube import KubeClient
+from kubessh.pod import pod_is_running
+
+# Annotation on user pods holding when they were last active, in ISO 8601
+LAST_ACTIVITY_ANNOTATION = 'kubessh.yuvi.in/last-activity'
+
+
+def _parse_timestamp(value):
+    # Python < 3.11 can't parse the 'Z' suffix Kubernetes uses
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+class PodActivity:
+    """
+    Sessions open into one pod, and when it was last used.
+    """
+    def __init__(self, uid):
+        self.uid = uid
+        self.sessions = 0
+        self.sessions_by_kind = {}
+        self.bytes = 0
+        self.last_activity = time.time()
+        # last_activity we last wrote to the pod's annotation
+        self.published = None
+
+
+class Session:
+    """
+    A shell or port forward open into a user pod.
+
+    Use as a context manager around the session, and call record for
+    data flowing through it.
+    """
+    def __init__(self, registry, activity, kind):
+        self.registry = registry
+        self.activity = activity
+        self.kind = kind
+        self.bytes = 0
+
+    def record(self, nbytes):
+        self.bytes += nbytes
+        self.activity.bytes += nbytes
+        self.activity.last_activity = time.time()
+        self.registry.bytes_relayed[self.kind] += nbytes
+
+    def __enter__(self):
+        self.activity.sessions += 1
+        self.activity.sessions_by_kind[self.kind] = self.activity.sessions_by_kind.get(self.kind, 0) + 1
+        self.activity.last_activity = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.activity.sessions -= 1
+        self.activity.sessions_by_kind[self.kind] -= 1
+        self.activity.last_activity = time.time()
+
+
+class SessionRegistry(SingletonConfigurable):
+    """
+    Open sessions into user pods in this process, and the culler using them.
+
+    Get it with `SessionRegistry.instance()`.
+    """
+    namespace = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Kubernetes Namespace of the user pods to cull.
+        """,
+    )
+
+    cull_idle_timeout = Float(
+        0,
+        help="""
+        Seconds a user pod can be idle before it is deleted.
+
+        Set to 0 (the default) to never delete idle pods. Users' next login
+        starts a fresh pod, so only persistent volumes survive culling.
+        """,
+        config=True
+    )
+
+    cull_interval = Float(
+        60,
+        help="""
+        Seconds between checks for idle pods.
+
+        Last activity annotations on pods are updated at the same interval.
+        Pods in use here must have their activity published before other
+        replicas think they are idle, so this is capped at half of
+        cull_idle_timeout.
+        """,
+        config=True
+    )
+
+    cull_connected = Bool(
+        False,
+        help="""
+        Cull pods with open sessions, if no data has flowed through them.
+
+        By default, pods are never culled while someone has a shell or port
+        forward open into them, no matter how quiet it is.
+        """,
+        config=True
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (namespace, pod name) -> PodActivity
+        self.pods = {}
+        # session kind -> total bytes relayed by sessions of that kind
+        self.bytes_relayed = {'shell': 0, 'sftp': 0, 'forward': 0}
+        self._task = None
+
+    def session(self, user_pod, kind):
+        """
+        Return a new Session into user_pod's pod, which must be running
+        """
+        key = (user_pod.namespace, user_pod.pod_name)
+        uid = user_pod.pod['metadata']['uid']
+        activity = self.pods.get(key)
+        if activity is None or activity.uid != uid:
+            activity = self.pods[key] = PodActivity(uid)
+        return Session(self, activity, kind)
+
+    def last_active(self, pod):
+        """
+        Return when pod was last active, as a unix timestamp.
+
+        Uses what we know about sessions here, the last activity other
+        replicas published on the pod, and when the pod started.
+        """
+        metadata = pod['metadata']
+        times = [_parse_timestamp(metadata['creationTimestamp'])]
+        published = (metadata.get('annotations') or {}).get(LAST_ACTIVITY_ANNOTATION)
+        if published:
+            times.append(_parse_timestamp(published))
+        activity = self.pods.get((self.namespace, metadata['name']))
+        if activity is not None and activity.uid == metadata['uid']:
+            if activity.sessions and not self.cull_connected:
+                return time.time()
+            times.append(activity.last_activity)
+        return max(times)
+
+    def start(self):
+        """
+        Start culling idle pods, if enabled
+        """
+        if self.cull_idle_timeout > 0 and self._task is None:
+            if self.cull_interval > self.cull_idle_timeout / 2:
+                self.log.warning(
+                    f'cull_interval of {self.cull_interval}s is too long for a cull_idle_timeout '
+                    f'of {self.cull_idle_timeout}s, using {self.cull_idle_timeout / 2}s'
+                )
+                self.cull_interval = self.cull_idle_timeout / 2
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _publish(self, pod, last_active):
+        path = f'/api/v1/namespaces/{self.namespace}/pods/{pod["metadata"]["name"]}'
+        timestamp = datetime.datetime.fromtimestamp(last_active, datetime.timezone.utc)
+        await KubeClient.instance().patch(path, {
+            'metadata': {'annotations': {LAST_ACTIVITY_ANNOTATION: timestamp.strftime('%Y-%m-%dT%H:%M:%SZ')}}
+        })
+
+    async def _cull(self, pod, idle):
+        name = pod['metadata']['name']
+        self.log.info(f'Deleting pod {name}, idle for {idle:.0f}s')
+        try:
+            await KubeClient.instance().delete(
+                f'/api/v1/namespaces/{self.namespace}/pods/{name}',
+                body={'preconditions': {'uid': pod['metadata']['uid']}}
+            )
+        except kubernetes.client.rest.ApiException as e:
+            if e.status not in (404, 409):
+                raise
+        self.pods.pop((self.namespace, name), None)
+
+    async def cull(self):
+        """
+        Delete user pods idle for longer than cull_idle_timeout.
+
+        Also publishes the last activity of pods in use here, so other
+        replicas don't cull them.
+        """
+        informer = PodInformer.for_namespace(self.namespace, parent=self)
+        if not informer.synced:
+            return
+        now = time.time()
+        for pod in list(informer.pods.values()):
+            metadata = pod['metadata']
+            if not (metadata.get('labels') or {}).get(USERNAME_LABEL) or metadata.get('deletionTimestamp'):
+                # Warm pool pods & pods on their way out
+                continue
+            last_active = self.last_active(pod)
+            if now - last_active > self.cull_idle_timeout and pod_is_running(pod):
+                await self._cull(pod, now - last_active)
+                continue
+            activity = self.pods.get((self.namespace, metadata['name']))
+            if activity is not None and activity.uid == metadata['uid'] and activity.published != last_active:
+                await self._publish(pod, last_active)
+                activity.published = last_active
+
+        # Forget pods that are gone
+        for key in [key for key in self.pods if key[0] == self.namespace and informer.get(key[1]) is None]:
+            del self.pods[key]
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.cull_interval)
+            try:
+                await self.cull()
+            except Exception:
+                self.log.exception('Culling idle pods failed')
@@ -0,0 +1,203 @@
+"""
+Streaming connections to pods over the Kubernetes websocket API.
+
+Implements the client side of the channel.k8s.io protocol used by the
+pods/exec and pods/portforward subresources, so we can talk to a container
+without spawning kubectl. Every websocket message is prefixed with a single
+byte saying which channel it belongs to.
+"""
+import asyncio
+import json
+
+import aiohttp
+
+from kubessh.kube import KubeClient
+
+STDIN_CHANNEL = 0
+STDOUT_CHANNEL = 1
+STDERR_CHANNEL = 2
+ERROR_CHANNEL = 3
+RESIZE_CHANNEL = 4
+# Only in v5.channel.k8s.io - used to half-close a channel
+CLOSE_CHANNEL = 255
+
+# Preferred first. v5 is the only one that can signal EOF on stdin.
+EXEC_PROTOCOLS = ('v5.channel.k8s.io', 'v4.channel.k8s.io')
+PORTFORWARD_PROTOCOLS = ('v4.channel.k8s.io',)
+
+
+def exit_code_from_status(status):
+    """
+    Return process exit code from a metav1.Status sent on the error channel
+    """
+    if status.get('status') == 'Success':
+        return 0
+    if status.get('reason') == 'NonZeroExitCode':
+        for cause in status.get('details', {}).get('causes', []):
+            if cause.get('reason') == 'ExitCode':
+                return int(cause['message'])
+    # Some other failure - the process possibly never started
+    return 1
+
+
+class ExecStream:
+    """
+    A process being run in a container via the pods/exec websocket API.
+
+    Iterate over it to get (channel, data) tuples for output. The process's
+    exit code is available as `exit_code` once iteration finishes.
+    """
+    def __init__(self, ws):
+        self.ws = ws
+        self.exit_code = None
+        self.error = None
+
+    @classmethod
+    async def connect(cls, namespace, pod_name, container, command, tty):
+        params = [
+            ('container', container),
+            ('stdin', 'true'),
+            ('stdout', 'true'),
+            # stderr is merged into stdout when there is a tty
+            ('stderr', 'false' if tty else 'true'),
+            ('tty', 'true' if tty else 'false'),
+        ] + [('command', c) for c in command]
+        ws = await KubeClient.instance().ws_connect(
+            f'/api/v1/namespaces/{namespace}/pods/{pod_name}/exec',
+            params, EXEC_PROTOCOLS
+        )
+        return cls(ws)
+
+    @property
+    def can_close_stdin(self):
+        return self.ws.protocol == 'v5.channel.k8s.io'
+
+    async def write_stdin(self, data):
+        await self.ws.send_bytes(bytes([STDIN_CHANNEL]) + data)
+
+    async def close_stdin(self):
+        """
+        Signal EOF on the process's stdin.
+
+        v4.channel.k8s.io has no way to do that, so the whole stream is
+        closed instead - otherwise a process reading stdin to the end would
+        wait forever. Anything it writes after that is lost.
+        """
+        if self.can_close_stdin:
+            await self.ws.send_bytes(bytes([CLOSE_CHANNEL, STDIN_CHANNEL]))
+        else:
+            await self.close()
+
+    async def resize(self, width, height):
+        size = json.dumps({'Width': width, 'Height': height}).encode()
+        await self.ws.send_bytes(bytes([RESIZE_CHANNEL]) + size)
+
+    async def close(self):
+        await self.ws.close()
+
+    def __aiter__(self):
+        return self._messages()
+
+    async def _messages(self):
+        async for msg in self.ws:
+            if msg.type != aiohttp.WSMsgType.BINARY or not msg.data:
+                continue
+            channel, data = msg.data[0], msg.data[1:]
+            if channel == ERROR_CHANNEL:
+                self.error = json.loads(data)
+                self.exit_code = exit_code_from_status(self.error)
+            elif data:
+                # The API server sends an empty message on each channel when
+                # it opens the stream, which we can ignore.
+                yield channel, data
+        if self.exit_code is None:
+            # Connection closed without telling us how the process exited
+            self.exit_code = 1
+
+
+class PortForwardStream:
+    """
+    A single TCP connection to a port in a pod, via the pods/portforward
+    websocket API.
+
+    Behaves enough like an asyncio StreamReader & StreamWriter at the same
+    time to be used with kubessh.relay.relay.
+    """
+    DATA_CHANNEL = 0
+    ERROR_CHANNEL = 1
+
+    def __init__(self, ws, port):
+        self.ws = ws
+        self.port = port
+        self._buffer = b''
+        self._pending = []
+        self._eof = False
+        self._close_task = None
+        # The first message on each channel is just the port number
+        self._port_prefix_seen = set()
+
+    @classmethod
+    async def connect(cls, namespace, pod_name, port):
+        ws = await KubeClient.instance().ws_connect(
+            f'/api/v1/namespaces/{namespace}/pods/{pod_name}/portforward',
+            [('ports', str(port))], PORTFORWARD_PROTOCOLS
+        )
+        return cls(ws, port)
+
+    async def _receive(self):
+        """
+        Return next chunk of data from the pod, or b'' once the connection is closed
+        """
+        async for msg in self.ws:
+            if msg.type != aiohttp.WSMsgType.BINARY or not msg.data:
+                continue
+            channel, data = msg.data[0], msg.data[1:]
+            if channel not in self._port_prefix_seen:
+                self._port_prefix_seen.add(channel)
+                data = data[2:]
+            if not data:
+                continue
+            if channel == self.ERROR_CHANNEL:
+                raise ConnectionError(f'Port forward to {self.port} failed: {data.decode(errors="replace")}')
+            return data
+        return b''
+
+    async def read(self, n=-1):
+        if not self._buffer and not self._eof:
+            self._buffer = await self._receive()
+            self._eof = not self._buffer
+        if n < 0:
+            n = len(self._buffer)
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+    def at_eof(self):
+        return self._eof and not self._buffer
+
+    def write(self, data):
+        self._pending.append(data)
+
+    async def drain(self):
+        pending, self._pending = self._pending, []
+        for data in pending:
+            await self.ws.send_bytes(bytes([self.DATA_CHANNEL]) + data)
+
+    def can_write_eof(self):
+        # The portforward protocol has no way to half-close a connection
+        return False
+
+    def write_eof(self):
+        # Never called, since can_write_eof() is False. relay() closes the
+        # whole connection instead, once the client side is done.
+        pass
+
+    def close(self):
+        """
+        Start closing the connection. Await wait_closed() for it to finish.
+        """
+        if self._close_task is None and not self.ws.closed:
+            self._close_task = asyncio.ensure_future(self.ws.close())
+
+    async def wait_closed(self):
+        if self._close_task is not None:
+            await self._close_task
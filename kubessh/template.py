@@ -0,0 +1,93 @@
+"""
+Pod & PVC templates, compiled for fast per-user expansion.
+
+Templates are plain dicts with '{username}' style placeholders in some of
+their strings. Walking the whole template and formatting every string on
+every spawn is wasted work, since most of a template never changes. A
+CompiledTemplate remembers which strings have placeholders in them, and
+expansion only formats & copies those - everything else is shared with the
+template.
+
+Expanded objects share structure with the template and with each other, so
+they must never be modified in place.
+"""
+from collections import OrderedDict
+
+
+def _placeholder_paths(src):
+    """
+    Return a trie of the paths in src leading to strings with placeholders.
+
+    Dicts & lists map the keys / indexes of children with placeholders in
+    them to their own tries. Strings with placeholders are True. Returns
+    None if src has no placeholders.
+    """
+    if isinstance(src, str):
+        return True if '{' in src or '}' in src else None
+    if isinstance(src, dict):
+        children = src.items()
+    elif isinstance(src, list):
+        children = enumerate(src)
+    else:
+        return None
+    paths = {}
+    for key, child in children:
+        child_paths = _placeholder_paths(child)
+        if child_paths is not None:
+            paths[key] = child_paths
+    return paths or None
+
+
+def _expand(src, paths, values):
+    if paths is True:
+        return src.format(**values)
+    expanded = src.copy()
+    for key, child_paths in paths.items():
+        expanded[key] = _expand(src[key], child_paths, values)
+    return expanded
+
+
+class CompiledTemplate:
+    """
+    A template, with the locations of its placeholders worked out.
+    """
+    def __init__(self, template):
+        self.template = template
+        self.paths = _placeholder_paths(template)
+
+    def expand(self, **values):
+        """
+        Return template with placeholders filled in from values.
+
+        Parts of the template without placeholders are shared with the
+        result, not copied.
+        """
+        if self.paths is None:
+            return self.template
+        return _expand(self.template, self.paths, values)
+
+
+class LRUCache:
+    """
+    Dict-like cache holding at most maxsize items, dropping least recently used ones
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+
+    def get(self, key, make):
+        """
+        Return item for key, calling make() to create it if needed
+        """
+        try:
+            self._items.move_to_end(key)
+            return self._items[key]
+        except KeyError:
+            pass
+        item = self._items[key] = make()
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+        return item
+
+    def __len__(self):
+        return len(self._items)
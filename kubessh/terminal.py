@@ -0,0 +1,164 @@
+"""
+Child processes on pseudo terminals, driven entirely by the event loop.
+
+The master side of the terminal is non-blocking, and is only read or written
+when the event loop says it is ready. Children are reaped when their pidfd
+becomes readable. No thread is needed per terminal, however many are open.
+"""
+import asyncio
+import errno
+import fcntl
+import os
+import pty
+import signal
+import struct
+import termios
+
+# Read up to this many bytes of terminal output at a time
+TERMINAL_READ_SIZE = 64 * 1024
+
+
+async def _wait_ready(fd, write=False):
+    """
+    Wait until fd is readable (or writable, if write is True)
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def ready():
+        if not future.done():
+            future.set_result(None)
+
+    if write:
+        loop.add_writer(fd, ready)
+    else:
+        loop.add_reader(fd, ready)
+    try:
+        await future
+    finally:
+        if write:
+            loop.remove_writer(fd)
+        else:
+            loop.remove_reader(fd)
+
+
+def _set_size(fd, width, height):
+    fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack('HHHH', height, width, 0, 0))
+
+
+class Terminal:
+    """
+    A child process running on its own pseudo terminal.
+
+    Start one with `Terminal.spawn`.
+    """
+    def __init__(self, pid, fd):
+        self.pid = pid
+        # Master side of the terminal
+        self.fd = fd
+        os.set_blocking(fd, False)
+        self.exit_code = None
+        self._reaper = None
+
+    @classmethod
+    def spawn(cls, argv, width, height):
+        """
+        Start argv on a new terminal of the given size.
+
+        The terminal is the child's controlling terminal, so it gets SIGWINCH
+        when resized, and SIGHUP when the terminal is closed.
+        """
+        pid, fd = pty.fork()
+        if pid == 0:
+            # In the child, with the terminal as stdin, stdout & stderr
+            try:
+                _set_size(0, width, height)
+                os.execvp(argv[0], argv)
+            except OSError as e:
+                os.write(2, f'Could not run {argv[0]}: {e.strerror}\r\n'.encode())
+            os._exit(127)
+        return cls(pid, fd)
+
+    def resize(self, width, height):
+        _set_size(self.fd, width, height)
+
+    async def read(self, size=TERMINAL_READ_SIZE):
+        """
+        Return output from the terminal, or b'' once nothing can write to it anymore
+        """
+        while True:
+            try:
+                return os.read(self.fd, size)
+            except BlockingIOError:
+                await _wait_ready(self.fd)
+            except OSError as e:
+                # Linux says EIO once every process has closed its side
+                if e.errno == errno.EIO:
+                    return b''
+                raise
+
+    async def write(self, data):
+        """
+        Write all of data to the terminal, waiting for room if it is full
+        """
+        data = memoryview(data)
+        while data:
+            try:
+                data = data[os.write(self.fd, data):]
+            except BlockingIOError:
+                await _wait_ready(self.fd, write=True)
+
+    async def wait(self):
+        """
+        Wait for the child to exit, returning its exit code.
+
+        Like in shells, children killed by a signal exit with 128 plus the
+        signal number.
+        """
+        if self._reaper is None:
+            self._reaper = asyncio.ensure_future(self._reap())
+        # Shielded, so giving up on waiting doesn't stop the child being reaped
+        return await asyncio.shield(self._reaper)
+
+    async def _reap(self):
+        try:
+            pidfd = os.pidfd_open(self.pid)
+        except (AttributeError, OSError):
+            # Not on Linux >= 5.3. Check back with a backoff instead.
+            pidfd = None
+        if pidfd is not None:
+            try:
+                await _wait_ready(pidfd)
+            finally:
+                os.close(pidfd)
+            _, status = os.waitpid(self.pid, 0)
+        else:
+            delay = 0.01
+            while True:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+                if pid:
+                    break
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1)
+        exit_code = os.waitstatus_to_exitcode(status)
+        self.exit_code = exit_code if exit_code >= 0 else 128 - exit_code
+        return self.exit_code
+
+    def close(self):
+        """
+        Hang up the terminal, which sends SIGHUP to the child
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    async def terminate(self, grace_period=1):
+        """
+        Hang up the terminal, and kill the child if it is still around after grace_period
+        """
+        self.close()
+        try:
+            return await asyncio.wait_for(self.wait(), grace_period)
+        except asyncio.TimeoutError:
+            os.kill(self.pid, signal.SIGKILL)
+            return await self.wait()
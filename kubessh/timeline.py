@@ -0,0 +1,121 @@
+"""
+Where the time goes while a user's pod starts.
+
+A cold start is an API call to create the pod, then waiting for the
+scheduler to find a node (and, with immediate binding, for PVCs to be
+bound), for the kubelet to attach & mount volumes, for the image to be
+pulled and for the container to start. SpawnTimeline records when each of
+these finished, as we hear about them from the pod's conditions and from
+the events Kubernetes posts about the pod.
+
+Times are when kubessh found out, by its own clock. Timestamps in events &
+conditions only have whole seconds, which is too coarse for most phases.
+"""
+import time
+
+# Phases of a cold start, in order, with the mark that ends each. A phase
+# starts where the one before it ended.
+PHASES = [
+    ('create', 'created'),
+    ('scheduling', 'scheduled'),
+    ('volumes', 'pulling'),
+    ('image_pull', 'pulled'),
+    ('container_start', 'running'),
+]
+
+# What we are waiting for, after each mark
+WAITING_FOR = {
+    None: 'Creating your pod',
+    'created': 'Waiting for a node',
+    'scheduled': 'Setting up volumes',
+    'pulling': 'Pulling image',
+    'pulled': 'Starting container',
+    'running': 'Ready',
+}
+
+# Event reasons worth showing to someone waiting for their pod
+WARNING_REASONS = {
+    'FailedScheduling', 'FailedAttachVolume', 'FailedMount', 'Failed', 'BackOff', 'ErrImagePull',
+}
+
+
+class SpawnTimeline:
+    """
+    Marks reached while a pod starts, in seconds since the spawn started.
+    """
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        # mark -> seconds after started
+        self.marks = {}
+        # Latest problem Kubernetes reported since the last mark, if any
+        self.warning = None
+
+    def elapsed(self):
+        return self.clock() - self.started
+
+    def mark(self, name, latest=False):
+        """
+        Record that name was reached now.
+
+        Only the first time counts, unless latest is True.
+        """
+        if name not in self.marks or latest:
+            self.marks[name] = self.elapsed()
+            self.warning = None
+
+    def update_from_pod(self, pod):
+        """
+        Record marks from pod's status conditions
+        """
+        for condition in pod.get('status', {}).get('conditions') or []:
+            if condition['type'] == 'PodScheduled' and condition['status'] == 'True':
+                self.mark('scheduled')
+
+    def update_from_event(self, event):
+        """
+        Record marks from a Kubernetes event about the pod
+        """
+        reason = event.get('reason')
+        if reason == 'Scheduled':
+            self.mark('scheduled')
+        elif reason == 'Pulling':
+            self.mark('pulling')
+        elif reason == 'Pulled':
+            # Images already on the node are 'Pulled' without any 'Pulling'
+            self.mark('pulling')
+            # With more than one image, pulling is done when the last one is
+            self.mark('pulled', latest=True)
+        elif reason in WARNING_REASONS:
+            self.warning = event.get('message') or reason
+
+    def phases(self):
+        """
+        Return dict of phase name to seconds spent in it, in order.
+
+        Phases whose start or end we didn't hear about are left out.
+        """
+        phases = {}
+        previous = 0
+        for phase, end in PHASES:
+            if end not in self.marks:
+                previous = None
+                continue
+            if previous is not None:
+                phases[phase] = max(self.marks[end] - previous, 0)
+            previous = self.marks[end]
+        return phases
+
+    def describe(self):
+        """
+        Return a line saying what the spawn is waiting for, and for how long
+        """
+        last = None
+        for _, end in PHASES:
+            if end in self.marks and (last is None or self.marks[end] >= self.marks[last]):
+                last = end
+        waited = self.elapsed() - self.marks.get(last, 0)
+        line = f'{WAITING_FOR[last]} ({waited:.0f}s)'
+        if self.warning:
+            line += f': {self.warning}'
+        return line
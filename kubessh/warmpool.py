@@ -0,0 +1,284 @@
+"""
+Pool of pre-started pods that users can be given at login.
+
+Starting a pod means scheduling, possibly pulling an image, and starting
+containers - all while the user stares at a spinner. The warm pool keeps a
+number of generic pods made from UserPod.pod_template running ahead of time.
+When a user without a pod logs in, one of these is handed over to them by
+relabelling it, and the pool is topped up again in the background.
+
+Pool pods carry the kubessh username label with an empty value, so the pod
+informer keeps track of them along with user pods.
+
+Every kubessh replica can claim pool pods. With leader_election, only the
+replica holding the pool's Lease tops it up, so replicas don't all start
+pods to fill the same gap.
+"""
+import asyncio
+import datetime
+import json
+
+import kubernetes
+from traitlets.config import SingletonConfigurable
+from traitlets import Bool, Integer, List, Float, Unicode
+
+from kubessh.informer import PodInformer, USERNAME_LABEL
+from kubessh.kube import KubeClient
+from kubessh.lease import Lease
+from kubessh.pod import UserPod, pod_is_running
+from kubessh.template import CompiledTemplate
+
+
+def _parse_time(value):
+    return datetime.datetime.strptime(value, '%H:%M').time()
+
+
+class WarmPool(SingletonConfigurable):
+    """
+    Keeps a configurable number of unclaimed, running user pods around.
+
+    Get it with `WarmPool.instance()`.
+    """
+    namespace = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Kubernetes Namespace the pool's pods are started in.
+        """,
+    )
+
+    size = Integer(
+        0,
+        help="""
+        Number of unclaimed pods to keep running.
+
+        Used whenever no entry in size_schedule applies. Set to 0 (the default)
+        to disable the pool. The pool can only be used when the pod template
+        doesn't depend on the username and pvc_templates is empty, since pool
+        pods are started before we know who will use them.
+        """,
+        config=True
+    )
+
+    size_schedule = List(
+        [],
+        help="""
+        Pool sizes for specific times of day.
+
+        A list of dicts with 'start' and 'end' times ('HH:MM', in the server's
+        local time) and the 'size' to use between them, like:
+
+            [{"start": "08:00", "end": "18:00", "size": 20}]
+
+        Periods may wrap around midnight. The first matching entry wins.
+        """,
+        config=True
+    )
+
+    refill_interval = Float(
+        10,
+        help="""
+        Seconds between checks that the pool has the right number of pods.
+
+        The pool is also checked right after every claim.
+        """,
+        config=True
+    )
+
+    leader_election = Bool(
+        False,
+        help="""
+        Only refill the pool from the kubessh replica holding a Lease.
+
+        Turn this on when running more than one replica, so they don't each
+        start pods to make up for the same shortfall. Requires permission to
+        manage leases in the namespace.
+        """,
+        config=True
+    )
+
+    lease_name = Unicode(
+        'kubessh-warm-pool',
+        help="""
+        Name of the Lease used for leader_election.
+        """,
+        config=True
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.claims = 0
+        self.misses = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def target_size(self, now=None):
+        """
+        Return the number of pods the pool should have at time now
+        """
+        now = (now or datetime.datetime.now()).time()
+        for entry in self.size_schedule:
+            start, end = _parse_time(entry['start']), _parse_time(entry['end'])
+            if start <= end:
+                matches = start <= now < end
+            else:
+                matches = now >= start or now < end
+            if matches:
+                return entry['size']
+        return self.size
+
+    def make_pod_spec(self):
+        """
+        Return request body for creating a pool pod.
+
+        The pod template expanded for an empty username, the username label
+        pool pods carry.
+        """
+        template = UserPod.configured(self.config, 'pod_template')
+        spec = CompiledTemplate(template).expand(username='')
+        metadata = {k: v for k, v in (spec.get('metadata') or {}).items() if k != 'name'}
+        metadata['labels'] = {**(metadata.get('labels') or {}), USERNAME_LABEL: ''}
+        metadata['generateName'] = 'ssh-pool-'
+        return {**spec, 'metadata': metadata}
+
+    @property
+    def enabled(self):
+        return self.size > 0 or any(entry['size'] > 0 for entry in self.size_schedule)
+
+    def usable(self):
+        """
+        Return True if pool pods could be handed to any user
+        """
+        return (
+            not UserPod.configured(self.config, 'pvc_templates')
+            and '{username}' not in json.dumps(UserPod.configured(self.config, 'pod_template'))
+        )
+
+    @property
+    def informer(self):
+        return PodInformer.for_namespace(self.namespace, parent=self)
+
+    def unclaimed_pods(self):
+        """
+        Return list of pool pods that are starting or running
+        """
+        return [
+            pod for pod in self.informer.pods.values()
+            if pod['metadata'].get('labels', {}).get(USERNAME_LABEL) == ''
+            and not pod['metadata'].get('deletionTimestamp')
+            and pod.get('status', {}).get('phase') not in ('Failed', 'Succeeded')
+        ]
+
+    def stats(self):
+        """
+        Return a dict describing the state of the pool.
+        """
+        pods = self.unclaimed_pods()
+        ready = sum(1 for pod in pods if pod_is_running(pod))
+        return {
+            'target': self.target_size(),
+            'ready': ready,
+            'starting': len(pods) - ready,
+            'claims': self.claims,
+            'misses': self.misses,
+        }
+
+    def start(self):
+        """
+        Start keeping the pool filled, if it is enabled & usable
+        """
+        if not self.enabled or self._task is not None:
+            return
+        if not self.usable():
+            self.log.warning('Warm pool disabled, since the pod template depends on the username or pvc_templates are set')
+            return
+        self._task = asyncio.ensure_future(self._run())
+
+    async def claim(self, user_pod):
+        """
+        Try to give a running pool pod to user_pod's user.
+
+        The claim is a JSON patch that only applies if the pod is still
+        unclaimed, so concurrent claims (even from other kubessh replicas)
+        can never hand the same pod to two users. Returns the claimed pod,
+        or None if no pool pod was available.
+        """
+        if self._task is None:
+            return None
+        kube = KubeClient.instance()
+        label_path = '/metadata/labels/' + USERNAME_LABEL.replace('/', '~1')
+        patch = [
+            {'op': 'test', 'path': label_path, 'value': ''},
+            {'op': 'replace', 'path': label_path, 'value': user_pod.required_labels[USERNAME_LABEL]},
+        ]
+        try:
+            for pod in self.unclaimed_pods():
+                if not pod_is_running(pod):
+                    continue
+                try:
+                    claimed = await kube.patch(
+                        f'/api/v1/namespaces/{self.namespace}/pods/{pod["metadata"]["name"]}',
+                        patch, content_type='application/json-patch+json'
+                    )
+                except kubernetes.client.rest.ApiException as e:
+                    if e.status in (404, 409, 422):
+                        # Deleted or claimed by someone else since we last looked
+                        continue
+                    raise
+                self.informer.record(claimed)
+                self.claims += 1
+                self.log.info(f'Gave pool pod {claimed["metadata"]["name"]} to {user_pod.username}')
+                return claimed
+            self.misses += 1
+            return None
+        finally:
+            self._wakeup.set()
+
+    async def _reconcile(self):
+        if not self.informer.synced:
+            return
+        kube = KubeClient.instance()
+        path = f'/api/v1/namespaces/{self.namespace}/pods'
+        target = self.target_size()
+        pods = self.unclaimed_pods()
+
+        if len(pods) < target:
+            spec = self.make_pod_spec()
+            self.log.debug(f'Starting {target - len(pods)} pool pods')
+            created = await asyncio.gather(
+                *[kube.create(path, spec) for _ in range(target - len(pods))],
+                return_exceptions=True
+            )
+            for pod in created:
+                if isinstance(pod, Exception):
+                    self.log.warning(f'Starting pool pod failed: {pod}')
+                else:
+                    self.informer.record(pod)
+        elif len(pods) > target:
+            # Shrink, getting rid of pods that aren't running yet first
+            pods.sort(key=pod_is_running)
+            for pod in pods[:len(pods) - target]:
+                self.log.debug(f'Removing pool pod {pod["metadata"]["name"]}')
+                try:
+                    await kube.delete(f'{path}/{pod["metadata"]["name"]}')
+                except kubernetes.client.rest.ApiException as e:
+                    if e.status != 404:
+                        raise
+
+    async def _run(self):
+        lease = None
+        if self.leader_election:
+            # Renewed every refill, so it only lapses if we miss a few
+            lease = Lease(self.namespace, self.lease_name, self.refill_interval * 3)
+        while True:
+            try:
+                if lease is None or await lease.acquire():
+                    await self._reconcile()
+                self.log.debug(f'Warm pool: {self.stats()}')
+            except Exception:
+                self.log.exception('Refilling warm pool failed')
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.refill_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
@@ -11,14 +11,18 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     install_requires=[
         'kubernetes',
-        'asyncssh',
-        'ptyprocess',
+        # kubessh.server.KubeSSHProcess mirrors asyncssh internals, so check
+        # it still matches asyncssh's SSHServerProcess before raising this
+        'asyncssh>=2.24,<2.25',
         'aiohttp',
         'traitlets',
         'escapism',
         'ruamel.yaml',
-        'simpervisor'
     ],
+    extras_require={
+        'metrics': ['prometheus_client'],
+        'uvloop': ['uvloop'],
+    },
     entry_points = {
         'console_scripts': [
             'kubessh=kubessh.app:main'
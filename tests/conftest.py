@@ -0,0 +1,61 @@
+"""
+Helpers shared between test modules
+"""
+from aiohttp import web
+from kubernetes import client as k
+from kubessh.informer import USERNAME_LABEL
+
+
+async def start_fake_api(app):
+    """
+    Serve app on a random port, and point the kubernetes client at it
+    """
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+
+    configuration = k.Configuration()
+    configuration.host = f'http://127.0.0.1:{runner.addresses[0][1]}'
+    k.Configuration.set_default(configuration)
+    return runner
+
+
+def make_pod(name, username, phase='Pending', resource_version='1', uid='uid-1'):
+    return {
+        'metadata': {
+            'name': name, 'uid': uid, 'resourceVersion': resource_version,
+            'labels': {USERNAME_LABEL: username}
+        },
+        'status': {'phase': phase}
+    }
+
+
+def make_pvc(name, username, resource_version='1', uid='uid-1'):
+    return {
+        'apiVersion': 'v1',
+        'kind': 'PersistentVolumeClaim',
+        'metadata': {
+            'name': name, 'uid': uid, 'resourceVersion': resource_version,
+            'labels': {USERNAME_LABEL: username}
+        },
+        'spec': {'accessModes': ['ReadWriteOnce'], 'resources': {'requests': {'storage': '1Gi'}}},
+        'status': {'phase': 'Bound'}
+    }
+
+
+def user_pod(name, username, uid, created='2020-01-01T00:00:00Z', annotations=None):
+    """
+    Return a running user pod, as the session registry sees them
+    """
+    pod = make_pod(name, username, phase='Running', uid=uid)
+    pod['metadata']['creationTimestamp'] = created
+    pod['metadata']['annotations'] = annotations or {}
+    return pod
+
+
+class FakeUserPod:
+    def __init__(self, pod):
+        self.namespace = 'cull-test'
+        self.pod_name = pod['metadata']['name']
+        self.pod = pod
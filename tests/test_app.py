@@ -0,0 +1,74 @@
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from kubessh.app import KubeSSH
+
+
+def test_import_without_kube_config():
+    """
+    Importing kubessh doesn't load kubernetes config or talk to anything
+    """
+    env = dict(os.environ, KUBECONFIG='/nonexistent')
+    env.pop('KUBERNETES_SERVICE_HOST', None)
+    subprocess.check_call(
+        [sys.executable, '-c', 'import kubessh.app, kubessh.cleanup, kubessh.serialization'],
+        env=env
+    )
+
+
+def test_ephemeral_host_key():
+    app = KubeSSH()
+    app.init_host_key()
+    assert app.ssh_host_key.get_algorithm() == 'ssh-ed25519'
+
+    app.host_key_type = 'ssh-rsa'
+    app.init_host_key()
+    assert app.ssh_host_key.get_algorithm() == 'ssh-rsa'
+
+
+def test_supervise(monkeypatch):
+    """
+    Workers are stopped with SIGTERM, leaving other children alone, and
+    the key cache made for them is removed
+    """
+    app = KubeSSH(workers=2)
+    app.workers_cache_dir = None
+    app.init_workers()
+    cache_dir = app.workers_cache_dir
+    assert os.path.isdir(cache_dir)
+
+    def start_worker(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            time.sleep(30)
+            os._exit(0)
+        return pid
+    monkeypatch.setattr(app, 'start_worker', start_worker)
+
+    other = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(0.5)'])
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGUSR1, signal.SIGUSR2)}
+    threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGTERM)).start()
+    try:
+        app.supervise()
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+    assert not os.path.exists(cache_dir)
+    assert other.wait() == 0
+
+
+def test_command_line():
+    """
+    --workers is added to the aliases Application has
+    """
+    app = KubeSSH()
+    app.parse_command_line(['--log-level=DEBUG', '--workers=2'])
+    assert app.log_level == logging.DEBUG
+    assert app.workers == 2
@@ -0,0 +1,90 @@
+import asyncio
+import json
+import logging
+
+from aiohttp import web
+from kubessh.cleanup import KubeSanitation, _finished_at
+from kubessh.kube import KubeClient
+from conftest import start_fake_api
+
+
+def finished_pod(name):
+    return {
+        'metadata': {'name': name, 'uid': f'uid-{name}', 'resourceVersion': '10'},
+        'status': {
+            'phase': 'Succeeded',
+            'containerStatuses': [{'state': {'terminated': {'finishedAt': '2020-01-01T00:00:00Z'}}}],
+        },
+    }
+
+
+def test_finished_at():
+    assert _finished_at(finished_pod('ssh-yuvi')).year == 2020
+    assert _finished_at({'status': {}}) is None
+
+
+def test_cleanup():
+    """
+    Finished pods are found by paging through lists & by watching
+    """
+    async def run():
+        deleted = []
+        params = []
+        done = asyncio.Event()
+
+        async def pods(request):
+            params.append(dict(request.query))
+            if request.query.get('watch'):
+                response = web.StreamResponse()
+                await response.prepare(request)
+                event = {'type': 'ADDED', 'object': finished_pod('ssh-watched')}
+                await response.write(json.dumps(event).encode() + b'\n')
+                await done.wait()
+                return response
+            if request.query.get('continue') == 'page-2':
+                return web.json_response({'metadata': {'resourceVersion': '5'}, 'items': [finished_pod('ssh-b')]})
+            return web.json_response({
+                'metadata': {'resourceVersion': '5', 'continue': 'page-2'},
+                'items': [finished_pod('ssh-a')],
+            })
+
+        async def delete(request):
+            deleted.append((request.match_info['name'], (await request.json())['preconditions']['uid']))
+            return web.json_response({})
+
+        app = web.Application()
+        app.router.add_get('/api/v1/namespaces/default/pods', pods)
+        app.router.add_delete('/api/v1/namespaces/default/pods/{name}', delete)
+        runner = await start_fake_api(app)
+
+        cleanup = KubeSanitation(namespace='default', page_size=1)
+        cleanup.kube = KubeClient.instance()
+        task = asyncio.ensure_future(cleanup.start())
+        for _ in range(100):
+            if len(deleted) == 3:
+                break
+            await asyncio.sleep(0.05)
+        task.cancel()
+        done.set()
+
+        assert sorted(deleted) == [('ssh-a', 'uid-ssh-a'), ('ssh-b', 'uid-ssh-b'), ('ssh-watched', 'uid-ssh-watched')]
+        assert params[0]['limit'] == '1'
+        assert params[0]['fieldSelector'] == 'status.phase=Succeeded'
+        assert params[2]['resourceVersion'] == '5'
+        assert len(cleanup.deletion_lags) == 3
+
+        await KubeClient.instance().close()
+        await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_log_level(monkeypatch):
+    """
+    Deletion lag reports at info level make it through the log handler
+    """
+    monkeypatch.setattr('kubessh.cleanup.load_config', lambda: None)
+    for debug, level in ((False, logging.INFO), (True, logging.DEBUG)):
+        cleanup = KubeSanitation(debug=debug)
+        cleanup.initialize([])
+        assert [handler.level for handler in cleanup.log.handlers] == [level]
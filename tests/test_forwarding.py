@@ -0,0 +1,25 @@
+from kubessh.forwarding import PortForwarder
+from kubessh.informer import PodInformer
+from conftest import make_pod
+
+
+def test_running_pod_cache():
+    """
+    Forwards skip the spawn while the pod they last went to is running
+    """
+    informer = PodInformer(namespace='forward-test')
+    informer._replace([make_pod('ssh-pool-abcde', 'yuvi', phase='Running', uid='uid-1')])
+    PodInformer._instances['forward-test'] = informer
+    try:
+        forwarder = PortForwarder()
+        assert forwarder.running_pod('forward-test', 'ssh-yuvi') is None
+
+        forwarder.pods['forward-test', 'ssh-yuvi'] = ('ssh-pool-abcde', 'uid-1')
+        assert forwarder.running_pod('forward-test', 'ssh-yuvi')['metadata']['uid'] == 'uid-1'
+
+        # A new pod with the same name isn't the one we know is running
+        informer._replace([make_pod('ssh-pool-abcde', 'yuvi', phase='Pending', uid='uid-2')])
+        assert forwarder.running_pod('forward-test', 'ssh-yuvi') is None
+        assert forwarder.pods == {}
+    finally:
+        del PodInformer._instances['forward-test']
@@ -0,0 +1,56 @@
+import asyncio
+from kubessh.informer import PodInformer
+from kubessh.pod import pod_is_running
+from conftest import make_pod
+
+
+def test_index_by_name_and_user():
+    """
+    Pods are indexed by name & username label once synced
+    """
+    informer = PodInformer(namespace='default')
+    assert informer.get('ssh-yuvi') is None
+
+    informer._replace([make_pod('ssh-yuvi', 'yuvi')])
+    assert informer.get('ssh-yuvi')['metadata']['name'] == 'ssh-yuvi'
+    assert informer.get_by_user('yuvi')['metadata']['name'] == 'ssh-yuvi'
+
+    informer._apply('DELETED', make_pod('ssh-yuvi', 'yuvi', resource_version='2'))
+    assert informer.get('ssh-yuvi') is None
+    assert informer.get_by_user('yuvi') is None
+
+
+def test_stale_objects_ignored():
+    """
+    Objects older than what we have cached don't replace it
+    """
+    informer = PodInformer(namespace='default')
+    informer._replace([make_pod('ssh-yuvi', 'yuvi', phase='Running', resource_version='5')])
+
+    informer.record(make_pod('ssh-yuvi', 'yuvi', phase='Pending', resource_version='3'))
+    assert informer.get('ssh-yuvi')['status']['phase'] == 'Running'
+
+    # A new pod with the same name is never stale
+    informer.record(make_pod('ssh-yuvi', 'yuvi', resource_version='1', uid='uid-2'))
+    assert informer.get('ssh-yuvi')['metadata']['uid'] == 'uid-2'
+
+
+def test_wait_for_change():
+    """
+    Waiters are woken up by events for the pod they are waiting on
+    """
+    async def run():
+        informer = PodInformer(namespace='default')
+        informer._replace([make_pod('ssh-yuvi', 'yuvi')])
+
+        loop = asyncio.get_event_loop()
+        loop.call_soon(informer._apply, 'MODIFIED', make_pod('ssh-yuvi', 'yuvi', phase='Running', resource_version='2'))
+        pod = await informer.wait_for_change('ssh-yuvi', timeout=5)
+        assert pod_is_running(pod)
+
+        # Without any events, we get the cached pod back after the timeout
+        pod = await informer.wait_for_change('ssh-yuvi', timeout=0.01)
+        assert pod['metadata']['resourceVersion'] == '2'
+        assert informer._waiters == {}
+
+    asyncio.run(run())
@@ -0,0 +1,97 @@
+import asyncio
+
+from aiohttp import web
+from kubessh.authentication.keycache import AuthorizedKeysCache
+
+KEY = 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIOMqqnkVzrm0SdG6UOoqKLsabgH5C9okWi0dh2l9GKJl'
+
+
+async def start_key_server(app):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, f'http://127.0.0.1:{runner.addresses[0][1]}'
+
+
+def test_key_cache():
+    """
+    Keys are fetched once, shared, refreshed when stale & kept if upstream fails
+    """
+    async def run():
+        state = {'fetches': 0, 'fail': False}
+
+        async def keys(request):
+            state['fetches'] += 1
+            await asyncio.sleep(0.05)
+            if state['fail']:
+                raise web.HTTPServiceUnavailable()
+            if request.match_info['username'] == 'nobody':
+                raise web.HTTPNotFound()
+            return web.Response(text=KEY + '\n')
+        app = web.Application()
+        app.router.add_get('/{username}.keys', keys)
+        runner, url = await start_key_server(app)
+
+        cache = AuthorizedKeysCache(ttl=60, negative_ttl=60)
+        # Concurrent logins share a single fetch
+        results = await asyncio.gather(*[cache.get(f'{url}/yuvi.keys') for _ in range(10)])
+        assert state['fetches'] == 1
+        assert all(r is results[0] and r is not None for r in results)
+
+        # Fresh keys are served from the cache
+        assert await cache.get(f'{url}/yuvi.keys') is results[0]
+        assert state['fetches'] == 1
+
+        # Missing users are remembered too
+        assert await cache.get(f'{url}/nobody.keys') is None
+        assert await cache.get(f'{url}/nobody.keys') is None
+        assert state['fetches'] == 2
+
+        # Stale keys are served right away, and refreshed in the background
+        cache.ttl = 0
+        assert await cache.get(f'{url}/yuvi.keys') is results[0]
+        await asyncio.sleep(0.1)
+        assert state['fetches'] == 3
+
+        # Too old keys are still used if upstream is failing
+        cache.max_stale = 0
+        state['fail'] = True
+        assert await cache.get(f'{url}/yuvi.keys') is not None
+        assert state['fetches'] == 4
+
+        await cache.close()
+        await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_key_cache_dir(tmp_path):
+    """
+    Caches sharing a cache_dir share their fetches
+    """
+    async def run():
+        fetches = []
+
+        async def keys(request):
+            fetches.append(request.match_info['username'])
+            if request.match_info['username'] == 'nobody':
+                raise web.HTTPNotFound()
+            return web.Response(text=KEY + '\n')
+        app = web.Application()
+        app.router.add_get('/{username}.keys', keys)
+        runner, url = await start_key_server(app)
+
+        first = AuthorizedKeysCache(cache_dir=str(tmp_path))
+        second = AuthorizedKeysCache(cache_dir=str(tmp_path))
+        assert await first.get(f'{url}/yuvi.keys') is not None
+        assert await second.get(f'{url}/yuvi.keys') is not None
+        assert await first.get(f'{url}/nobody.keys') is None
+        assert await second.get(f'{url}/nobody.keys') is None
+        assert fetches == ['yuvi', 'nobody']
+
+        await first.close()
+        await second.close()
+        await runner.cleanup()
+
+    asyncio.run(run())
@@ -0,0 +1,94 @@
+import asyncio
+
+from aiohttp import web
+from kubessh.kube import KubeClient
+from kubessh.lease import Lease
+from conftest import start_fake_api
+
+
+def fake_leases():
+    """
+    Return an aiohttp app storing leases, with optimistic concurrency
+    """
+    leases = {}
+
+    def conflict():
+        return web.json_response({'reason': 'Conflict'}, status=409)
+
+    async def create(request):
+        lease = await request.json()
+        name = lease['metadata']['name']
+        if name in leases:
+            return conflict()
+        lease['metadata']['resourceVersion'] = '1'
+        leases[name] = lease
+        return web.json_response(lease)
+
+    async def get(request):
+        name = request.match_info['name']
+        if name not in leases:
+            return web.json_response({'reason': 'NotFound'}, status=404)
+        return web.json_response(leases[name])
+
+    async def replace(request):
+        lease = await request.json()
+        current = leases.get(request.match_info['name'])
+        if current is None or current['metadata']['resourceVersion'] != lease['metadata']['resourceVersion']:
+            return conflict()
+        lease['metadata']['resourceVersion'] = str(int(lease['metadata']['resourceVersion']) + 1)
+        leases[lease['metadata']['name']] = lease
+        return web.json_response(lease)
+
+    async def delete(request):
+        name = request.match_info['name']
+        preconditions = (await request.json())['preconditions']
+        if leases[name]['metadata']['resourceVersion'] != preconditions['resourceVersion']:
+            return conflict()
+        del leases[name]
+        return web.json_response({})
+
+    path = '/apis/coordination.k8s.io/v1/namespaces/default/leases'
+    app = web.Application()
+    app.router.add_post(path, create)
+    app.router.add_get(path + '/{name}', get)
+    app.router.add_put(path + '/{name}', replace)
+    app.router.add_delete(path + '/{name}', delete)
+    return app, leases
+
+
+def test_lease():
+    """
+    Only one holder at a time, until the lease expires or is released
+    """
+    async def run():
+        app, leases = fake_leases()
+        runner = await start_fake_api(app)
+
+        first = Lease('default', 'ssh-yuvi', 30, identity='replica-1')
+        second = Lease('default', 'ssh-yuvi', 30, identity='replica-2')
+        assert await first.acquire()
+        assert not await second.acquire()
+        # Renewing doesn't need the API server until a third of the lease is up
+        assert await first.acquire()
+        assert leases['ssh-yuvi']['metadata']['resourceVersion'] == '1'
+        first._renewed -= 20
+        assert await first.acquire()
+        assert leases['ssh-yuvi']['metadata']['resourceVersion'] == '2'
+
+        # Expired leases can be taken over
+        leases['ssh-yuvi']['spec']['renewTime'] = '2020-01-01T00:00:00.000000Z'
+        assert await second.acquire()
+        assert leases['ssh-yuvi']['spec']['holderIdentity'] == 'replica-2'
+        assert leases['ssh-yuvi']['spec']['leaseTransitions'] == 1
+
+        # Releasing a lease someone else took over leaves it alone
+        await first.release()
+        assert 'ssh-yuvi' in leases
+        await second.release()
+        assert leases == {}
+        assert await first.acquire()
+
+        await KubeClient.instance().close()
+        await runner.cleanup()
+
+    asyncio.run(run())
@@ -0,0 +1,41 @@
+import asyncio
+import logging
+import sys
+import time
+
+from kubessh.loopmonitor import LoopMonitor, collapse_stack
+
+
+def blocking_call():
+    time.sleep(0.3)
+
+
+def test_collapse_stack():
+    stack = collapse_stack(sys._getframe())
+    assert stack.endswith(';test_loopmonitor.py:test_collapse_stack')
+
+
+def test_stall_logged(caplog):
+    """
+    The stack of a call blocking the loop is logged, and shows up in profiles
+    """
+    async def run():
+        monitor = LoopMonitor(lag_interval=0.01, stall_threshold=0.1)
+        monitor.log = logging.getLogger('test_loopmonitor')
+        monitor.start()
+        await asyncio.sleep(0.05)
+
+        loop = asyncio.get_running_loop()
+        profile = loop.run_in_executor(None, monitor.profile, 0.2)
+        await asyncio.sleep(0.01)
+        blocking_call()
+        samples = await profile
+
+        await asyncio.sleep(0.05)
+        assert monitor.max_lag >= 0.2
+        assert any(stack.endswith('blocking_call') for stack in samples)
+        monitor.stop()
+
+    with caplog.at_level(logging.WARNING):
+        asyncio.run(run())
+    assert any('blocking_call' in record.getMessage() for record in caplog.records)
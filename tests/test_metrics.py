@@ -0,0 +1,26 @@
+import pytest
+
+prometheus_client = pytest.importorskip('prometheus_client')
+
+from kubessh.metrics import KubeSSHCollector
+from kubessh.sessions import SessionRegistry
+from conftest import FakeUserPod, user_pod
+
+
+def test_collector():
+    """
+    Session & byte counts are read from their owners when scraped
+    """
+    registry = SessionRegistry.instance(namespace='cull-test')
+    try:
+        pod = FakeUserPod(user_pod('ssh-yuvi', 'yuvi', 'uid-1'))
+        with registry.session(pod, 'shell') as session:
+            session.record(100)
+
+            metrics = {m.name: m for m in KubeSSHCollector().collect()}
+            sessions = {s.labels['kind']: s.value for s in metrics['kubessh_sessions'].samples}
+            assert sessions == {'shell': 1, 'sftp': 0, 'forward': 0}
+            relayed = {s.labels['kind']: s.value for s in metrics['kubessh_relayed_bytes'].samples if s.name.endswith('_total')}
+            assert relayed == {'shell': 100, 'sftp': 0, 'forward': 0}
+    finally:
+        SessionRegistry.clear_instance()
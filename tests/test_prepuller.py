@@ -0,0 +1,157 @@
+import asyncio
+
+from aiohttp import web
+from traitlets.config import Config, LoggingConfigurable
+
+from kubessh.kube import KubeClient
+from kubessh.prepuller import ImagePuller, PULLER_LABEL, PULL_COMMAND, SPEC_HASH_ANNOTATION
+from conftest import start_fake_api
+
+
+def make_puller(pod_template):
+    config = Config()
+    config.UserPod = Config({'pod_template': pod_template})
+    return ImagePuller(parent=LoggingConfigurable(config=config), namespace='default', enabled=True)
+
+
+def template(*images, **spec):
+    return {
+        'spec': {
+            'containers': [{'name': f'c{i}', 'image': image} for i, image in enumerate(images)],
+            **spec,
+        }
+    }
+
+
+def puller_pod(node, *states):
+    """
+    Return a puller pod with init containers in states.
+
+    A state with a 'state' key is a whole container status instead.
+    """
+    return {
+        'spec': {'nodeName': node},
+        'status': {
+            'initContainerStatuses': [
+                {'name': f'pull-{i}', **(state if 'state' in state else {'state': state})}
+                for i, state in enumerate(states)
+            ]
+        },
+    }
+
+
+def test_make_daemonset():
+    """
+    One init container per image, placed like user pods are.
+
+    Pull containers run a helper copied in first, so they don't depend on
+    what is in the images.
+    """
+    tolerations = [{'key': 'users', 'operator': 'Exists'}]
+    puller = make_puller(template(
+        'shell:1', 'sidecar:2', 'shell:1', 'home-{username}:1',
+        tolerations=tolerations,
+    ))
+    assert puller.images() == ['shell:1', 'sidecar:2']
+    daemonset = puller.make_daemonset()
+    pod_spec = daemonset['spec']['template']['spec']
+    helper, *pulls = pod_spec['initContainers']
+    assert helper['image'] == 'busybox:1.36'
+    assert helper['command'] == ['cp', '/bin/busybox', PULL_COMMAND]
+    assert [c['image'] for c in pulls] == ['shell:1', 'sidecar:2']
+    for container in pulls:
+        assert container['command'] == [PULL_COMMAND]
+        assert container['volumeMounts'] == helper['volumeMounts']
+    assert pod_spec['tolerations'] == tolerations
+    assert daemonset['spec']['selector']['matchLabels'] == {PULLER_LABEL: 'kubessh-image-puller'}
+
+    changed = make_puller(template('shell:2', 'sidecar:2', tolerations=tolerations)).make_daemonset()
+    assert changed['metadata']['annotations'][SPEC_HASH_ANNOTATION] != \
+        daemonset['metadata']['annotations'][SPEC_HASH_ANNOTATION]
+
+
+def test_node_state_and_place():
+    puller = make_puller(template('shell:1', 'sidecar:2'))
+    puller._update_nodes([
+        puller_pod('node-1', {'terminated': {'exitCode': 0}}, {'terminated': {'exitCode': 0}}),
+        puller_pod('node-2', {'terminated': {'exitCode': 0}}, {'waiting': {'reason': 'PodInitializing'}}),
+        puller_pod('node-3', {'waiting': {'reason': 'ImagePullBackOff', 'message': 'not found'}}),
+        # A failing pull container is retried forever, and the next never starts
+        puller_pod(
+            'node-4',
+            {'state': {'waiting': {'reason': 'CrashLoopBackOff'}}, 'lastState': {'terminated': {'exitCode': 127}}},
+        ),
+        # Not scheduled yet
+        {'spec': {}, 'status': {}},
+    ])
+    assert puller.stats() == {'pulled': 1, 'pulling': 1, 'failed': 2}
+    assert puller.cached_nodes() == ['node-1']
+    assert puller.nodes['node-4'] == {'shell:1': 'failed', 'sidecar:2': 'pulling'}
+
+    pod = {'spec': {'affinity': {'podAffinity': {}}, 'containers': []}}
+    placed = puller.place(pod)
+    assert pod == {'spec': {'affinity': {'podAffinity': {}}, 'containers': []}}
+    assert placed['spec']['affinity']['podAffinity'] == {}
+    [preference] = placed['spec']['affinity']['nodeAffinity']['preferredDuringSchedulingIgnoredDuringExecution']
+    assert preference['preference']['matchFields'][0]['values'] == ['node-1']
+
+    # No choice to make once every node has the images
+    puller.nodes = {'node-1': puller.nodes['node-1']}
+    assert puller.place(pod) is pod
+
+
+def test_sync():
+    """
+    DaemonSet is created, and only replaced when the template changes
+    """
+    daemonsets = {}
+    writes = []
+
+    async def get(request):
+        name = request.match_info['name']
+        if name not in daemonsets:
+            return web.json_response({'reason': 'NotFound'}, status=404)
+        return web.json_response(daemonsets[name])
+
+    async def create(request):
+        daemonset = await request.json()
+        daemonset['metadata']['resourceVersion'] = '1'
+        daemonsets[daemonset['metadata']['name']] = daemonset
+        writes.append('create')
+        return web.json_response(daemonset)
+
+    async def replace(request):
+        daemonset = await request.json()
+        assert daemonset['metadata']['resourceVersion'] == '1'
+        daemonsets[daemonset['metadata']['name']] = daemonset
+        writes.append('replace')
+        return web.json_response(daemonset)
+
+    async def list_pods(request):
+        assert request.query['labelSelector'] == f'{PULLER_LABEL}=kubessh-image-puller'
+        return web.json_response({'items': [puller_pod('node-1', {'running': {}})]})
+
+    async def run():
+        path = '/apis/apps/v1/namespaces/default/daemonsets'
+        app = web.Application()
+        app.router.add_get(path + '/{name}', get)
+        app.router.add_post(path, create)
+        app.router.add_put(path + '/{name}', replace)
+        app.router.add_get('/api/v1/namespaces/default/pods', list_pods)
+        runner = await start_fake_api(app)
+
+        await make_puller(template('shell:1')).sync()
+        puller = make_puller(template('shell:1'))
+        await puller.sync()
+        assert writes == ['create']
+        assert puller.nodes == {'node-1': {'shell:1': 'pulled'}}
+
+        await make_puller(template('shell:2')).sync()
+        assert writes == ['create', 'replace']
+        init_containers = daemonsets['kubessh-image-puller']['spec']['template']['spec']['initContainers']
+        assert [c['image'] for c in init_containers[1:]] == ['shell:2']
+
+        await KubeClient.instance().close()
+        await runner.cleanup()
+
+    asyncio.run(run())
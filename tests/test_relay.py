@@ -0,0 +1,117 @@
+import asyncio
+
+from kubessh.relay import relay
+
+
+async def echo(reader, writer):
+    while True:
+        data = await reader.read(1024)
+        if not data:
+            break
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+async def start_relay():
+    echo_server = await asyncio.start_server(echo, '127.0.0.1', 0)
+    echo_port = echo_server.sockets[0].getsockname()[1]
+
+    async def handle(reader, writer):
+        upstream_reader, upstream_writer = await asyncio.open_connection('127.0.0.1', echo_port)
+        await relay(reader, writer, upstream_reader, upstream_writer)
+
+    relay_server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return echo_server, relay_server, relay_server.sockets[0].getsockname()[1]
+
+
+def test_relay_half_close():
+    """
+    Data flows both ways, and EOF from the client reaches the upstream
+    """
+    async def run():
+        echo_server, relay_server, port = await start_relay()
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+        # Request / response without closing, like an interactive protocol
+        writer.write(b'ping')
+        assert await asyncio.wait_for(reader.readexactly(4), 1) == b'ping'
+
+        payload = b'x' * (1024 * 1024)
+        writer.write(payload)
+        writer.write_eof()
+        # The echo server only closes once it sees our EOF through the relay
+        assert await asyncio.wait_for(reader.read(), 5) == payload
+
+        writer.close()
+        echo_server.close()
+        relay_server.close()
+
+    asyncio.run(run())
+
+
+class NoEOFWriter:
+    """
+    Writer that can't half-close, like a port forward
+    """
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, data):
+        self.writer.write(data)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def can_write_eof(self):
+        return False
+
+    def close(self):
+        self.writer.close()
+
+
+def test_relay_without_half_close():
+    """
+    EOF from the client closes upstreams that can't half-close
+    """
+    async def run():
+        upstream_closed = asyncio.Event()
+
+        async def hold_open(reader, writer):
+            # Never closes on its own, like a server waiting for more requests
+            while await reader.read(1024):
+                pass
+            upstream_closed.set()
+
+        server = await asyncio.start_server(hold_open, '127.0.0.1', 0)
+        upstream_reader, upstream_writer = await asyncio.open_connection(
+            '127.0.0.1', server.sockets[0].getsockname()[1]
+        )
+
+        client_reader = asyncio.StreamReader()
+        client_reader.feed_data(b'ping')
+        client_reader.feed_eof()
+
+        class ClientWriter:
+            def write(self, data):
+                pass
+
+            async def drain(self):
+                pass
+
+            def can_write_eof(self):
+                return True
+
+            def write_eof(self):
+                pass
+
+            def close(self):
+                pass
+
+        await asyncio.wait_for(
+            relay(client_reader, ClientWriter(), upstream_reader, NoEOFWriter(upstream_writer)), 2
+        )
+        await asyncio.wait_for(upstream_closed.wait(), 2)
+        server.close()
+
+    asyncio.run(run())
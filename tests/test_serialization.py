@@ -0,0 +1,37 @@
+from kubernetes import client as k
+from kubessh.serialization import make_api_object_from_dict, _set_k8s_attribute, api_body
+
+
+def test_make_api_object_from_dict():
+    pod = make_api_object_from_dict({
+        'metadata': {'name': 'ssh-yuvi', 'labels': {'app': 'kubessh'}},
+        'spec': {'automountServiceAccountToken': False, 'containers': [{'name': 'shell', 'image': 'busybox'}]},
+    }, k.V1Pod)
+    assert isinstance(pod, k.V1Pod)
+    assert pod.metadata.labels == {'app': 'kubessh'}
+    assert pod.spec.automount_service_account_token is False
+    assert pod.spec.containers[0].image == 'busybox'
+
+
+def test_set_k8s_attribute():
+    """
+    Dicts are deep merged & lists appended, in place
+    """
+    pod = k.V1Pod(
+        metadata=k.V1ObjectMeta(name='ssh-yuvi', labels={'app': 'kubessh'}),
+        spec=k.V1PodSpec(containers=[k.V1Container(name='shell')]),
+    )
+    labels = pod.metadata.labels
+    _set_k8s_attribute(pod, 'metadata', {'labels': {'user': 'yuvi'}})
+    assert pod.metadata.labels is labels
+    assert labels == {'app': 'kubessh', 'user': 'yuvi'}
+
+    _set_k8s_attribute(pod.spec, 'containers', [k.V1Container(name='sidecar')])
+    _set_k8s_attribute(pod.spec, 'nodeName', 'node-1')
+    assert api_body(pod)['spec'] == {
+        'containers': [{'name': 'shell'}, {'name': 'sidecar'}],
+        'nodeName': 'node-1',
+    }
+
+    body = {'metadata': {'name': 'ssh-yuvi'}}
+    assert api_body(body) is body
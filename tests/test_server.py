@@ -0,0 +1,36 @@
+import asyncio
+from functools import partial
+
+import asyncssh
+from kubessh.server import BaseServer
+
+
+class NoAuthServer(BaseServer):
+    def begin_auth(self, username):
+        return False
+
+
+def test_subsystems():
+    """
+    sftp subsystem requests reach the process factory, like other sessions
+    """
+    async def run():
+        async def handle(process):
+            process.stdout.write(f'{process.subsystem} {process.command}'.encode())
+            process.exit(0)
+
+        server = await asyncssh.listen(
+            '127.0.0.1', 0,
+            server_factory=partial(NoAuthServer, process_factory=handle),
+            server_host_keys=[asyncssh.generate_private_key('ssh-ed25519')],
+            encoding=None,
+        )
+        port = server.sockets[0].getsockname()[1]
+        async with asyncssh.connect('127.0.0.1', port, username='yuvi', known_hosts=None) as conn:
+            result = await conn.run(subsystem='sftp', encoding=None)
+            assert result.stdout == b'sftp None'
+            result = await conn.run('ls', encoding=None)
+            assert result.stdout == b'None ls'
+        server.close()
+
+    asyncio.run(run())
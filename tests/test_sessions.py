@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+from aiohttp import web
+from kubessh.informer import PodInformer
+from kubessh.kube import KubeClient
+from kubessh.sessions import SessionRegistry, LAST_ACTIVITY_ANNOTATION
+from conftest import FakeUserPod, start_fake_api, user_pod
+
+
+def test_cull_idle_pods():
+    """
+    Only pods idle here and everywhere else are deleted
+    """
+    async def run():
+        deleted = []
+        patched = []
+
+        async def delete(request):
+            deleted.append(request.match_info['name'])
+            return web.json_response({})
+
+        async def patch(request):
+            patched.append((request.match_info['name'], await request.json()))
+            return web.json_response({})
+
+        app = web.Application()
+        app.router.add_delete('/api/v1/namespaces/cull-test/pods/{name}', delete)
+        app.router.add_patch('/api/v1/namespaces/cull-test/pods/{name}', patch)
+        runner = await start_fake_api(app)
+
+        recent = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        pods = {
+            'idle': user_pod('ssh-idle', 'idle', 'uid-1'),
+            'connected': user_pod('ssh-connected', 'connected', 'uid-2'),
+            'elsewhere': user_pod('ssh-elsewhere', 'elsewhere', 'uid-3', annotations={LAST_ACTIVITY_ANNOTATION: recent}),
+            'new': user_pod('ssh-new', 'new', 'uid-4', created=recent),
+            'pool': user_pod('ssh-pool-abcde', '', 'uid-5'),
+        }
+        informer = PodInformer(namespace='cull-test')
+        informer._replace(pods.values())
+        PodInformer._instances['cull-test'] = informer
+
+        registry = SessionRegistry(namespace='cull-test', cull_idle_timeout=60)
+        with registry.session(FakeUserPod(pods['connected']), 'shell') as session:
+            session.record(10)
+            await registry.cull()
+            assert deleted == ['ssh-idle']
+            assert [name for name, _ in patched] == ['ssh-connected']
+
+            # Quiet sessions only keep pods around unless cull_connected is set
+            registry.cull_connected = True
+            registry.pods['cull-test', 'ssh-connected'].last_activity -= 120
+            await registry.cull()
+            assert deleted == ['ssh-idle', 'ssh-idle', 'ssh-connected']
+
+        await KubeClient.instance().close()
+        await runner.cleanup()
+        del PodInformer._instances['cull-test']
+
+    asyncio.run(run())
+
+
+def test_cull_interval_capped():
+    """
+    Activity is checked & published more often than pods can go idle
+    """
+    async def run():
+        registry = SessionRegistry(namespace='cull-test', cull_idle_timeout=60, cull_interval=300)
+        registry.start()
+        assert registry.cull_interval == 30
+        registry._task.cancel()
+
+        registry = SessionRegistry(namespace='cull-test', cull_idle_timeout=600, cull_interval=60)
+        registry.start()
+        assert registry.cull_interval == 60
+        registry._task.cancel()
+
+    asyncio.run(run())
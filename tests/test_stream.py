@@ -0,0 +1,194 @@
+import asyncio
+import json
+
+import pytest
+
+from aiohttp import web
+from kubessh.kube import KubeClient
+from kubessh.stream import (
+    ExecStream, PortForwardStream, exit_code_from_status,
+    STDIN_CHANNEL, STDOUT_CHANNEL, ERROR_CHANNEL, RESIZE_CHANNEL, CLOSE_CHANNEL
+)
+from kubessh.relay import relay
+from conftest import start_fake_api
+
+
+def test_exit_code_from_status():
+    assert exit_code_from_status({'status': 'Success'}) == 0
+    assert exit_code_from_status({
+        'status': 'Failure',
+        'reason': 'NonZeroExitCode',
+        'details': {'causes': [{'reason': 'ExitCode', 'message': '42'}]}
+    }) == 42
+    assert exit_code_from_status({'status': 'Failure', 'reason': 'InternalError'}) == 1
+
+
+async def fake_exec(request):
+    """
+    Behaves like `cat` run through the exec API, recording resizes
+    """
+    ws = web.WebSocketResponse(protocols=['v5.channel.k8s.io'])
+    await ws.prepare(request)
+    request.app['params'] = dict(request.query)
+    async for msg in ws:
+        channel, data = msg.data[0], msg.data[1:]
+        if channel == STDIN_CHANNEL:
+            await ws.send_bytes(bytes([STDOUT_CHANNEL]) + data)
+        elif channel == RESIZE_CHANNEL:
+            request.app['sizes'].append(json.loads(data))
+        elif channel == CLOSE_CHANNEL and data[0] == STDIN_CHANNEL:
+            await ws.send_bytes(bytes([ERROR_CHANNEL]) + json.dumps({'status': 'Success'}).encode())
+            await ws.close()
+    return ws
+
+
+def test_exec_stream():
+    """
+    stdin, stdout, resize & exit status all go over the websocket
+    """
+    async def run():
+        app = web.Application()
+        app['sizes'] = []
+        app.router.add_get('/api/v1/namespaces/{namespace}/pods/{name}/exec', fake_exec)
+        runner = await start_fake_api(app)
+
+        stream = await ExecStream.connect('default', 'ssh-yuvi', 'shell', ['cat'], tty=False)
+        await stream.resize(80, 24)
+        await stream.write_stdin(b'hello')
+        await stream.close_stdin()
+
+        output = [data async for channel, data in stream]
+        assert output == [b'hello']
+        assert stream.exit_code == 0
+        assert app['sizes'] == [{'Width': 80, 'Height': 24}]
+        assert app['params']['stderr'] == 'true'
+        await KubeClient.instance().close()
+        await runner.cleanup()
+
+    asyncio.run(run())
+
+
+async def fake_exec_v4(request):
+    """
+    Behaves like `cat` run through the exec API, on a server without v5
+    """
+    ws = web.WebSocketResponse(protocols=['v4.channel.k8s.io'])
+    await ws.prepare(request)
+    async for msg in ws:
+        channel, data = msg.data[0], msg.data[1:]
+        if channel == STDIN_CHANNEL:
+            await ws.send_bytes(bytes([STDOUT_CHANNEL]) + data)
+    return ws
+
+
+def test_exec_stream_v4_eof():
+    """
+    Without v5, closing stdin closes the stream rather than hanging
+    """
+    async def run():
+        app = web.Application()
+        app.router.add_get('/api/v1/namespaces/{namespace}/pods/{name}/exec', fake_exec_v4)
+        runner = await start_fake_api(app)
+
+        stream = await ExecStream.connect('default', 'ssh-yuvi', 'shell', ['cat'], tty=False)
+        assert not stream.can_close_stdin
+        await stream.close_stdin()
+        output = await asyncio.wait_for(_collect(stream), 5)
+        assert output == []
+        assert stream.exit_code == 1
+        await KubeClient.instance().close()
+        await runner.cleanup()
+
+    asyncio.run(run())
+
+
+async def _collect(stream):
+    return [data async for channel, data in stream]
+
+
+async def fake_portforward(request):
+    """
+    Echoes data back, uppercased, like a pod running an echo server on the port
+    """
+    ws = web.WebSocketResponse(protocols=['v4.channel.k8s.io'])
+    await ws.prepare(request)
+    port = int(request.query['ports']).to_bytes(2, 'little')
+    await ws.send_bytes(bytes([0]) + port)
+    await ws.send_bytes(bytes([1]) + port)
+    async for msg in ws:
+        data = msg.data[1:]
+        if data == b'fail':
+            await ws.send_bytes(bytes([1]) + b'connection refused')
+        else:
+            await ws.send_bytes(bytes([0]) + data.upper())
+    return ws
+
+
+def test_portforward_stream():
+    """
+    Port prefixes are stripped, and data & errors are read from their channels
+    """
+    async def run():
+        app = web.Application()
+        app.router.add_get('/api/v1/namespaces/{namespace}/pods/{name}/portforward', fake_portforward)
+        runner = await start_fake_api(app)
+
+        stream = await PortForwardStream.connect('default', 'ssh-yuvi', 8888)
+        stream.write(b'hello')
+        await stream.drain()
+        assert await stream.read(3) == b'HEL'
+        assert await stream.read(100) == b'LO'
+
+        stream.write(b'fail')
+        await stream.drain()
+        with pytest.raises(ConnectionError):
+            await stream.read(100)
+
+        stream.close()
+        await stream.wait_closed()
+        assert stream.ws.closed
+        await KubeClient.instance().close()
+        await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_portforward_closed_with_client():
+    """
+    Port forwards can't half-close, so the client closing its side closes
+    the whole forward - even while the pod keeps its side open
+    """
+    async def run():
+        upstream_closed = asyncio.Event()
+
+        async def hold_open(request):
+            ws = web.WebSocketResponse(protocols=['v4.channel.k8s.io'])
+            await ws.prepare(request)
+            port = int(request.query['ports']).to_bytes(2, 'little')
+            await ws.send_bytes(bytes([0]) + port)
+            await ws.send_bytes(bytes([1]) + port)
+            async for msg in ws:
+                await ws.send_bytes(bytes([0]) + msg.data[1:])
+            upstream_closed.set()
+            return ws
+
+        app = web.Application()
+        app.router.add_get('/api/v1/namespaces/{namespace}/pods/{name}/portforward', hold_open)
+        runner = await start_fake_api(app)
+
+        stream = await PortForwardStream.connect('default', 'ssh-yuvi', 8888)
+        server = await asyncio.start_server(
+            lambda reader, writer: relay(reader, writer, stream, stream), '127.0.0.1', 0
+        )
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+        writer.write(b'ping')
+        assert await asyncio.wait_for(reader.readexactly(4), 1) == b'ping'
+        writer.close()
+
+        await asyncio.wait_for(upstream_closed.wait(), 2)
+        await stream.wait_closed()
+        server.close()
+        await KubeClient.instance().close()
+        await runner.cleanup()
+
+    asyncio.run(run())
@@ -0,0 +1,37 @@
+from kubessh.template import CompiledTemplate, LRUCache
+
+
+def test_expand_only_placeholders():
+    """
+    Only parts of the template with placeholders in them are copied
+    """
+    template = {
+        'metadata': {'name': 'home-{username}', 'labels': {'app': 'kubessh'}},
+        'spec': {
+            'containers': [
+                {'name': 'shell', 'env': [{'name': 'USER', 'value': '{username}'}]},
+                {'name': 'sidecar', 'args': ['--port', '8888']},
+            ],
+        },
+    }
+    compiled = CompiledTemplate(template)
+    expanded = compiled.expand(username='yuvi')
+
+    assert expanded['metadata']['name'] == 'home-yuvi'
+    assert expanded['spec']['containers'][0]['env'][0]['value'] == 'yuvi'
+    assert template['metadata']['name'] == 'home-{username}'
+    assert expanded['metadata']['labels'] is template['metadata']['labels']
+    assert expanded['spec']['containers'][1] is template['spec']['containers'][1]
+
+    assert CompiledTemplate({'a': ['b']}).expand(username='yuvi') == {'a': ['b']}
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    assert cache.get('a', lambda: 1) == 1
+    assert cache.get('b', lambda: 2) == 2
+    assert cache.get('a', lambda: 'unused') == 1
+    cache.get('c', lambda: 3)
+    # b was the least recently used
+    assert cache.get('b', lambda: 'new') == 'new'
+    assert len(cache) == 2
@@ -0,0 +1,48 @@
+import asyncio
+
+from kubessh.terminal import Terminal
+
+
+async def read_until(terminal, expected):
+    output = b''
+    while expected not in output:
+        data = await asyncio.wait_for(terminal.read(), 5)
+        assert data, f'Terminal closed after {output!r}'
+        output += data
+    return output
+
+
+def test_terminal():
+    """
+    Input & output flow through the terminal, and exit codes come back
+    """
+    async def run():
+        terminal = Terminal.spawn(['sh', '-c', 'stty size; read line; echo "got $line"; exit 3'], 100, 40)
+        assert b'40 100' in await read_until(terminal, b'40 100')
+        await terminal.write(b'hello\n')
+        await read_until(terminal, b'got hello')
+        assert await asyncio.wait_for(terminal.wait(), 5) == 3
+        assert await terminal.read() == b''
+        terminal.close()
+
+    asyncio.run(run())
+
+
+def test_terminal_resize_and_hangup():
+    """
+    Resizes reach the child, and hanging up stops it
+    """
+    async def run():
+        terminal = Terminal.spawn(['sh', '-c', 'trap "stty size" WINCH; echo ready; while true; do sleep 0.01; done'], 80, 24)
+        await read_until(terminal, b'ready')
+        terminal.resize(120, 50)
+        await read_until(terminal, b'50 120')
+        # Killed by SIGHUP
+        assert await terminal.terminate() == 129
+
+        terminal = Terminal.spawn(['sh', '-c', 'trap "" HUP; echo ready; while true; do sleep 0.01; done'], 80, 24)
+        await read_until(terminal, b'ready')
+        # Killed by SIGKILL, since it ignores SIGHUP
+        assert await terminal.terminate(grace_period=0.1) == 137
+
+    asyncio.run(run())
@@ -0,0 +1,117 @@
+import asyncio
+
+from aiohttp import web
+from kubessh.informer import PodInformer
+from kubessh.kube import KubeClient
+from kubessh.pod import UserPod, PodState
+from kubessh.timeline import SpawnTimeline
+from conftest import make_pod, start_fake_api
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100
+
+    def __call__(self):
+        return self.now
+
+
+def test_phases():
+    clock = FakeClock()
+    timeline = SpawnTimeline(clock)
+    assert timeline.describe() == 'Creating your pod (0s)'
+
+    clock.now += 0.5
+    timeline.mark('created')
+    clock.now += 2
+    timeline.update_from_event({'reason': 'FailedScheduling', 'message': '0/3 nodes are available'})
+    assert timeline.describe() == 'Waiting for a node (2s): 0/3 nodes are available'
+    timeline.update_from_pod({'status': {'conditions': [{'type': 'PodScheduled', 'status': 'True'}]}})
+    clock.now += 1
+    timeline.update_from_event({'reason': 'Pulling'})
+    clock.now += 10
+    timeline.update_from_event({'reason': 'Pulled'})
+    assert timeline.describe() == 'Starting container (0s)'
+    clock.now += 1.5
+    timeline.mark('running')
+
+    assert timeline.phases() == {
+        'create': 0.5,
+        'scheduling': 2,
+        'volumes': 1,
+        'image_pull': 10,
+        'container_start': 1.5,
+    }
+
+
+def test_phases_missing_marks():
+    """
+    Phases we can't tell the start of are left out
+    """
+    clock = FakeClock()
+    timeline = SpawnTimeline(clock)
+    clock.now += 1
+    timeline.mark('created')
+    clock.now += 1
+    timeline.mark('scheduled')
+    # Cached images are only 'Pulled'
+    clock.now += 1
+    timeline.update_from_event({'reason': 'Pulled', 'message': 'already present on machine'})
+    clock.now += 1
+    timeline.mark('running')
+    assert timeline.phases() == {
+        'create': 1, 'scheduling': 1, 'volumes': 1, 'image_pull': 0, 'container_start': 1
+    }
+
+    # Without events, we only know when the pod was scheduled & running
+    timeline = SpawnTimeline(clock)
+    timeline.mark('created')
+    timeline.mark('scheduled')
+    clock.now += 5
+    timeline.mark('running')
+    assert timeline.phases() == {'create': 0, 'scheduling': 0}
+
+
+def test_wait_for_running_timeline():
+    """
+    Pod conditions and events end up in the timeline
+    """
+    async def run():
+        reads = 0
+
+        async def get_pod(request):
+            nonlocal reads
+            reads += 1
+            pod = make_pod(request.match_info['name'], 'yuvi', phase='Pending')
+            if reads >= 2:
+                pod['status']['conditions'] = [{'type': 'PodScheduled', 'status': 'True'}]
+            if reads >= 3:
+                pod['status']['phase'] = 'Running'
+            return web.json_response(pod)
+
+        async def events(request):
+            assert 'involvedObject.name=ssh-yuvi' in request.query['fieldSelector']
+            if request.query.get('watch'):
+                return web.Response(body=b'')
+            return web.json_response({
+                'metadata': {'resourceVersion': '10'},
+                'items': [{'reason': 'Pulling'}, {'reason': 'Pulled'}],
+            })
+
+        app = web.Application()
+        app.router.add_get('/api/v1/namespaces/default/pods/{name}', get_pod)
+        app.router.add_get('/api/v1/namespaces/default/events', events)
+        runner = await start_fake_api(app)
+
+        pod = UserPod('yuvi', 'default', poll_max_interval=0.01)
+        pod.informer = PodInformer(namespace='default')
+        pod.timeline = SpawnTimeline()
+        pod.timeline.mark('created')
+        states = [state async for state in pod._wait_for_running(make_pod('ssh-yuvi', 'yuvi', phase='Pending'))]
+        assert states[-1] == PodState.RUNNING
+        assert set(pod.timeline.marks) == {'created', 'scheduled', 'pulling', 'pulled', 'running'}
+
+        await KubeClient.instance().close()
+        await runner.cleanup()
+
+    asyncio.run(run())
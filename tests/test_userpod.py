@@ -1,5 +1,12 @@
-import pytest
-from kubessh.pod import UserPod
+import asyncio
+
+from aiohttp import web
+from traitlets.config import Config
+from kubessh.informer import PodInformer, PVCInformer
+from kubessh.kube import KubeClient
+from kubessh.lease import Lease
+from kubessh.pod import UserPod, PodState
+from conftest import make_pod, make_pvc, start_fake_api
 
 def test_pod_name():
     """
@@ -7,3 +14,209 @@ def test_pod_name():
     """
     assert UserPod('test-name', 'default').pod_name == 'ssh-test-2dname'
 
+
+
+class FakeSpawnPod(UserPod):
+    """
+    UserPod whose spawn just counts how often it runs
+    """
+    spawns = 0
+
+    async def _spawn(self):
+        FakeSpawnPod.spawns += 1
+        yield PodState.STARTING
+        await asyncio.sleep(0.05)
+        if self.username == 'broken':
+            raise RuntimeError('Pod exited while starting')
+        self.pod = {'metadata': {'name': 'ssh-pool-abcde'}}
+        self.pod_name = 'ssh-pool-abcde'
+        yield PodState.RUNNING
+
+
+def test_concurrent_spawns():
+    """
+    Concurrent ensure_running calls for one user share a single spawn
+    """
+    async def start(username):
+        pod = FakeSpawnPod(username, 'default')
+        states = [state async for state in pod.ensure_running()]
+        return pod, states
+
+    async def run():
+        results = await asyncio.gather(*[start('yuvi') for _ in range(5)])
+        assert FakeSpawnPod.spawns == 1
+        for pod, states in results:
+            assert states == [PodState.STARTING, PodState.RUNNING]
+            assert pod.pod_name == 'ssh-pool-abcde'
+
+        # Once done, the next call spawns again
+        await start('yuvi')
+        assert FakeSpawnPod.spawns == 2
+
+        # Everyone waiting hears about failures
+        results = await asyncio.gather(*[start('broken') for _ in range(3)], return_exceptions=True)
+        assert FakeSpawnPod.spawns == 3
+        assert all(isinstance(r, RuntimeError) for r in results)
+
+    asyncio.run(run())
+
+
+def test_specs():
+    """
+    Pod & PVC specs are expanded for the user and labelled
+    """
+    pod = UserPod('test-name', 'default', pod_template={
+        'metadata': {'labels': {'app': 'kubessh'}},
+        'spec': {'volumes': [{'name': 'home', 'persistentVolumeClaim': {'claimName': 'home-{username}'}}]},
+    })
+    spec = pod.make_pod_spec()
+    assert spec['metadata']['name'] == 'ssh-test-2dname'
+    assert spec['metadata']['labels'] == {'app': 'kubessh', 'kubessh.yuvi.in/username': 'test-2Dname'}
+    assert spec['spec']['volumes'][0]['persistentVolumeClaim']['claimName'] == 'home-test-2dname'
+    assert pod.make_pod_spec() is spec
+
+    pod.pvc_templates = [{'metadata': {'name': 'home-{username}'}}]
+    [compiled] = pod.compiled_templates('pvc_templates')
+    pvc = pod.make_pvc_spec(compiled)
+    assert pvc['metadata'] == {'name': 'home-test-2dname', 'labels': {'kubessh.yuvi.in/username': 'test-2Dname'}}
+
+
+def test_configured():
+    """
+    Templates can be read from config without making a UserPod
+    """
+    config = Config()
+    assert UserPod.configured(config, 'pvc_templates') == []
+    assert UserPod.configured(config, 'pod_template') == UserPod('', 'default').pod_template
+
+    config.UserPod.pvc_templates = [{'metadata': {'name': 'home-{username}'}}]
+    assert UserPod.configured(config, 'pvc_templates') == config.UserPod.pvc_templates
+
+    config = Config()
+    config.UserPod.pvc_templates.append({'metadata': {'name': 'scratch-{username}'}})
+    assert UserPod.configured(config, 'pvc_templates') == [{'metadata': {'name': 'scratch-{username}'}}]
+
+
+def test_templates_compiled_once():
+    """
+    Templates from config are compiled once, not once per UserPod
+    """
+    config = Config()
+    config.UserPod.pod_template = {'metadata': {'name': 'ssh-{username}'}}
+    first = UserPod('a', 'default', config=config)
+    second = UserPod('b', 'default', config=config)
+    assert first.compiled_templates('pod_template') is second.compiled_templates('pod_template')
+    assert UserPod('a', 'default').compiled_templates('pvc_templates') == []
+
+    # Changed templates are compiled again
+    second.pod_template = {'metadata': {'name': 'other-{username}'}}
+    assert second.compiled_templates('pod_template').template == second.pod_template
+    assert first.compiled_templates('pod_template').template == config.UserPod.pod_template
+
+
+def test_create_conflict():
+    """
+    When another replica created the pod first, we use theirs
+    """
+    async def run():
+        async def create(request):
+            return web.json_response({'reason': 'AlreadyExists'}, status=409)
+
+        async def get(request):
+            return web.json_response(make_pod(request.match_info['name'], 'yuvi', uid='theirs'))
+
+        app = web.Application()
+        app.router.add_post('/api/v1/namespaces/default/pods', create)
+        app.router.add_get('/api/v1/namespaces/default/pods/{name}', get)
+        runner = await start_fake_api(app)
+
+        pod = UserPod('yuvi', 'default')
+        pod.informer = PodInformer(namespace='default')
+        created = await pod._create()
+        assert created['metadata']['uid'] == 'theirs'
+
+        await KubeClient.instance().close()
+        await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_pvcs():
+    """
+    PVCs are created concurrently, and known PVCs are left alone
+    """
+    async def run():
+        created = []
+        in_flight = 0
+        max_in_flight = 0
+
+        async def create(request):
+            nonlocal in_flight, max_in_flight
+            pvc = await request.json()
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.05)
+            in_flight -= 1
+            created.append(pvc['metadata']['name'])
+            pvc['metadata'].update(uid=f'uid-{pvc["metadata"]["name"]}', resourceVersion='1')
+            return web.json_response(pvc)
+
+        async def create_pod(request):
+            pod = await request.json()
+            pod['metadata'].update(uid='uid-pod', resourceVersion='1')
+            return web.json_response(pod)
+
+        app = web.Application()
+        app.router.add_post('/api/v1/namespaces/pvc-test/persistentvolumeclaims', create)
+        app.router.add_post('/api/v1/namespaces/pvc-test/pods', create_pod)
+        runner = await start_fake_api(app)
+
+        pvcs = PVCInformer(namespace='pvc-test')
+        pvcs._replace([make_pvc('home-known', 'known')])
+        PVCInformer._instances['pvc-test'] = pvcs
+        try:
+            templates = [{'metadata': {'name': 'home-{username}'}}, {'metadata': {'name': 'scratch-{username}'}}]
+            pod = UserPod('yuvi', 'pvc-test', pvc_templates=templates)
+            pod.informer = PodInformer(namespace='pvc-test')
+            await pod._create()
+            assert sorted(created) == ['home-yuvi', 'scratch-yuvi']
+            assert max_in_flight == 2
+
+            # Created PVCs are remembered, as are ones listed by the informer
+            [home, _] = pod.compiled_templates('pvc_templates')
+            await UserPod('yuvi', 'pvc-test')._ensure_pvc(home)
+            await UserPod('known', 'pvc-test')._ensure_pvc(home)
+            assert len(created) == 2
+        finally:
+            del PVCInformer._instances['pvc-test']
+            await KubeClient.instance().close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_lease_unavailable(caplog):
+    """
+    Pods start without a lease when leases are forbidden or not served,
+    with one warning for each namespace
+    """
+    async def run():
+        async def forbidden(request):
+            return web.json_response({'reason': 'Forbidden'}, status=403)
+
+        app = web.Application()
+        app.router.add_route('*', '/apis/coordination.k8s.io/v1/namespaces/lease-test/leases/{name}', forbidden)
+        runner = await start_fake_api(app)
+
+        # Nothing serves leases in no-leases, so they are 404
+        for namespace in ('lease-test', 'no-leases'):
+            for username in ('yuvi', 'other'):
+                pod = UserPod(username, namespace)
+                assert await pod._acquire(Lease(pod.namespace, pod.pod_name, 10))
+        warnings = [r for r in caplog.records if r.levelname == 'WARNING' and 'leases' in r.getMessage()]
+        assert len(warnings) == 2
+
+        await KubeClient.instance().close()
+        await runner.cleanup()
+
+    asyncio.run(run())
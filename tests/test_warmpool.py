@@ -0,0 +1,53 @@
+import datetime
+
+from traitlets.config import Config, LoggingConfigurable
+
+from kubessh.informer import USERNAME_LABEL
+from kubessh.warmpool import WarmPool
+
+
+def test_target_size_schedule():
+    """
+    Schedule entries override size, including ones wrapping around midnight
+    """
+    pool = WarmPool(size=2, size_schedule=[
+        {'start': '08:00', 'end': '18:00', 'size': 20},
+        {'start': '22:00', 'end': '06:00', 'size': 0},
+    ])
+    at = lambda hour, minute=0: datetime.datetime(2020, 1, 1, hour, minute)
+    assert pool.target_size(at(12)) == 20
+    assert pool.target_size(at(18)) == 2
+    assert pool.target_size(at(23)) == 0
+    assert pool.target_size(at(3)) == 0
+    assert pool.target_size(at(7, 59)) == 2
+
+
+def test_usable():
+    """
+    Pool can't be used when pods depend on who the user is
+    """
+    def pool(**user_pod_config):
+        config = Config()
+        config.UserPod = Config(user_pod_config)
+        return WarmPool(parent=LoggingConfigurable(config=config))
+
+    assert pool().usable()
+    assert not pool(pod_template={'spec': {'containers': [{'name': 'shell', 'args': ['{username}']}]}}).usable()
+    assert not pool(pvc_templates=[{'metadata': {'name': 'home-{username}'}}]).usable()
+
+
+def test_make_pod_spec():
+    """
+    Pool pods are made from the configured template, with an empty username label
+    """
+    config = Config()
+    config.UserPod.pod_template = {
+        'metadata': {'name': 'ssh-{username}', 'labels': {'app': 'kubessh'}},
+        'spec': {'containers': [{'name': 'shell', 'image': 'busybox'}]},
+    }
+    spec = WarmPool(parent=LoggingConfigurable(config=config)).make_pod_spec()
+    assert spec['metadata'] == {
+        'generateName': 'ssh-pool-',
+        'labels': {'app': 'kubessh', USERNAME_LABEL: ''},
+    }
+    assert spec['spec'] == config.UserPod.pod_template['spec']